@@ -0,0 +1,91 @@
+ -- Every form a product or bulk item barcode may be scanned as, mapped back
+ -- to the barcode we store, so a scan resolves in one indexed lookup
+ -- (BobApi.resolve_barcode) instead of a retry per variant.
+ --
+ -- Rank 0 is the stored barcode itself; rank 1 is a padded form: a UPC-A
+ -- behind a leading zero (EAN-13), or a UPC-E between a leading zero and any
+ -- check digit.  When a scan matches several rows, the lowest rank wins,
+ -- then products over bulk items.  barcode_alias_forms() must match
+ -- barcode_aliases() in pybob/private_api/barcodes.py.
+ --
+ -- Triggers keep the table in step with products and bulk_items.  Run once
+ -- to create and backfill.
+
+begin;
+
+create table barcode_aliases (
+    alias character varying not null,
+    rank smallint not null,
+    kind text not null check (kind in ('product', 'bulkitem')),
+    barcode character varying not null,
+    bulkid integer
+);
+
+create index barcode_aliases_alias_index on barcode_aliases (alias);
+create index barcode_aliases_barcode_index on barcode_aliases (barcode);
+
+create or replace function barcode_alias_forms(p_barcode character varying)
+    returns table (alias character varying, rank smallint) as $$
+begin
+    return query select p_barcode, 0::smallint;
+    if length(p_barcode) = 12 then
+        return query select ('0' || p_barcode)::character varying, 1::smallint;
+    end if;
+    if length(p_barcode) = 6 then
+        return query
+            select ('0' || p_barcode || d)::character varying, 1::smallint
+            from generate_series(0, 9) d;
+    end if;
+end;
+$$ language plpgsql immutable;
+
+create or replace function products_barcode_aliases() returns trigger as $$
+begin
+    if TG_OP in ('UPDATE', 'DELETE') then
+        delete from barcode_aliases
+            where kind = 'product' and barcode = OLD.barcode;
+    end if;
+    if TG_OP in ('INSERT', 'UPDATE') then
+        insert into barcode_aliases (alias, rank, kind, barcode, bulkid)
+            select f.alias, f.rank, 'product', NEW.barcode, NEW.bulkid
+            from barcode_alias_forms(NEW.barcode) f;
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+create or replace function bulk_items_barcode_aliases() returns trigger as $$
+begin
+    if TG_OP in ('UPDATE', 'DELETE') then
+        delete from barcode_aliases
+            where kind = 'bulkitem' and bulkid = OLD.bulkid;
+    end if;
+    if TG_OP in ('INSERT', 'UPDATE') and NEW.bulkbarcode is not null then
+        insert into barcode_aliases (alias, rank, kind, barcode, bulkid)
+            select f.alias, f.rank, 'bulkitem', NEW.bulkbarcode, NEW.bulkid
+            from barcode_alias_forms(NEW.bulkbarcode) f;
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists products_barcode_aliases on products;
+create trigger products_barcode_aliases
+    after insert or update of barcode, bulkid or delete on products
+    for each row execute procedure products_barcode_aliases();
+
+drop trigger if exists bulk_items_barcode_aliases on bulk_items;
+create trigger bulk_items_barcode_aliases
+    after insert or update of bulkid, bulkbarcode or delete on bulk_items
+    for each row execute procedure bulk_items_barcode_aliases();
+
+insert into barcode_aliases (alias, rank, kind, barcode, bulkid)
+    select f.alias, f.rank, 'product', p.barcode, p.bulkid
+    from products p, barcode_alias_forms(p.barcode) f;
+
+insert into barcode_aliases (alias, rank, kind, barcode, bulkid)
+    select f.alias, f.rank, 'bulkitem', b.bulkbarcode, b.bulkid
+    from bulk_items b, barcode_alias_forms(b.bulkbarcode) f
+    where b.bulkbarcode is not null;
+
+commit;
@@ -0,0 +1,24 @@
+ -- Tell listeners (pybob/private_api/catalog.py) whenever the product
+ -- catalog changes, so in-process caches of products and bulk_items can be
+ -- dropped.  Safe to re-run.
+
+begin;
+
+create or replace function notify_catalog_changed() returns trigger as $$
+begin
+    perform pg_notify('catalog_changed', TG_TABLE_NAME);
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists products_catalog_changed on products;
+create trigger products_catalog_changed
+    after insert or update or delete or truncate on products
+    for each statement execute procedure notify_catalog_changed();
+
+drop trigger if exists bulk_items_catalog_changed on bulk_items;
+create trigger bulk_items_catalog_changed
+    after insert or update or delete or truncate on bulk_items
+    for each statement execute procedure notify_catalog_changed();
+
+commit;
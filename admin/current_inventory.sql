@@ -0,0 +1,235 @@
+ -- What we think is on the shelves right now, per bulk item, kept in step
+ -- by triggers so easy_inventory and orders/create_order_estimate.py can
+ -- read it directly instead of rebuilding it from all of inventory, orders
+ -- and transactions on every request.
+ --
+ -- For each bulk item, inventory_state holds the last inventory of it (for
+ -- active items), the units ordered after that date, and the sales since
+ -- then; the current_inventory view adds them up.  An item has a row if it
+ -- has been inventoried or sold since.  This is the same model the old
+ -- temporary views computed.
+ --
+ -- A purchase just bumps n_sold.  Anything rarer (inventory counts, orders,
+ -- edits to products or bulk items, rewritten transactions) recomputes the
+ -- affected items with inventory_state_refresh().
+ --
+ -- Run once to create and backfill.
+
+begin;
+
+create table inventory_state (
+    bulkid integer primary key,
+    date date,
+    n_inventoried integer,
+    n_ordered bigint default 0 not null,
+    n_sold bigint default 0 not null,
+    most_recent_sale timestamp with time zone
+);
+
+create or replace view current_inventory as
+    select
+        date,
+        bulkid,
+        coalesce(n_inventoried, 0) + n_ordered - n_sold as remaining,
+        n_inventoried,
+        n_ordered,
+        n_sold,
+        most_recent_sale
+    from inventory_state;
+
+create or replace function inventory_state_refresh(p_bulkid integer)
+    returns void as $$
+declare
+    v_date date;
+    v_units integer;
+    v_ordered bigint;
+    v_sold bigint;
+    v_recent timestamp with time zone;
+begin
+    if p_bulkid is null then
+        return;
+    end if;
+
+    loop
+        v_date := null;
+        v_units := null;
+        select i.date, i.units into v_date, v_units
+            from inventory i
+                inner join bulk_items b on b.bulkid = i.bulkid
+            where i.bulkid = p_bulkid and b.active
+            order by i.date desc
+            limit 1;
+
+        select sum(oi.quantity * oi.number) into v_ordered
+            from orders o
+                inner join order_items oi on oi.order_id = o.id
+            where oi.bulk_type_id = p_bulkid
+                and (v_date is null or o.date > v_date);
+
+        select count(*), max(t.xacttime) into v_sold, v_recent
+            from transactions t
+                inner join products p on p.barcode = t.barcode
+            where p.bulkid = p_bulkid
+                and (v_date is null or t.xacttime > v_date);
+
+        delete from inventory_state where bulkid = p_bulkid;
+        if v_date is null and v_sold = 0 then
+            return;
+        end if;
+
+        begin
+            insert into inventory_state (bulkid, date, n_inventoried,
+                                         n_ordered, n_sold, most_recent_sale)
+                values (p_bulkid, v_date, v_units,
+                        coalesce(v_ordered, 0), v_sold, v_recent);
+            return;
+        exception when unique_violation then
+            -- A concurrent refresh or first sale beat us to it; count
+            -- again, now that we can see what it committed.
+        end;
+    end loop;
+end;
+$$ language plpgsql;
+
+ -- Counts n sales (n = 1 or -1) of p_bulkid made at p_time.
+create or replace function inventory_state_sale(
+        p_bulkid integer, p_time timestamp with time zone, n integer)
+    returns void as $$
+begin
+    if p_bulkid is null then
+        return;
+    end if;
+
+    if n > 0 then
+        update inventory_state
+            set n_sold = n_sold + n,
+                most_recent_sale = greatest(most_recent_sale, p_time)
+            where bulkid = p_bulkid and (date is null or p_time > date);
+        if not found then
+            -- Either the sale predates the last inventory, or this is the
+            -- item's first sale and it needs a row.
+            perform 1 from inventory_state where bulkid = p_bulkid;
+            if not found then
+                perform inventory_state_refresh(p_bulkid);
+            end if;
+        end if;
+        return;
+    end if;
+
+    perform 1 from inventory_state
+        where bulkid = p_bulkid and (date is null or p_time > date);
+    if not found then
+        -- Never counted, e.g. maintenance.sql trimming old history.
+        return;
+    end if;
+
+    update inventory_state
+        set n_sold = n_sold + n
+        where bulkid = p_bulkid and most_recent_sale > p_time
+            and (date is not null or n_sold + n > 0);
+    if not found then
+        -- It was the latest sale, or the item's only one.
+        perform inventory_state_refresh(p_bulkid);
+    end if;
+end;
+$$ language plpgsql;
+
+create or replace function inventory_state_transactions_trigger()
+    returns trigger as $$
+declare
+    old_bulkid integer;
+    new_bulkid integer;
+begin
+    if TG_OP in ('UPDATE', 'DELETE') then
+        select bulkid into old_bulkid
+            from products where barcode = OLD.barcode;
+    end if;
+    if TG_OP in ('INSERT', 'UPDATE') then
+        select bulkid into new_bulkid
+            from products where barcode = NEW.barcode;
+    end if;
+
+    if TG_OP = 'INSERT' then
+        perform inventory_state_sale(new_bulkid, NEW.xacttime, 1);
+    elsif TG_OP = 'DELETE' then
+        perform inventory_state_sale(old_bulkid, OLD.xacttime, -1);
+    else
+        -- Rare; the refresh already sees the updated row.
+        perform inventory_state_refresh(old_bulkid);
+        if new_bulkid is distinct from old_bulkid then
+            perform inventory_state_refresh(new_bulkid);
+        end if;
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+ -- For the tables whose rows name a bulk item in the column given as the
+ -- trigger's argument.
+create or replace function inventory_state_refresh_trigger()
+    returns trigger as $$
+declare
+    old_bulkid integer;
+    new_bulkid integer;
+begin
+    if TG_OP in ('UPDATE', 'DELETE') then
+        execute format('select ($1).%I', TG_ARGV[0])
+            into old_bulkid using OLD;
+        perform inventory_state_refresh(old_bulkid);
+    end if;
+    if TG_OP in ('INSERT', 'UPDATE') then
+        execute format('select ($1).%I', TG_ARGV[0])
+            into new_bulkid using NEW;
+        if new_bulkid is distinct from old_bulkid then
+            perform inventory_state_refresh(new_bulkid);
+        end if;
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+create or replace function inventory_state_orders_trigger()
+    returns trigger as $$
+begin
+    perform inventory_state_refresh(oi.bulk_type_id)
+        from (select distinct bulk_type_id from order_items
+              where order_id = OLD.id) oi;
+    return null;
+end;
+$$ language plpgsql;
+
+lock table transactions, inventory, orders, order_items, products,
+    bulk_items in share row exclusive mode;
+
+create trigger transactions_inventory_state
+    after insert or update of barcode, xacttime or delete on transactions
+    for each row execute procedure inventory_state_transactions_trigger();
+
+create trigger inventory_inventory_state
+    after insert or update or delete on inventory
+    for each row execute procedure inventory_state_refresh_trigger('bulkid');
+
+create trigger order_items_inventory_state
+    after insert or update or delete on order_items
+    for each row execute procedure
+        inventory_state_refresh_trigger('bulk_type_id');
+
+create trigger orders_inventory_state
+    after update of date on orders
+    for each row execute procedure inventory_state_orders_trigger();
+
+create trigger products_inventory_state
+    after insert or update of barcode, bulkid or delete on products
+    for each row execute procedure inventory_state_refresh_trigger('bulkid');
+
+create trigger bulk_items_inventory_state
+    after update of active on bulk_items
+    for each row execute procedure inventory_state_refresh_trigger('bulkid');
+
+select inventory_state_refresh(bulkid) from (
+    select bulkid from bulk_items
+    union select bulkid from products where bulkid is not null
+    union select bulkid from inventory
+) s;
+
+commit;
@@ -0,0 +1,122 @@
+ -- Hourly totals of sales and deposits, kept in step with transactions by a
+ -- trigger, so the dashboard's hourly averages (BobApi.get_day_average_data)
+ -- never have to scan a year of transactions.
+ --
+ -- Every insert, update or delete on transactions adjusts a row for its
+ -- (date, hour), so the rollup always equals an aggregate over the table,
+ -- including after maintenance.sql trims old history.
+ --
+ -- Dates and hours are local to hourly_rollup_zone(), not to whatever the
+ -- session's TimeZone happens to be, so the trigger, the backfill and the
+ -- dashboard always agree on which hour a transaction fell in.
+ --
+ -- An updated row stays locked until the purchase commits, and every
+ -- purchase in an hour would want the same one.  So each (date, hour) is spread over
+ -- hourly_rollup_shards() rows, picked by backend, and readers sum them
+ -- through hourly_transaction_totals.  (transactions_inventory_state, from
+ -- current_inventory.sql, also locks a row per purchase, but one per bulk
+ -- item, so only concurrent sales of the same item wait on each other.)
+ --
+ -- Run once to create and backfill.
+
+begin;
+
+create or replace function hourly_rollup_zone() returns text as $$
+    select 'America/Los_Angeles'::text;
+$$ language sql immutable;
+
+create or replace function hourly_rollup_shards() returns integer as $$
+    select 8;
+$$ language sql immutable;
+
+create table hourly_transaction_rollup (
+    date date not null,
+    hour smallint not null,
+    shard smallint not null,
+    sales numeric(12,2) default 0.00 not null,
+    deposits numeric(12,2) default 0.00 not null,
+    -- Per shard this can go negative, when a delete lands on another
+    -- shard than the insert did; the sum over shards can't.
+    n_transactions integer default 0 not null,
+    primary key (date, hour, shard)
+);
+
+create view hourly_transaction_totals as
+    select
+        date, hour,
+        sum(sales) as sales,
+        sum(deposits) as deposits,
+        sum(n_transactions) as n_transactions
+    from hourly_transaction_rollup
+    group by date, hour;
+
+create or replace function hourly_rollup_add(
+        p_time timestamp with time zone, p_value numeric, n integer)
+    returns void as $$
+declare
+    d_sales numeric(12,2) := n * (case when p_value < 0
+                                       then -1 * p_value else 0 end);
+    d_deposits numeric(12,2) := n * (case when p_value > 0
+                                          then p_value else 0 end);
+    local_time timestamp := p_time at time zone hourly_rollup_zone();
+    p_shard smallint := pg_backend_pid() % hourly_rollup_shards();
+begin
+    -- No upsert before 9.5; retry the update if we lose an insert race.
+    loop
+        update hourly_transaction_rollup
+            set sales = sales + d_sales,
+                deposits = deposits + d_deposits,
+                n_transactions = n_transactions + n
+            where date = local_time::date
+                and hour = extract(hour from local_time)
+                and shard = p_shard;
+        if found then
+            return;
+        end if;
+        begin
+            insert into hourly_transaction_rollup
+                    (date, hour, shard, sales, deposits, n_transactions)
+                values (local_time::date, extract(hour from local_time),
+                        p_shard, d_sales, d_deposits, n);
+            return;
+        exception when unique_violation then
+            -- Someone else created the row; go round and update it.
+        end;
+    end loop;
+end;
+$$ language plpgsql;
+
+create or replace function hourly_rollup_trigger() returns trigger as $$
+begin
+    if TG_OP in ('UPDATE', 'DELETE') then
+        perform hourly_rollup_add(OLD.xacttime, OLD.xactvalue, -1);
+    end if;
+    if TG_OP in ('INSERT', 'UPDATE') then
+        perform hourly_rollup_add(NEW.xacttime, NEW.xactvalue, 1);
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+lock table transactions in share row exclusive mode;
+
+insert into hourly_transaction_rollup
+        (date, hour, shard, sales, deposits, n_transactions)
+    select
+        local_time::date,
+        extract(hour from local_time),
+        0,
+        -1 * sum(case when xactvalue < 0 then xactvalue else 0 end),
+        sum(case when xactvalue > 0 then xactvalue else 0 end),
+        count(*)
+    from (
+        select xacttime at time zone hourly_rollup_zone() as local_time,
+            xactvalue
+        from transactions) t
+    group by local_time::date, extract(hour from local_time);
+
+create trigger transactions_hourly_rollup
+    after insert or update of xacttime, xactvalue or delete on transactions
+    for each row execute procedure hourly_rollup_trigger();
+
+commit;
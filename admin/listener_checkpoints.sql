@@ -0,0 +1,24 @@
+ -- The last transaction each new_transactions listener has finished with,
+ -- so that after a restart it can replay what it missed before going back
+ -- to LISTEN (see pybob/notifiers/listen_transactions.py and crossbar's
+ -- transaction_stream).
+ --
+ -- Transactions commit out of id order, so the replay also looks a little
+ -- before last_id; recent_ids are those it has already handled there.
+ --
+ -- If you created this table before recent_ids was added:
+ --   alter table listener_checkpoints
+ --       add column recent_ids integer[] default '{}' not null;
+ --
+ -- Run once to create.
+
+begin;
+
+create table listener_checkpoints (
+    consumer text primary key,
+    last_id integer not null,
+    recent_ids integer[] default '{}' not null,
+    updated timestamp with time zone default now() not null
+);
+
+commit;
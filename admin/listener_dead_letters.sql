@@ -0,0 +1,21 @@
+ -- Transactions a new_transactions listener's callback gave up on, after
+ -- retrying, so that they're retried on the listener's next startup instead
+ -- of being passed over by its checkpoint (see
+ -- pybob/notifiers/listen_transactions.py).
+ --
+ -- Run once to create.
+
+begin;
+
+create table listener_dead_letters (
+    consumer text not null,
+    callback text not null,
+    transaction_id integer not null,
+    error text,
+    attempts integer default 1 not null,
+    created timestamp with time zone default now() not null,
+    updated timestamp with time zone default now() not null,
+    primary key (consumer, callback, transaction_id)
+);
+
+commit;
@@ -0,0 +1,77 @@
+ -- Announce each new transaction on the new_transactions channel with the
+ -- fields its listeners use (pybob/notifiers/listen_transactions.py and
+ -- crossbar's transaction_stream), so they don't have to query for them.
+ --
+ -- The payload is a JSON object: the transaction, the user's name and
+ -- balance, and the product's name, price and bulkid (null if it isn't
+ -- one), with the transaction's barcode also given as t_barcode.
+ -- xacttime is ISO 8601, with its UTC offset.  A payload too big for
+ -- NOTIFY (8000 bytes) is sent as just the transaction id, as before, and
+ -- listeners look that one up.
+ --
+ -- It's a deferred constraint trigger, so it runs at commit and sees the
+ -- balance after the whole purchase, as the old lookup did.
+ --
+ -- Replaces the trigger that sent the bare ids, which isn't in this repo,
+ -- so name it (\d transactions lists it):
+ --
+ --     psql -v ON_ERROR_STOP=1 -v old_trigger=<name> -f transaction_notify.sql
+ --
+ -- It fails if there's no trigger of that name on transactions, so a typo
+ -- can't leave two triggers notifying.  Once transactions_notify exists,
+ -- re-running just replaces it, and old_trigger may be anything.
+
+begin;
+
+select set_config('chezbob.old_trigger', :'old_trigger', true);
+
+create or replace function notify_new_transaction() returns trigger as $$
+declare
+    payload text;
+begin
+    select row_to_json(r)::text into payload from (
+        select
+            t.id, t.userid, t.xactvalue, t.xacttype, t.barcode, t.source,
+            to_char(t.xacttime, 'YYYY-MM-DD"T"HH24:MI:SS.USOF') as xacttime,
+            t.barcode as t_barcode,
+            u.username, u.nickname, u.email, u.balance, u.disabled,
+            p.name, p.price, p.bulkid
+        from transactions t
+            inner join users u on u.userid = t.userid
+            left outer join products p on p.barcode = t.barcode
+        where t.id = NEW.id
+    ) r;
+
+    if payload is null or octet_length(payload) >= 8000 then
+        payload := NEW.id::text;
+    end if;
+
+    perform pg_notify('new_transactions', payload);
+    return null;
+end;
+$$ language plpgsql;
+
+do $$
+declare
+    old_trigger text := current_setting('chezbob.old_trigger');
+begin
+    if exists (select 1 from pg_trigger
+               where tgrelid = 'transactions'::regclass
+                   and tgname = 'transactions_notify') then
+        drop trigger transactions_notify on transactions;
+    elsif exists (select 1 from pg_trigger
+                  where tgrelid = 'transactions'::regclass
+                      and tgname = old_trigger) then
+        execute format('drop trigger %I on transactions', old_trigger);
+    else
+        raise exception 'no trigger % on transactions', old_trigger;
+    end if;
+end;
+$$;
+
+create constraint trigger transactions_notify
+    after insert on transactions
+    deferrable initially deferred
+    for each row execute procedure notify_new_transaction();
+
+commit;
@@ -0,0 +1,233 @@
+"""Live dashboard data, pushed over WAMP instead of polled.
+
+Keeps the month of transactions the dashboard's charts are drawn from in
+memory, as get_month_transactions rows, and adds every record
+transaction_stream publishes on chezbob.transaction. Clients call
+chezbob.dashboard.get_snapshot once, then apply the deltas published on
+chezbob.dashboard.delta:
+
+    {"type": "transaction", "seq": n,
+     "transaction": {barcode, bulkid, userid, xactvalue, xacttime_e}}
+
+The snapshot is the columnar form of get_month_transactions, plus the seq
+of the last delta it includes. userids are anonymized the way that
+endpoint does it, with a salt that changes at every resync.
+
+Deltas are numbered; a client that sees a gap in seq should fetch a new
+snapshot. A delta of type "snapshot" says the month was reloaded from the
+database (every RESYNC_INTERVAL_S, which also picks up edits and
+deletions, which don't come down the transaction stream) and clients
+should fetch a new snapshot.
+"""
+
+import datetime
+import hashlib
+import random
+import string
+import time
+
+import psycopg2
+import psycopg2.extras
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.threads import deferToThread
+from twisted.logger import Logger
+
+from autobahn.twisted.util import sleep
+from autobahn.twisted.wamp import ApplicationSession
+
+DB_CREDS = {"dbname": "bob", "user": "bob", "host": "localhost"}
+
+WINDOW_DAYS = 31
+RESYNC_INTERVAL_S = 15 * 60
+
+SNAPSHOT_PROCEDURE = 'chezbob.dashboard.get_snapshot'
+DELTA_TOPIC = 'chezbob.dashboard.delta'
+
+# The same rows as queries.MONTH_TRANSACTIONS.
+MONTH_QUERY = """
+    SELECT t.id, t.barcode, t.userid, t.xacttime, t.xactvalue, p.bulkid
+    FROM transactions t LEFT OUTER JOIN products p ON p.barcode = t.barcode
+    WHERE xacttime > now() - interval '31 days'
+    ORDER BY xacttime ASC
+"""
+
+COLUMNS = ('barcode', 'bulkid', 'xacttime_e', 'xactvalue', 'userid')
+DICTIONARY_COLUMNS = ('barcode', 'userid')
+
+
+def make_salt():
+    return "".join([random.choice(string.printable) for x in range(32)])
+
+
+def anonymize(userid, salt):
+    """As public_api.stats anonymizes userids."""
+    h = hashlib.md5()
+    h.update((str(userid) + salt).encode('ascii', 'ignore'))
+    return h.hexdigest()[:5]
+
+
+def parse_isoformat(st):
+    """Parses datetime.isoformat() output with a UTC offset, as
+    transaction_stream publishes xacttime."""
+    stamp, offset = st[:-6], st[-6:]
+    fmt = "%Y-%m-%dT%H:%M:%S.%f" if '.' in stamp else "%Y-%m-%dT%H:%M:%S"
+    delta = datetime.timedelta(hours=int(offset[1:3]),
+                               minutes=int(offset[4:6]))
+    return datetime.datetime.strptime(stamp, fmt).replace(
+        tzinfo=datetime.timezone(-delta if offset[0] == '-' else delta))
+
+
+def to_columnar(rows, columns=COLUMNS, dictionary_columns=DICTIONARY_COLUMNS):
+    """As public_api.columnar.to_columnar."""
+    result = {
+        "format": "columnar",
+        "length": 0,
+        "columns": {c: [] for c in columns},
+        "dictionaries": {c: [] for c in dictionary_columns},
+    }
+    indexes = {c: {} for c in dictionary_columns}
+
+    for row in rows:
+        result["length"] += 1
+        for c in columns:
+            value = row[c]
+            if c in indexes:
+                index = indexes[c].get(value)
+                if index is None:
+                    index = indexes[c][value] = len(indexes[c])
+                    result["dictionaries"][c].append(value)
+                value = index
+            result["columns"][c].append(value)
+
+    return result
+
+
+class MonthTransactions(object):
+    """The last WINDOW_DAYS of transactions, as anonymized rows."""
+
+    def __init__(self, salt=None):
+        self.salt = salt or make_salt()
+        self.rows = []
+        # Every id in rows -> its xacttime_e. Ids commit out of order, so
+        # a sale can arrive after one with a higher id.
+        self.ids = {}
+
+    def row(self, barcode, bulkid, userid, xactvalue, xacttime_e):
+        return {
+            "barcode": barcode,
+            "bulkid": bulkid,
+            "userid": anonymize(userid, self.salt),
+            "xactvalue": float(xactvalue),
+            "xacttime_e": int(xacttime_e),
+        }
+
+    @classmethod
+    def load(cls, conn):
+        """Reads the month from the database. Blocks."""
+        month = cls()
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute(MONTH_QUERY)
+        for x in cursor:
+            row = month.row(
+                x['barcode'], x['bulkid'], x['userid'], x['xactvalue'],
+                x['xacttime'].timestamp())
+            month.rows.append(row)
+            month.ids[x['id']] = row['xacttime_e']
+        conn.commit()
+        return month
+
+    def add(self, record):
+        """Adds a chezbob.transaction record; returns its row, or None if
+        the snapshot already had it."""
+        if record['id'] in self.ids:
+            return None
+
+        row = self.row(
+            record['t_barcode'], record.get('bulkid'), record['userid'],
+            record['xactvalue'],
+            parse_isoformat(record['xacttime']).timestamp())
+        self.rows.append(row)
+        self.ids[record['id']] = row['xacttime_e']
+        return row
+
+    def trim(self, now=None):
+        cutoff = (now or time.time()) - WINDOW_DAYS * 24 * 60 * 60
+        self.rows = [x for x in self.rows if x['xacttime_e'] > cutoff]
+        self.ids = {k: v for k, v in self.ids.items() if v > cutoff}
+
+    def snapshot(self):
+        return to_columnar(self.rows)
+
+
+class AppSession(ApplicationSession):
+
+    log = Logger()
+
+    def __init__(self, *args, **kwargs):
+        self.conn = psycopg2.connect(**DB_CREDS)
+        self.conn.set_client_encoding("utf-8")
+        self.seq = 0
+        self.month = MonthTransactions.load(self.conn)
+        # Records seen while resync() reads the month, else None.
+        self._arrived_during_load = None
+        super().__init__(*args, **kwargs)
+
+    def get_snapshot(self):
+        self.month.trim()
+        snapshot = self.month.snapshot()
+        snapshot['seq'] = self.seq
+        return snapshot
+
+    def _load(self):
+        try:
+            return MonthTransactions.load(self.conn)
+        except psycopg2.Error:
+            self.conn.rollback()
+            raise
+
+    @inlineCallbacks
+    def resync(self):
+        self._arrived_during_load = []
+        try:
+            month = yield deferToThread(self._load)
+        except psycopg2.Error:
+            self.log.failure("Dashboard resync failed")
+            return
+        finally:
+            arrived, self._arrived_during_load = (
+                self._arrived_during_load, None)
+
+        # Keep anything streamed in while the load ran.
+        for record in arrived:
+            month.add(record)
+
+        self.month = month
+        self.seq += 1
+        yield self.publish(DELTA_TOPIC, {"type": "snapshot", "seq": self.seq})
+
+    def process_transaction(self, record):
+        if self._arrived_during_load is not None:
+            self._arrived_during_load.append(record)
+
+        row = self.month.add(record)
+        if row is None:
+            return None
+
+        self.seq += 1
+        return self.publish(DELTA_TOPIC, {
+            "type": "transaction",
+            "seq": self.seq,
+            "transaction": row,
+        })
+
+    @inlineCallbacks
+    def onJoin(self, details):
+        self.log.info("Starting dashboard aggregator...")
+
+        yield self.register(self.get_snapshot, SNAPSHOT_PROCEDURE)
+        yield self.subscribe(self.process_transaction, 'chezbob.transaction')
+
+        while True:
+            yield sleep(RESYNC_INTERVAL_S)
+            yield self.resync()
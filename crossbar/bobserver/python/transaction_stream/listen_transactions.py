@@ -1,35 +1,155 @@
+"""Callbacks get (cursor, record) for each new transaction.
+
+The record usually comes straight from the notification (see
+admin/transaction_notify.sql); when the payload is just an id, it's looked
+up once for all callbacks.
+
+Given a consumer name, the listener checkpoints the last transaction it
+handled in listener_checkpoints (admin/listener_checkpoints.sql), and on
+startup replays everything after it, in id order, before carrying on with
+the notifications. Since transactions commit out of id order, the replay
+also covers those started in the REPLAY_OVERLAP_S before the checkpoint was
+saved, less the ones it lists as handled.
+"""
+
+import datetime
+import decimal
+import json
 import select
 import sys
+import time
+import traceback
 
 import psycopg2
 import psycopg2.extensions
 import psycopg2.extras
 
+REPLAY_BATCH_SIZE = 1000
+CHECKPOINT_INTERVAL_S = 5
+REPLAY_OVERLAP_S = 10 * 60
+# How long to skip notifications for transactions we replayed.
+REPLAYED_DEDUPE_S = 60
 
-def get_details(cur, id):
-    cur.execute("SELECT * FROM TRANSACTIONS WHERE id = %s", [id])
-    return cur.fetchone()
+# The same fields admin/transaction_notify.sql sends.
+RECORD_QUERY = """
+    SELECT
+        t.id, t.userid, t.xactvalue, t.xacttype, t.barcode, t.source,
+        t.xacttime, t.barcode AS t_barcode,
+        u.username, u.nickname, u.email, u.balance, u.disabled,
+        p.name, p.price, p.bulkid
+    FROM transactions t
+        INNER JOIN users u ON u.userid = t.userid
+        LEFT OUTER JOIN products p ON p.barcode = t.barcode
+"""
+
+REPLAY_QUERY = RECORD_QUERY + """
+    WHERE t.id > %(start)s
+        AND (t.id > %(after_id)s OR t.xacttime > %(since)s)
+        AND NOT t.id = ANY(%(skip)s)
+    ORDER BY t.id
+    LIMIT %(limit)s
+"""
+
+# Where the replay's scan by id starts.
+REPLAY_START = ("SELECT coalesce(min(id) - 1, %(after_id)s) FROM transactions"
+                " WHERE xacttime > %(since)s AND id <= %(after_id)s")
+
+RECORD_BY_ID_QUERY = RECORD_QUERY + """
+    WHERE t.id = %s
+"""
+
+LOAD_CHECKPOINT = ("SELECT last_id, recent_ids,"
+                   " updated - %s * interval '1 second'"
+                   " FROM listener_checkpoints WHERE consumer = %s")
+
+UPDATE_CHECKPOINT = ("UPDATE listener_checkpoints"
+                     " SET last_id = %s, recent_ids = %s, updated = now()"
+                     " WHERE consumer = %s")
+
+INSERT_CHECKPOINT = ("INSERT INTO listener_checkpoints"
+                     " (last_id, recent_ids, consumer)"
+                     " VALUES (%s, %s, %s)")
+
+LAST_TRANSACTION_ID = "SELECT coalesce(max(id), 0) FROM transactions"
 
 
 def get_detailed_details(cur, id):
-    cur.execute(("SELECT t.*, u.*, p.*, t.barcode as t_barcode"
-                 " FROM transactions t"
-                 " INNER JOIN users u"
-                 " ON t.userid = u.userid"
-                 " LEFT OUTER JOIN products p"
-                 " ON p.barcode = t.barcode"
-                 " WHERE id = %s"), [id])
+    """Looks up the record for a payload that was only an id."""
+    cur.execute(RECORD_BY_ID_QUERY, [id])
     return cur.fetchone()
 
 
+def parse_timestamp(st):
+    """Parses to_char(..., 'YYYY-MM-DD"T"HH24:MI:SS.USOF') output."""
+    stamp, sign, offset = st[:26], st[26], st[27:]
+    hours, _, minutes = offset.partition(':')
+    delta = datetime.timedelta(hours=int(hours), minutes=int(minutes or 0))
+    return datetime.datetime.strptime(stamp, "%Y-%m-%dT%H:%M:%S.%f").replace(
+        tzinfo=datetime.timezone(delta if sign == '+' else -delta))
+
+
+def parse_payload(payload):
+    """Returns the record in a new_transactions payload, or None if the
+    payload is only an id."""
+    if not payload.startswith('{'):
+        return None
+    record = json.loads(payload, parse_float=decimal.Decimal)
+    record['xacttime'] = parse_timestamp(record['xacttime'])
+    return record
+
+
+def get_record(cur, payload):
+    record = parse_payload(payload)
+    if record is None:
+        row = get_detailed_details(cur, int(payload))
+        if row is None:
+            raise LookupError("No transaction {}".format(payload))
+        record = dict(row)
+    return record
+
+
+def replay_transactions(cur, after_id, batch_size=REPLAY_BATCH_SIZE,
+                        since=None, skip=()):
+    """Yields the record of every transaction after after_id, and of those
+    before it started after since, in id order, except the ids in skip;
+    fetching batch_size at a time."""
+    args = {"after_id": after_id, "since": since, "skip": list(skip),
+            "limit": batch_size, "start": after_id}
+    if since is not None:
+        cur.execute(REPLAY_START, args)
+        args["start"] = cur.fetchone()[0]
+
+    while True:
+        cur.execute(REPLAY_QUERY, args)
+        rows = cur.fetchall()
+        for row in rows:
+            yield dict(row)
+        if len(rows) < batch_size:
+            return
+        args["start"] = rows[-1]['id']
+
+
+def load_checkpoint(cur, consumer):
+    """Returns (last id, recent ids, replay since) or None."""
+    cur.execute(LOAD_CHECKPOINT, [REPLAY_OVERLAP_S, consumer])
+    row = cur.fetchone()
+    return tuple(row) if row else None
+
+
+def save_checkpoint(cur, consumer, last_id, recent_ids=()):
+    # There's only ever one of each consumer running, so no insert race.
+    cur.execute(UPDATE_CHECKPOINT, [last_id, list(recent_ids), consumer])
+    if not cur.rowcount:
+        cur.execute(INSERT_CHECKPOINT, [last_id, list(recent_ids), consumer])
+
+
 def trunc(st, ln):
     if not st:
         return ''
     return st[:ln]
 
 
-def print_transactions(curs, tid):
-    result = get_detailed_details(curs, tid)
+def print_transactions(curs, result):
     format_line = "{:13} | {:40} | {:6} | {:8} | {:20} | {:20} | {:6} | {}"
 
     print(format_line.format(
@@ -44,7 +164,9 @@ def print_transactions(curs, tid):
     ))
 
 
-def watch_transactions(cbs):
+def watch_transactions(cbs, consumer=None):
+    """Calls each of cbs with every new transaction, forever, replaying
+    those missed since the last run if consumer is given."""
     if type(cbs) != list:
         cbs = [cbs]
 
@@ -53,18 +175,105 @@ def watch_transactions(cbs):
     conn.set_client_encoding("utf-8")
 
     curs = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    # Listen before replaying, so nothing falls between the two.
     curs.execute("LISTEN new_transactions;")
 
+    handled = None
+    # Transaction id -> when we handled it, for the checkpoint's recent_ids.
+    finished = {}
+    saved = (None, [])
+    last_save = time.time()
+
+    def handle(record):
+        nonlocal handled
+        for cb in cbs:
+            try:
+                cb(curs, record)
+            except Exception:
+                traceback.print_exc()
+        handled = max(handled or 0, record['id'])
+        finished[record['id']] = time.time()
+
+    def save_if_due(force=False):
+        nonlocal finished, saved, last_save
+        if not consumer or handled is None:
+            return
+        if not force and time.time() - last_save < CHECKPOINT_INTERVAL_S:
+            return
+        last_save = time.time()
+
+        # Twice the overlap, so clock skew can't open a gap.
+        cutoff = time.time() - 2 * REPLAY_OVERLAP_S
+        finished = {tid: t for tid, t in finished.items() if t > cutoff}
+        checkpoint = (max(handled, saved[0] or 0), sorted(finished))
+        if checkpoint == saved:
+            return
+        try:
+            save_checkpoint(curs, consumer, *checkpoint)
+            saved = checkpoint
+        except psycopg2.Error:
+            traceback.print_exc()
+
+    # Replayed id -> when; their notifications can arrive after the replay.
+    replayed = {}
+    # Notifications are delivered in commit order, so once this one comes
+    # back, so have those of everything the replay saw.
+    drained_channel = "new_transactions_drained_{}".format(
+        conn.get_backend_pid())
+    drained = True
+    if consumer:
+        checkpoint = load_checkpoint(curs, consumer)
+        if checkpoint is None:
+            # First run; there's nothing we missed.
+            curs.execute(LAST_TRANSACTION_ID)
+            checkpoint = (curs.fetchone()[0], [], None)
+            save_checkpoint(curs, consumer, checkpoint[0])
+        last_id, recent_ids, since = checkpoint
+        saved = (last_id, list(recent_ids))
+        # The last run's recent ids still need skipping if we restart soon.
+        for tid in recent_ids:
+            finished.setdefault(tid, time.time())
+
+        # The replay's queries run on curs too, so it gets its own.
+        replay_curs = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        for record in replay_transactions(
+                replay_curs, last_id, since=since, skip=recent_ids):
+            handle(record)
+            replayed[record['id']] = time.time()
+            save_if_due()
+        save_if_due(force=True)
+
+        if replayed:
+            drained = False
+            curs.execute("LISTEN {};".format(drained_channel))
+            curs.execute("NOTIFY {};".format(drained_channel))
+
     while 1:
-        if select.select([conn], [], [], 5) == ([], [], []):
-            pass
-        else:
+        if select.select([conn], [], [], 5) != ([], [], []):
             conn.poll()
             while conn.notifies:
                 notify = conn.notifies.pop(0)
-                for cb in cbs:
-                    cb(curs, int(notify.payload))
+                if notify.channel == drained_channel:
+                    drained = True
+                    curs.execute("UNLISTEN {};".format(drained_channel))
+                    continue
+                try:
+                    record = get_record(curs, notify.payload)
+                except Exception:
+                    traceback.print_exc()
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        traceback.print_exc()
+                    continue
+                if record['id'] in replayed:
+                    continue
+                handle(record)
                 #print(notify.pid, notify.channel, notify.payload)
+        if replayed and drained:
+            cutoff = time.time() - REPLAYED_DEDUPE_S
+            replayed = {tid: t for tid, t in replayed.items() if t > cutoff}
+        save_if_due()
 
 
 def main():
@@ -58,15 +58,14 @@ class AppSession(ApplicationSession):
         self.log.info("add2() called with {x} and {y}", x=x, y=y)
         return x + y
 
-    def handle_transaction(self, curs, tid):
-        record = trans_listener.get_detailed_details(curs, tid)
-
+    def handle_transaction(self, curs, record):
         record = prepare_record(record)
         return self.publish('chezbob.transaction', record)
 
     def listen_thread(self):
         self.log.info("Started listening thread")
-        trans_listener.watch_transactions(self.handle_transaction)
+        trans_listener.watch_transactions(
+            self.handle_transaction, consumer=NODE_NAME)
 
     def start_thread(self):
         self.thread = threading.Thread(daemon=True, target=self.listen_thread)
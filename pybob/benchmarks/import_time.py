@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Reports what importing the public API WSGI app costs, to guard startup.
+
+Imports public_api in a fresh interpreter under python -X importtime, prints
+the slowest modules by cumulative time, and fails if the whole import took
+longer than --max-ms:
+
+    ./import_time.py --top 20 --max-ms 1500
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+BOB_PATH = os.environ.get('CHEZ_BOB_PATH', '/git')
+PYBOB_PATH = os.path.join(BOB_PATH, 'pybob')
+
+START_MARKER = '-- start --'
+
+
+def profile_import(module):
+    """Returns [(cumulative us, self us, module)] for one cold import,
+    leaving out what the interpreter imports at startup. Module names keep
+    python's indentation: one space, plus two per level of nesting."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [PYBOB_PATH] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         'import sys; sys.stderr.write("{}\\n"); import {}'.format(
+             START_MARKER, module)],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+
+    timings = []
+    errors = []
+    started = False
+    for line in proc.stderr.splitlines():
+        if line == START_MARKER:
+            started = True
+            continue
+        if not line.startswith('import time:'):
+            errors.append(line)
+            continue
+        if not started:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        try:
+            timings.append((int(cumulative), int(own), name.rstrip()))
+        except ValueError:
+            # The column header.
+            continue
+
+    if proc.returncode != 0:
+        sys.stderr.write("\n".join(errors) + "\n")
+        raise RuntimeError("importing {} failed".format(module))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--module', default='public_api')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help="exit nonzero if the import takes longer")
+    args = parser.parse_args()
+
+    timings = profile_import(args.module)
+    top_level = [t for t in timings if not t[2].startswith('  ')]
+    total_ms = sum(cumulative for cumulative, _, _ in top_level) / 1000.0
+
+    print("{:>10}  {:>10}  {}".format("cumul ms", "self ms", "module"))
+    for cumulative, own, name in sorted(timings, reverse=True)[:args.top]:
+        print("{:>10.1f}  {:>10.1f}  {}".format(
+            cumulative / 1000.0, own / 1000.0, name.strip()))
+    print("")
+    print("importing {} took {:.1f}ms ({} modules)".format(
+        args.module, total_ms, len(timings)))
+
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print("over the {:.1f}ms budget".format(args.max_ms))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Shows what preparing the login-by-barcode query saves.
+
+Runs BobApi.get_user_from_barcode through the prepared statement and the
+same query sent as plain SQL, and reports the planning time Postgres
+reports for a plain run of it:
+
+    ./login_prepared.py --barcode 123456789012
+"""
+
+import argparse
+import os
+import sys
+import time
+
+BOB_PATH = os.environ.get('CHEZ_BOB_PATH', '/git')
+sys.path.insert(0, os.path.join(BOB_PATH, 'pybob'))
+
+from private_api import db
+from private_api.bob_api import BobApi
+
+PLAIN_QUERY = (" SELECT"
+               "  u.userid, username, nickname, balance"
+               " from users u inner join userbarcodes b"
+               "  on b.userid = u.userid"
+               " where"
+               "  barcode = %s")
+
+
+def planning_time_ms(api, barcode):
+    cursor = api._get_cursor()
+    cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + PLAIN_QUERY, [barcode])
+    plan = cursor.fetchone()[0][0]
+    api.db.rollback()
+    return plan.get("Planning Time", plan.get("Planning time"))
+
+
+def measure(func, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    return (time.perf_counter() - start) * 1000 / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--barcode', required=True)
+    parser.add_argument('-n', type=int, default=5000)
+    parser.add_argument('--config', default=db.DEFAULT_CONFIG_PATH)
+    args = parser.parse_args()
+
+    api = BobApi(db.get_db_credentials(args.config))
+
+    plain = measure(lambda: api._fetchone(PLAIN_QUERY, [args.barcode]), args.n)
+    prepared = measure(lambda: api.get_user_from_barcode(args.barcode), args.n)
+
+    print("plain SQL:          {:.3f} ms/call".format(plain))
+    print("prepared:           {:.3f} ms/call".format(prepared))
+    print("saved:              {:.3f} ms/call".format(plain - prepared))
+    print("planning (EXPLAIN): {:.3f} ms".format(
+        planning_time_ms(api, args.barcode)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Compares p50/p99 latency of BobApi.buy_barcode against the old
+validate/insert/update sequence it replaced.
+
+Every iteration records a real purchase, so point this at a development
+database and a throwaway account:
+
+    ./purchase_latency.py --userid 1234 --barcode 000000000017
+"""
+
+import argparse
+import os
+import sys
+import time
+
+BOB_PATH = os.environ.get('CHEZ_BOB_PATH', '/git')
+sys.path.insert(0, os.path.join(BOB_PATH, 'pybob'))
+
+from private_api import db
+from private_api.bob_api import BobApi, InvalidOperationException
+
+
+def stepwise_buy_barcode(api, userid, barcode, source):
+    """The four round trip purchase path, kept here for comparison."""
+    if not api.is_valid_userid(userid):
+        raise InvalidOperationException("Invalid userid")
+
+    if not api.is_valid_product_barcode(barcode):
+        raise InvalidOperationException("Invalid barcode")
+
+    purchase_query = """
+        INSERT INTO transactions (
+            userid, xactvalue, xacttype, barcode, source)
+        SELECT
+            %s,
+            -1 * price,
+            (case when price < 0 then 'ADD ' else 'BUY ' end ) || name,
+            barcode, %s
+        FROM dynamic_barcode_lookup WHERE barcode = %s AND userid = %s LIMIT 1
+        RETURNING *
+    """
+
+    balance_query = """
+        UPDATE users SET balance = balance + %s WHERE userid = %s
+        RETURNING balance
+    """
+
+    cursor = api._get_cursor()
+    cursor.execute(purchase_query, [userid, source, barcode, userid])
+    row = cursor.fetchone()
+    results = dict(row)
+    cursor.execute(balance_query, [row['xactvalue'], userid])
+    results['balance'] = cursor.fetchone()['balance']
+    api.db.commit()
+    return results
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def measure(func, n):
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--userid', type=int, required=True)
+    parser.add_argument('--barcode', required=True)
+    parser.add_argument('-n', type=int, default=1000)
+    parser.add_argument('--config', default=db.DEFAULT_CONFIG_PATH)
+    args = parser.parse_args()
+
+    api = BobApi(db.get_db_credentials(args.config))
+
+    paths = [
+        ("stepwise", lambda: stepwise_buy_barcode(
+            api, args.userid, args.barcode, 'benchmark')),
+        ("single", lambda: api.buy_barcode(
+            args.userid, args.barcode, source='benchmark')),
+    ]
+
+    print("{:>10} | {:>9} | {:>9}".format("path", "p50 (ms)", "p99 (ms)"))
+    for name, func in paths:
+        samples = measure(func, args.n)
+        print("{:>10} | {:9.3f} | {:9.3f}".format(
+            name, percentile(samples, 50), percentile(samples, 99)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Measures purchase throughput through a pooled BobApi as workers grow.
+
+Every worker thread buys the same barcode for the same user in a loop, so
+point this at a development database and a throwaway account:
+
+    ./purchase_throughput.py --userid 1234 --barcode 000000000017
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+BOB_PATH = os.environ.get('CHEZ_BOB_PATH', '/git')
+sys.path.insert(0, os.path.join(BOB_PATH, 'pybob'))
+
+from private_api import db
+from private_api.bob_api import BobApi
+
+
+def run_workers(api, n_workers, n_purchases, userid, barcode):
+    def worker():
+        for _ in range(n_purchases):
+            api.buy_barcode(userid, barcode, source='benchmark')
+        api.release()
+
+    threads = [threading.Thread(target=worker) for _ in range(n_workers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--userid', type=int, required=True)
+    parser.add_argument('--barcode', required=True)
+    parser.add_argument('--purchases', type=int, default=200,
+                        help="purchases per worker")
+    parser.add_argument('--workers', default="1,2,4,8,16")
+    parser.add_argument('--config', default=db.DEFAULT_CONFIG_PATH)
+    args = parser.parse_args()
+
+    workers = [int(x) for x in args.workers.split(",")]
+    creds = db.get_db_credentials(args.config)
+    pool = db.ConnectionPool(creds, maxconn=max(workers))
+    api = BobApi(pool)
+
+    print("{:>8} | {:>10} | {:>10}".format("workers", "seconds", "buys/s"))
+    for n in workers:
+        elapsed = run_workers(api, n, args.purchases, args.userid, args.barcode)
+        print("{:8} | {:10.3f} | {:10.1f}".format(
+            n, elapsed, n * args.purchases / elapsed))
+
+    pool.closeall()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
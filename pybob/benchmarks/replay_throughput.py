@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""Measures how fast a transaction listener catches up after downtime.
+
+Replays the last --backlog transactions the way listen_transactions does
+on startup, for each batch size: once just fetching the records, and once
+dispatching them to --callbacks no-op callbacks through the worker queues.
+Only reads, so it's safe against production, but it's kinder to point it
+at a copy:
+
+    ./replay_throughput.py --backlog 100000 --batch-sizes 100,1000,5000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import psycopg2
+
+BOB_PATH = os.environ.get('CHEZ_BOB_PATH', '/git')
+sys.path.insert(0, os.path.join(BOB_PATH, 'pybob'))
+sys.path.insert(0, os.path.join(BOB_PATH, 'pybob', 'notifiers'))
+
+from private_api import db
+
+from dispatcher import TransactionDispatcher
+from listen_transactions import replay_transactions, LAST_TRANSACTION_ID
+
+
+def fetch_only(conn, after_id, batch_size):
+    n = 0
+    start = time.perf_counter()
+    for _ in replay_transactions(conn, after_id, batch_size):
+        n += 1
+    return n, time.perf_counter() - start
+
+
+def noop(conn, record):
+    pass
+
+
+def dispatched(conn, after_id, batch_size, n_callbacks):
+    cbs = [noop] * n_callbacks
+    dispatcher = TransactionDispatcher(cbs, report_interval_s=float('inf'))
+
+    n = 0
+    last_id = None
+    start = time.perf_counter()
+    for record in replay_transactions(conn, after_id, batch_size):
+        dispatcher.dispatch(record)
+        last_id = record['id']
+        n += 1
+    while last_id is not None and dispatcher.checkpoint() != last_id:
+        time.sleep(0.001)
+    return n, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backlog', type=int, default=100000,
+                        help="how many of the latest transactions to replay")
+    parser.add_argument('--batch-sizes', default="100,1000,5000")
+    parser.add_argument('--callbacks', type=int, default=5)
+    parser.add_argument('--config', default=db.DEFAULT_CONFIG_PATH)
+    args = parser.parse_args()
+
+    creds = db.get_db_credentials(args.config)
+    db.get_pool(args.config, maxconn=2 * args.callbacks + 1)
+    conn = psycopg2.connect(**creds)
+    conn.set_client_encoding("UTF-8")
+
+    cursor = conn.cursor()
+    cursor.execute(LAST_TRANSACTION_ID)
+    after_id = max(cursor.fetchone()[0] - args.backlog, 0)
+    conn.rollback()
+
+    print("{:>8} | {:>10} | {:>8} | {:>10} | {:>10}".format(
+        "batch", "mode", "records", "seconds", "records/s"))
+    for batch_size in [int(x) for x in args.batch_sizes.split(",")]:
+        for mode, run in [
+                ("fetch", lambda: fetch_only(conn, after_id, batch_size)),
+                ("dispatch", lambda: dispatched(
+                    conn, after_id, batch_size, args.callbacks))]:
+            n, elapsed = run()
+            conn.rollback()
+            print("{:8} | {:>10} | {:8} | {:10.3f} | {:10.1f}".format(
+                batch_size, mode, n, elapsed, n / elapsed if elapsed else 0))
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Measures what the verified-token cache saves on a kiosk session.
+
+Each session signs one token, as /userauth/authenticate_from_bc does, then
+decodes it once per purchase, as /buy/by_barcode does, with and without
+public_api.token_cache in front of jose:
+
+    ./token_cache.py --sessions 200 --purchases 10
+"""
+
+import argparse
+import os
+import sys
+import time
+
+BOB_PATH = os.environ.get('CHEZ_BOB_PATH', '/git')
+# Straight from the directory: importing the public_api package starts the
+# whole app.
+sys.path.insert(0, os.path.join(BOB_PATH, 'pybob', 'public_api'))
+
+from jose import jwt
+
+from token_cache import VerifiedTokenCache
+
+SECRET = "benchmark-secret"
+ALGO = "HS256"
+VALID_FOR_TIME_S = 300
+
+
+def decode(token):
+    return jwt.decode(token, SECRET, algorithms=[ALGO])
+
+
+def run(decode_func, n_sessions, n_purchases):
+    tokens = [
+        jwt.encode({"uid": i, "exp": int(time.time()) + VALID_FOR_TIME_S},
+                   SECRET, algorithm=ALGO)
+        for i in range(n_sessions)]
+
+    start = time.perf_counter()
+    for token in tokens:
+        for _ in range(n_purchases):
+            decode_func(token)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--purchases', type=int, default=10,
+                        help="purchases per session")
+    args = parser.parse_args()
+
+    n = args.sessions * args.purchases
+    uncached = run(decode, args.sessions, args.purchases)
+    cache = VerifiedTokenCache(decode)
+    cached = run(cache.decode, args.sessions, args.purchases)
+
+    print("decodes:  {}".format(n))
+    print("uncached: {:.1f} us/decode".format(uncached * 1e6 / n))
+    print("cached:   {:.1f} us/decode".format(cached * 1e6 / n))
+    print("cache:    {}".format(cache.stats()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""A persistent outbox for Slack, so nothing waits on Slack to answer.
+
+outbox.public and outbox.private have the same send_msg() (and, for public,
+delete_msg()) as public_slack and private_slack, but they only add the
+message to a local SQLite queue and return. Run this file with --send to
+deliver them:
+
+    ./outbox.py --send
+
+The sender works through each channel's queue oldest first: a message is
+only sent once everything queued before it for its channel has been. It
+sends at most one message per channel every MIN_SEND_INTERVAL_S, and when
+Slack says we're rate limited it waits as long as it's told. Messages
+queued for the same channel while it waits go out together as one post.
+Failed messages are retried with backoff, up to MAX_ATTEMPTS.
+
+A public message sent with track_userid is recorded in
+outstanding_slack_messages once it's posted, so transaction_watcher can take
+it down when the user pays up. Until then, public.cancel_tracked() takes it
+out of the queue; if it was being posted at the time, the sender deletes it
+straight after.
+
+CHEZBOB_SLACK_API_URL and CHEZBOB_SLACK_WEBHOOK_URL point the sender
+somewhere other than Slack, such as stub_slack.py.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import os.path
+import sqlite3
+import sys
+import time
+import traceback
+import urllib.parse
+
+if __name__ == "__main__":
+    BOB_PATH = os.environ.get('CHEZ_BOB_PATH', '/git')
+    sys.path.insert(0, os.path.join(BOB_PATH, 'pybob'))
+
+from secrets import get_secret
+from bobslack import private_slack
+
+
+OUTBOX_PATH = os.environ.get(
+    "CHEZBOB_SLACK_OUTBOX", "/var/tmp/chezbob-slack-outbox.sqlite")
+
+API_URL = os.environ.get("CHEZBOB_SLACK_API_URL", "https://slack.com/api/")
+WEBHOOK_URL = os.environ.get(
+    "CHEZBOB_SLACK_WEBHOOK_URL", "https://" + private_slack.POST_HOST)
+
+PUBLIC = 'public'
+PRIVATE = 'private'
+
+PUBLIC_DEFAULT_CHANNEL = "#chezbob"
+
+MIN_SEND_INTERVAL_S = 1.0
+DEFAULT_RETRY_AFTER_S = 30
+MAX_ATTEMPTS = 8
+MAX_BACKOFF_S = 600
+HTTP_TIMEOUT_S = 10
+POLL_INTERVAL_S = 1.0
+
+# Slack cuts messages off at 4000 characters.
+MAX_COALESCED_CHARS = 3500
+MAX_COALESCED = 20
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        workspace TEXT NOT NULL,
+        action TEXT NOT NULL,
+        channel TEXT NOT NULL,
+        body TEXT NOT NULL,
+        track_userid INTEGER,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL,
+        created REAL NOT NULL
+    )
+"""
+
+DUE_QUERY = ("SELECT * FROM outbox WHERE next_attempt <= ?"
+             " ORDER BY id LIMIT 500")
+
+# The oldest message queued for each channel, the only one it may send.
+HEADS_QUERY = ("SELECT workspace, channel, min(id) FROM outbox"
+               " GROUP BY workspace, channel")
+
+SAVE_OUTSTANDING = "INSERT INTO outstanding_slack_messages VALUES (%s, %s, %s)"
+
+FORGET_OUTSTANDING = ("DELETE FROM outstanding_slack_messages"
+                      " WHERE userid = %s AND channel = %s AND ts = %s")
+
+# As public_slack.CHANNEL_IDS; the rest come from channels.list.
+CHANNEL_IDS = {
+    "slackbot": "D0DCD2PJ5",
+}
+
+
+class SlackError(Exception):
+    pass
+
+
+class RateLimited(SlackError):
+    def __init__(self, retry_after):
+        super().__init__("rate limited for {}s".format(retry_after))
+        self.retry_after = retry_after
+
+
+def log(*args):
+    sys.stderr.write(" ".join([str(x) for x in args]))
+    sys.stderr.write("\n")
+
+
+def connect(path=OUTBOX_PATH):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute(SCHEMA)
+    return conn
+
+
+def enqueue(workspace, action, channel, body, track_userid=None,
+            path=OUTBOX_PATH):
+    now = time.time()
+    conn = connect(path)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT INTO outbox (workspace, action, channel, body,"
+                " track_userid, next_attempt, created)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [workspace, action, channel, json.dumps(body), track_userid,
+                 now, now])
+    finally:
+        conn.close()
+
+
+def cancel_tracked(userid, path=OUTBOX_PATH):
+    """Drops the queued public posts tracked for userid; returns how many."""
+    conn = connect(path)
+    try:
+        with conn:
+            return conn.execute(
+                "DELETE FROM outbox WHERE workspace = ? AND track_userid = ?",
+                [PUBLIC, userid]).rowcount
+    finally:
+        conn.close()
+
+
+class PublicOutbox(object):
+    def __init__(self, path=OUTBOX_PATH):
+        self.path = path
+
+    def send_msg(self, message, channel=PUBLIC_DEFAULT_CHANNEL,
+                 as_user=False, track_userid=None):
+        enqueue(PUBLIC, 'post', channel,
+                {"text": message, "as_user": as_user}, track_userid,
+                path=self.path)
+
+    def delete_msg(self, message):
+        """message is a dict-like with the posted message's channel and ts,
+        such as a row of outstanding_slack_messages."""
+        enqueue(PUBLIC, 'delete', message["channel"], {"ts": message["ts"]},
+                path=self.path)
+
+    def cancel_tracked(self, userid):
+        return cancel_tracked(userid, path=self.path)
+
+
+class PrivateOutbox(object):
+    def __init__(self, path=OUTBOX_PATH):
+        self.path = path
+
+    def send_msg(self, message, channel=private_slack.DEFAULT_CHANNEL,
+                 icon=private_slack.ICON):
+        enqueue(PRIVATE, 'post', channel, {"text": message, "icon": icon},
+                path=self.path)
+
+
+public = PublicOutbox()
+private = PrivateOutbox()
+
+
+def _post(url, body, content_type):
+    parts = urllib.parse.urlsplit(url)
+    conn_class = (http.client.HTTPSConnection if parts.scheme == 'https'
+                  else http.client.HTTPConnection)
+    conn = conn_class(parts.netloc, timeout=HTTP_TIMEOUT_S)
+    try:
+        conn.request("POST", parts.path, body, {"Content-type": content_type})
+        response = conn.getresponse()
+        data = response.read()
+    finally:
+        conn.close()
+
+    if response.status == 429:
+        raise RateLimited(int(response.getheader(
+            "Retry-After", DEFAULT_RETRY_AFTER_S)))
+    if response.status >= 400:
+        raise SlackError("HTTP {}: {}".format(response.status, data[:200]))
+    return data
+
+
+def _api_call(method, **fields):
+    fields["token"] = get_secret("slack.ucsdcse_token")
+    data = _post(API_URL + method, urllib.parse.urlencode(fields),
+                 "application/x-www-form-urlencoded")
+    result = json.loads(data.decode('utf-8'))
+    if not result.get("ok"):
+        if result.get("error") == "ratelimited":
+            raise RateLimited(DEFAULT_RETRY_AFTER_S)
+        raise SlackError(result.get("error"))
+    return result
+
+
+def populate_channel_mapping():
+    result = _api_call("channels.list")
+    for channel in result['channels']:
+        CHANNEL_IDS['#' + channel['name']] = channel['id']
+
+
+def get_channel_id(channel):
+    """Resolves a channel name the way public_slack.get_channel_id does."""
+    channel_id = CHANNEL_IDS.get(channel, None)
+    if not channel_id:
+        populate_channel_mapping()
+        channel_id = CHANNEL_IDS.get(channel, None)
+    if not channel_id:
+        raise SlackError("unknown channel {}".format(channel))
+    return channel_id
+
+
+def deliver(workspace, action, channel, body):
+    """Does one thing on Slack; returns the posted message's (channel id,
+    ts) for public posts, else None."""
+    if workspace == PRIVATE:
+        _post(WEBHOOK_URL + private_slack.POST_PATH +
+              get_secret("slack.chezbob_token"),
+              json.dumps({
+                  "text": body["text"],
+                  "username": private_slack.USER,
+                  "icon_emoji": body["icon"],
+                  "channel": channel,
+                  "mrkdwn": True,
+              }),
+              "application/json")
+        return None
+
+    if action == 'delete':
+        try:
+            _api_call("chat.delete", channel=channel, ts=body["ts"])
+        except RateLimited:
+            raise
+        except SlackError as e:
+            # Someone got there first.
+            if str(e) != "message_not_found":
+                raise
+        return None
+
+    result = _api_call(
+        "chat.postMessage", channel=get_channel_id(channel),
+        text=body["text"],
+        as_user="true" if body["as_user"] else "false")
+    return result["channel"], result["ts"]
+
+
+def _run_bob_query(query, args):
+    from private_api import db
+    conn = db.get_conn()
+    cursor = conn.cursor()
+    cursor.execute(query, args)
+    conn.commit()
+
+
+def save_outstanding(userid, channel_id, ts):
+    _run_bob_query(SAVE_OUTSTANDING, [userid, channel_id, ts])
+
+
+def forget_outstanding(userid, channel_id, ts):
+    _run_bob_query(FORGET_OUTSTANDING, [userid, channel_id, ts])
+
+
+class OutboxSender(object):
+    def __init__(self, path=OUTBOX_PATH, min_interval_s=MIN_SEND_INTERVAL_S):
+        self.path = path
+        self.conn = connect(path)
+        self.min_interval_s = min_interval_s
+
+        # (workspace, channel) -> when we may next send there.
+        self._next_send = {}
+        # workspace -> when Slack said we could come back.
+        self._paused_until = {}
+
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.dropped = 0
+
+    def _ready(self, row, now):
+        key = (row['workspace'], row['channel'])
+        return (self._paused_until.get(row['workspace'], 0) <= now and
+                self._next_send.get(key, 0) <= now)
+
+    def _batch(self, rows, first):
+        """first, and the rows after it that can go out in the same post."""
+        batch = [first]
+        if first['action'] != 'post' or first['track_userid'] is not None:
+            return batch
+
+        body = json.loads(first['body'])
+        length = len(body['text'])
+        for row in rows:
+            if row['id'] <= first['id'] or len(batch) >= MAX_COALESCED:
+                continue
+            if (row['workspace'], row['channel']) != (
+                    first['workspace'], first['channel']):
+                continue
+            other = json.loads(row['body'])
+            if (row['action'] != 'post' or row['track_userid'] is not None or
+                    dict(other, text=None) != dict(body, text=None) or
+                    length + len(other['text']) + 1 > MAX_COALESCED_CHARS):
+                # Keep the channel's messages in order.
+                break
+            length += len(other['text']) + 1
+            batch.append(row)
+        return batch
+
+    def _send(self, batch, now):
+        first = batch[0]
+        body = json.loads(first['body'])
+        if len(batch) > 1:
+            body['text'] = "\n".join(
+                json.loads(row['body'])['text'] for row in batch)
+
+        self._next_send[(first['workspace'], first['channel'])] = (
+            now + self.min_interval_s)
+        try:
+            posted = deliver(first['workspace'], first['action'],
+                             first['channel'], body)
+        except RateLimited as e:
+            log("Slack rate limited {} for {}s".format(
+                first['workspace'], e.retry_after))
+            self._paused_until[first['workspace']] = now + e.retry_after
+            return
+        except Exception:
+            traceback.print_exc()
+            self._failed(batch, first['attempts'] + 1, now)
+            return
+
+        tracked = posted and first['track_userid'] is not None
+        if tracked:
+            # Before it leaves the queue, so that once it has, it's always
+            # where transaction_watcher will look for it.
+            try:
+                save_outstanding(first['track_userid'], *posted)
+            except Exception:
+                traceback.print_exc()
+
+        with self.conn:
+            n_deleted = self.conn.executemany(
+                "DELETE FROM outbox WHERE id = ?",
+                [[row['id']] for row in batch]).rowcount
+        self.sent += 1
+        self.coalesced += len(batch) - 1
+
+        if tracked and not n_deleted:
+            # cancel_tracked() got to it while it was being posted.
+            log("Taking down cancelled Slack message {}".format(first['id']))
+            PublicOutbox(self.path).delete_msg(
+                {"channel": posted[0], "ts": posted[1]})
+            try:
+                forget_outstanding(first['track_userid'], *posted)
+            except Exception:
+                traceback.print_exc()
+
+    def _failed(self, batch, attempts, now):
+        ids = [row['id'] for row in batch]
+        with self.conn:
+            if attempts >= MAX_ATTEMPTS:
+                log("Giving up on Slack messages {}".format(ids))
+                self.dropped += len(ids)
+                self.conn.executemany(
+                    "DELETE FROM outbox WHERE id = ?", [[x] for x in ids])
+                return
+
+            # The rest of the channel waits behind these; see run_once().
+            self.retries += len(ids)
+            retry_at = now + min(2 ** attempts, MAX_BACKOFF_S)
+            self.conn.executemany(
+                "UPDATE outbox SET attempts = ?, next_attempt = ?"
+                " WHERE id = ?", [[attempts, retry_at, x] for x in ids])
+
+    def run_once(self, now=None):
+        """Sends whatever is due and allowed; returns how many posts."""
+        if now is None:
+            now = time.time()
+        rows = self.conn.execute(DUE_QUERY, [now]).fetchall()
+        heads = {(workspace, channel): head for workspace, channel, head
+                 in self.conn.execute(HEADS_QUERY)}
+
+        n_sent = 0
+        for row in rows:
+            # Only the oldest message of a channel goes, and only one post
+            # per channel each time round.
+            if (heads.get((row['workspace'], row['channel'])) != row['id'] or
+                    not self._ready(row, now)):
+                continue
+            self._send(self._batch(rows, row), now)
+            n_sent += 1
+        return n_sent
+
+    def stats(self):
+        queued = self.conn.execute("SELECT count(*) FROM outbox").fetchone()
+        return {"queued": queued[0], "sent": self.sent,
+                "coalesced": self.coalesced, "retries": self.retries,
+                "dropped": self.dropped}
+
+    def run_forever(self):
+        while True:
+            try:
+                self.run_once()
+            except sqlite3.Error:
+                traceback.print_exc()
+            time.sleep(POLL_INTERVAL_S)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--send', action='store_true',
+                        help="Deliver queued messages, forever.")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print how many messages are queued.")
+    parser.add_argument('--outbox', default=OUTBOX_PATH)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    sender = OutboxSender(args.outbox)
+    if args.stats:
+        print(json.dumps(sender.stats()))
+    if args.send:
+        sender.run_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
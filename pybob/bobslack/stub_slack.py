@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""A stand-in for Slack, for trying out the outbox without bothering anyone.
+
+Accepts webhook posts (/services/...) and the channels.list,
+chat.postMessage and chat.delete API calls (/api/...), remembers the posts
+and deletes, and lists what it got at GET /messages. It can also play at
+being rate limited or flaky:
+
+    ./stub_slack.py --port 8099 --rate-limit-every 10 --fail-every 7
+
+    CHEZBOB_SLACK_API_URL=http://localhost:8099/api/ \\
+    CHEZBOB_SLACK_WEBHOOK_URL=http://localhost:8099 \\
+    ./outbox.py --send
+
+tests/pybob/bobslack/test_outbox.py runs the outbox against it.
+"""
+
+import argparse
+import http.server
+import json
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+DEFAULT_PORT = 8099
+
+DEFAULT_CHANNELS = ("chezbob", "coldbrew", "general")
+
+
+class StubSlack(object):
+    def __init__(self, rate_limit_every=0, fail_every=0, retry_after=1,
+                 channels=DEFAULT_CHANNELS):
+        self.rate_limit_every = rate_limit_every
+        self.fail_every = fail_every
+        self.retry_after = retry_after
+        self.channels = {name: "C{:08d}".format(i)
+                         for i, name in enumerate(channels)}
+
+        self.messages = []
+        self.n_requests = 0
+        self._lock = threading.Lock()
+
+    def misbehavior(self):
+        """Returns the HTTP status to fail this request with, if any."""
+        with self._lock:
+            self.n_requests += 1
+            n = self.n_requests
+        if self.rate_limit_every and n % self.rate_limit_every == 0:
+            return 429
+        if self.fail_every and n % self.fail_every == 0:
+            return 500
+        return None
+
+    def record(self, kind, fields):
+        message = dict(fields, kind=kind, received=time.time())
+        message.pop("token", None)
+        with self._lock:
+            self.messages.append(message)
+        return message
+
+
+def make_handler(stub):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def _reply(self, status, body, content_type="application/json",
+                   headers=None):
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-type", content_type)
+            self.send_header("Content-length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/messages":
+                return self._reply(404, json.dumps({"ok": False}))
+            with stub._lock:
+                messages = list(stub.messages)
+            self._reply(200, json.dumps(messages))
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-length", 0))
+            body = self.rfile.read(length).decode('utf-8')
+
+            status = stub.misbehavior()
+            if status == 429:
+                return self._reply(
+                    429, json.dumps({"ok": False, "error": "ratelimited"}),
+                    headers={"Retry-After": str(stub.retry_after)})
+            if status:
+                return self._reply(status, "oops", "text/plain")
+
+            if self.path.startswith("/services/"):
+                stub.record("webhook", json.loads(body))
+                return self._reply(200, "ok", "text/plain")
+
+            fields = dict(urllib.parse.parse_qsl(body))
+            if self.path == "/api/channels.list":
+                return self._reply(200, json.dumps({
+                    "ok": True,
+                    "channels": [{"name": name, "id": channel_id}
+                                 for name, channel_id
+                                 in stub.channels.items()],
+                }))
+            if self.path == "/api/chat.postMessage":
+                if fields.get("channel") not in stub.channels.values():
+                    return self._reply(200, json.dumps(
+                        {"ok": False, "error": "channel_not_found"}))
+                message = stub.record("post", fields)
+                return self._reply(200, json.dumps({
+                    "ok": True,
+                    "channel": fields["channel"],
+                    "ts": "{:.6f}".format(message["received"]),
+                }))
+            if self.path == "/api/chat.delete":
+                stub.record("delete", fields)
+                return self._reply(200, json.dumps({"ok": True}))
+
+            self._reply(200, json.dumps(
+                {"ok": False, "error": "unknown_method"}))
+
+        def log_message(self, format, *args):
+            sys.stderr.write("stub_slack: " + (format % args) + "\n")
+
+    return Handler
+
+
+class ThreadedHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(stub, port=DEFAULT_PORT):
+    """Returns a running server (in a daemon thread) for stub."""
+    server = ThreadedHTTPServer(("127.0.0.1", port), make_handler(stub))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help="Answer every Nth request with a 429.")
+    parser.add_argument('--fail-every', type=int, default=0,
+                        help="Answer every Nth request with a 500.")
+    parser.add_argument('--retry-after', type=int, default=1)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    stub = StubSlack(args.rate_limit_every, args.fail_every,
+                     args.retry_after)
+    server = ThreadedHTTPServer(("127.0.0.1", args.port), make_handler(stub))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,6 +7,7 @@ import fprint
 import json
 import os
 import sys
+import traceback
 
 DEFAULT_ENDPOINT = "http://192.168.1.10:8080/api"
 
@@ -14,7 +15,8 @@ BOB_PATH = os.environ.get('CHEZ_BOB_PATH', '/git')
 sys.path.insert(0, os.path.join(BOB_PATH, 'pybob'))
 
 import bob_send
-import private_api
+from private_api import db
+from private_api.async_bob_api import AsyncBobApi
 
 
 class FingerprintState(Enum):
@@ -39,13 +41,17 @@ class FingerprintInterface:
         self.bound_identify_callback = self.identify_callback
         self.bound_stop_callback = self.stop_callback
 
-        db = private_api.db.get_conn()
-        self.db_api = private_api.bob_api.BobApi(db)
-        self.load_db()
+        # Enrollments being saved; the loop only keeps weak references.
+        self.saving = set()
+
+        self.loop = asyncio.get_event_loop()
+
+        creds = db.get_db_credentials(db.DEFAULT_CONFIG_PATH)
+        self.db_api = AsyncBobApi(creds)
+        self.loop.run_until_complete(self.load_db())
         endpoint = DEFAULT_ENDPOINT
         self.send_api = bob_send.BobApi(endpoint, 1, 0)
 
-        self.loop = asyncio.get_event_loop()
         fprint.init()
         ddevs = fprint.DiscoveredDevices()
         if len(ddevs) != 1:
@@ -61,17 +67,19 @@ class FingerprintInterface:
                 self.loop.add_writer(fd[0], self.dev.handle_events)
         print("FingerprintInterface initialized")
 
-    def load_db(self):
-        self.userids = []
-        self.templates = []
-        rows = self.db_api.get_fingerprint_data()
+    async def load_db(self):
+        rows = await self.db_api.get_fingerprint_data()
+        userids = []
+        templates = []
         for row in rows:
-            self.userids.append(row[1])
+            userids.append(row[1])
             pd = fprint.PrintData.from_data(bytes(row[2]))
-            self.templates.append(pd)
+            templates.append(pd)
+        self.userids = userids
+        self.templates = templates
 
-    def reload_db(self):
-        self.load_db()
+    async def reload_db(self):
+        await self.load_db()
         if self.state == FingerprintState.IDENTIFYING:
             self.state = FingerprintState.IDENTIFY_STARTING
             self.cancel_identify()
@@ -81,11 +89,33 @@ class FingerprintInterface:
             self.cancel_enroll()
             self.userids.append(self.enrolling_userid)
             self.templates.append(pd)
-            self.db_api.add_fingerprint_data(self.enrolling_userid, pd.data)
+            task = self.loop.create_task(
+                self.save_enrollment(self.enrolling_userid, pd))
+            self.saving.add(task)
+            task.add_done_callback(self.saving.discard)
         if result == fprint.fp_enroll_result.FP_ENROLL_FAIL:
             self.cancel_enroll()
         self.send_api.send_enroll_progress(result)
 
+    async def save_enrollment(self, userid, pd):
+        """Saves a new print; if that fails, forgets it again, so we don't
+        identify anyone with a print that's gone at the next reload."""
+        try:
+            await self.db_api.add_fingerprint_data(userid, pd.data)
+        except Exception:
+            print("Couldn't save fingerprint for {}".format(userid),
+                  file=sys.stderr)
+            traceback.print_exc()
+
+            for i, template in enumerate(self.templates):
+                if template is pd:
+                    del self.userids[i]
+                    del self.templates[i]
+                    break
+            if self.state == FingerprintState.IDENTIFYING:
+                self.state = FingerprintState.IDENTIFY_STARTING
+                self.cancel_identify()
+
     def _start_enroll(self):
         self.dev.enroll_start(self.bound_enroll_progress_callback)
         self.state = FingerprintState.ENROLLING
@@ -166,7 +196,7 @@ class FingerprintDaemon:
         elif request['method'] == 'fp.idle':
             self.fp_interface.idle()
         elif request['method'] == 'fp.reload':
-            self.fp_interface.reload_db()
+            await self.fp_interface.reload_db()
         return web.Response()
 
     async def enroll(self, request):
@@ -14,7 +14,7 @@ BOB_PATH = os.environ.get('CHEZ_BOB_PATH', '/git')
 sys.path.insert(0, os.path.join(BOB_PATH, 'pybob'))
 
 from private_api import db
-from bobslack import private_slack
+from bobslack import outbox
 
 import gs1_validator
 import tail
@@ -60,21 +60,21 @@ def handle_barcode(body, match, _):
 
     if bc_counts[bc] == SCAN_COUNT_NOTIFICATION_THRESHOLD:
         msg = UNKNOWN_BARCODE_MESSAGE.format(bc=bc)
-        private_slack.send_msg(msg, channel="#unknown_barcodes")
+        outbox.private.send_msg(msg, channel="#unknown_barcodes")
         logger.info(msg)
 
 
 def handle_user(body, match, _):
     user = match.group(1)
     msg = UNKNOWN_USER_MESSAGE.format(user=user)
-    private_slack.send_msg(msg, channel="#unknown_users")
+    outbox.private.send_msg(msg, channel="#unknown_users")
     logger.info(msg)
 
 
 def handle_disabled(body, match, _):
     user = match.group(1)
     msg = DISABLED_USER_MESSAGE.format(user=user)
-    private_slack.send_msg(msg, channel="#disabled_users")
+    outbox.private.send_msg(msg, channel="#disabled_users")
     logger.info(msg)
 
 
@@ -89,7 +89,7 @@ def handle_sodaoos(body, match, conn):
     row = curs.fetchone()
 
     msg = "Failed purchase due to OOS soda: {} ({})".format(row['name'], bc)
-    private_slack.send_msg(msg, channel="#out_of_stock")
+    outbox.private.send_msg(msg, channel="#out_of_stock")
     logger.info(msg)
 
 
@@ -0,0 +1,254 @@
+"""Runs transaction callbacks off the listening thread.
+
+Each callback gets its own worker threads, each fed by a bounded queue.
+A transaction goes to the same worker for every callback, picked by its
+userid, so each callback sees any one user's transactions in order, while a
+slow callback (say, one waiting on Slack) only holds up its own queues.
+When a queue fills up, dispatch() waits for room rather than dropping
+anything.
+
+Callbacks are called as cb(conn, record), with conn checked out of the
+shared pool for the call. A callback that raises (or can't get a
+connection) is retried, with backoff, up to max_attempts times, holding up
+its queue meanwhile. After that the transaction becomes a dead letter: it
+stays pending until the listener has recorded it somewhere it can be
+retried from, and calls release().
+
+checkpoint() gives the id below which every dispatched transaction has
+been through every callback (or been dead lettered), for the listener to
+persist. Since ids are handed out before their transactions commit, that
+isn't quite everything that happened before it, so recently_finished()
+also gives the ids the listener should skip if it replays past it.
+"""
+
+import queue
+import sys
+import threading
+import time
+import traceback
+
+from private_api import db
+from private_api.metrics import MethodStats
+
+DEFAULT_WORKERS_PER_CALLBACK = 2
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_REPORT_INTERVAL_S = 300
+DEFAULT_MAX_ATTEMPTS = 3
+RETRY_DELAY_S = 1
+
+
+def log(*args):
+    sys.stderr.write(" ".join([str(x) for x in args]))
+    sys.stderr.write("\n")
+
+
+class CallbackWorkers(object):
+    """The queues and threads serving one callback."""
+
+    def __init__(self, cb, n_workers, queue_size, on_done,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.cb = cb
+        self.on_done = on_done
+        self.max_attempts = max_attempts
+        self.name = getattr(cb, '__name__', repr(cb))
+        self.queues = [queue.Queue(queue_size) for _ in range(n_workers)]
+
+        self._lock = threading.Lock()
+        # Per attempt, so retries count each time.
+        self.latency = MethodStats()
+        # Per transaction.
+        self.handled = 0
+        self.dead_lettered = 0
+        self.wait_ms = 0.0
+        self.max_depth = 0
+        self.n_blocked = 0
+
+        for i, q in enumerate(self.queues):
+            threading.Thread(
+                target=self._work, args=(q,), daemon=True,
+                name="{}-{}".format(self.name, i)).start()
+
+    def put(self, record):
+        q = self.queues[hash(record['userid']) % len(self.queues)]
+        if q.full():
+            with self._lock:
+                self.n_blocked += 1
+        q.put((time.perf_counter(), record))
+
+        depth = self.depth()
+        with self._lock:
+            self.max_depth = max(self.max_depth, depth)
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def _call(self, record):
+        """Calls cb once; returns the formatted exception, if any."""
+        start = time.perf_counter()
+        error = None
+        try:
+            with db.get_pool().connection() as conn:
+                self.cb(conn, record)
+        except Exception:
+            error = traceback.format_exc()
+            sys.stderr.write(error)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            self.latency.add(elapsed_ms, None, error is not None)
+        return error
+
+    def _work(self, q):
+        while True:
+            queued_at, record = q.get()
+            wait_ms = (time.perf_counter() - queued_at) * 1000
+
+            for attempt in range(1, self.max_attempts + 1):
+                error = self._call(record)
+                if error is None:
+                    break
+                if attempt < self.max_attempts:
+                    time.sleep(RETRY_DELAY_S * 2 ** (attempt - 1))
+
+            with self._lock:
+                self.handled += 1
+                self.wait_ms += wait_ms
+                if error is not None:
+                    self.dead_lettered += 1
+            self.on_done(record['id'], self.name, error)
+
+    def stats(self):
+        with self._lock:
+            calls = self.latency.calls
+            result = {
+                "handled": self.handled,
+                "dead_lettered": self.dead_lettered,
+                "attempts": calls,
+                "errors": self.latency.errors,
+                "mean_ms": round(self.latency.total_ms / calls, 3)
+                if calls else 0.0,
+                "max_ms": round(self.latency.max_ms, 3),
+                "histogram": self.latency.histogram[:],
+                "mean_wait_ms": round(self.wait_ms / self.handled, 3)
+                if self.handled else 0.0,
+                "max_queue_depth": self.max_depth,
+                "blocked": self.n_blocked,
+            }
+        result["queue_depth"] = self.depth()
+        return result
+
+
+class TransactionDispatcher(object):
+    def __init__(self, cbs, n_workers=DEFAULT_WORKERS_PER_CALLBACK,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 report_interval_s=DEFAULT_REPORT_INTERVAL_S,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.workers = [CallbackWorkers(cb, n_workers, queue_size,
+                                        self._done, max_attempts)
+                        for cb in cbs]
+        self.report_interval_s = report_interval_s
+        self._last_report = time.time()
+
+        # Transaction id -> how many callbacks have yet to finish with it.
+        self._pending = {}
+        self._max_dispatched = None
+        # (transaction id, callback name) -> the error, until release()d.
+        self._dead_letters = {}
+        # Transaction id -> when every callback was done with it.
+        self._finished = {}
+        self._lock = threading.Lock()
+
+    def _finish(self, tid):
+        self._pending[tid] -= 1
+        if not self._pending[tid]:
+            del self._pending[tid]
+            self._finished[tid] = time.time()
+
+    def _done(self, tid, name, error=None):
+        with self._lock:
+            if error is None:
+                self._finish(tid)
+            else:
+                self._dead_letters[(tid, name)] = error
+
+    def names(self):
+        return [x.name for x in self.workers]
+
+    def dispatch(self, record, names=None):
+        """Queues record for every callback, or just those named."""
+        workers = [x for x in self.workers if names is None or x.name in names]
+        if not workers:
+            return
+        with self._lock:
+            self._pending[record['id']] = (
+                self._pending.get(record['id'], 0) + len(workers))
+            self._max_dispatched = max(self._max_dispatched or 0,
+                                       record['id'])
+        for x in workers:
+            x.put(record)
+
+    def dead_letters(self):
+        """Returns [(transaction id, callback name, error)] for callbacks
+        that gave up and haven't been release()d."""
+        with self._lock:
+            return [(tid, name, error)
+                    for (tid, name), error in self._dead_letters.items()]
+
+    def release(self, tid, name):
+        """Counts a dead letter as done, once it's been recorded."""
+        with self._lock:
+            if self._dead_letters.pop((tid, name), None) is not None:
+                self._finish(tid)
+
+    def is_pending(self, tid):
+        with self._lock:
+            return tid in self._pending
+
+    def _checkpoint(self):
+        if self._pending:
+            return min(self._pending) - 1
+        return self._max_dispatched
+
+    def checkpoint(self):
+        """Returns the highest id such that every dispatched transaction up
+        to it has been handled or released, or None if nothing has been
+        dispatched."""
+        with self._lock:
+            return self._checkpoint()
+
+    def recently_finished(self, window_s):
+        """Returns the sorted ids finished in the last window_s, and any
+        above the checkpoint, forgetting the rest."""
+        cutoff = time.time() - window_s
+        with self._lock:
+            checkpoint = self._checkpoint()
+            self._finished = {
+                tid: t for tid, t in self._finished.items()
+                if t > cutoff or tid > checkpoint}
+            return sorted(self._finished)
+
+    def stats(self):
+        """Returns {callback name: queue depth and handler latency}."""
+        return {workers.name: workers.stats() for workers in self.workers}
+
+    def summary(self):
+        lines = ["Transaction callbacks:"]
+        for name, stats in sorted(self.stats().items()):
+            lines.append(
+                "  {}: {} handled, {} dead lettered, {} attempts,"
+                " {} errors, mean {:.1f} ms,"
+                " max {:.1f} ms, mean wait {:.1f} ms, queued {}"
+                " (max {}, blocked {})".format(
+                    name, stats["handled"], stats["dead_lettered"],
+                    stats["attempts"], stats["errors"],
+                    stats["mean_ms"], stats["max_ms"],
+                    stats["mean_wait_ms"], stats["queue_depth"],
+                    stats["max_queue_depth"], stats["blocked"]))
+        return "\n".join(lines)
+
+    def report_if_due(self):
+        """Logs summary() if report_interval_s has passed since the last."""
+        if time.time() - self._last_report < self.report_interval_s:
+            return
+        self._last_report = time.time()
+        log(self.summary())
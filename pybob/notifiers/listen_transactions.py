@@ -1,7 +1,35 @@
-"""Essentially `tail -f` for transactions."""
+"""Essentially `tail -f` for transactions.
 
+Callbacks get (conn, record) for each new transaction. The record usually
+comes straight from the notification (see admin/transaction_notify.sql);
+when the payload is just an id, it's looked up once for all callbacks.
+They run on worker threads (see dispatcher.py), so a slow one doesn't hold
+up the rest.
+
+A listener watching as a named consumer keeps a checkpoint of the last
+transaction it has finished with in listener_checkpoints
+(admin/listener_checkpoints.sql). On startup it starts listening, replays
+everything after its checkpoint in id order, then carries on with the
+notifications, skipping any for transactions it just replayed.
+
+Transaction ids are handed out when a transaction starts, but only seen
+when it commits, so a checkpoint can pass an id that's still to come. The
+replay therefore also covers transactions started in the REPLAY_OVERLAP_S
+before the checkpoint was saved, skipping those the checkpoint says were
+already handled. Only a transaction open for longer than that can be
+missed.
+
+Transactions a callback gave up on are kept in listener_dead_letters, and
+retried, for that callback only, on the next startup.
+"""
+
+import datetime
+import decimal
+import json
 import select
 import sys
+import time
+import traceback
 
 import psycopg2
 import psycopg2.extensions
@@ -10,29 +38,230 @@ import psycopg2.extras
 
 from private_api import db
 
+from dispatcher import TransactionDispatcher
 
-def get_details(cur, id):
-    cur.execute("SELECT * FROM transactions WHERE id = %s", [id])
-    return cur.fetchone()
+REPLAY_BATCH_SIZE = 1000
+CHECKPOINT_INTERVAL_S = 5
+REPLAY_OVERLAP_S = 10 * 60
+# How long to skip notifications for transactions we replayed.
+REPLAYED_DEDUPE_S = 60
+
+# The same fields admin/transaction_notify.sql sends.
+RECORD_QUERY = """
+    SELECT
+        t.id, t.userid, t.xactvalue, t.xacttype, t.barcode, t.source,
+        t.xacttime, t.barcode AS t_barcode,
+        u.username, u.nickname, u.email, u.balance, u.disabled,
+        p.name, p.price, p.bulkid
+    FROM transactions t
+        INNER JOIN users u ON u.userid = t.userid
+        LEFT OUTER JOIN products p ON p.barcode = t.barcode
+"""
+
+REPLAY_QUERY = RECORD_QUERY + """
+    WHERE t.id > %(start)s
+        AND (t.id > %(after_id)s OR t.xacttime > %(since)s)
+        AND NOT t.id = ANY(%(skip)s)
+    ORDER BY t.id
+    LIMIT %(limit)s
+"""
+
+# Where the replay's scan by id starts.
+REPLAY_START = ("SELECT coalesce(min(id) - 1, %(after_id)s) FROM transactions"
+                " WHERE xacttime > %(since)s AND id <= %(after_id)s")
+
+RECORDS_BY_ID_QUERY = RECORD_QUERY + """
+    WHERE t.id = ANY(%s)
+    ORDER BY t.id
+"""
+
+LOAD_CHECKPOINT = ("SELECT last_id, recent_ids,"
+                   " updated - %s * interval '1 second'"
+                   " FROM listener_checkpoints WHERE consumer = %s")
+
+UPDATE_CHECKPOINT = ("UPDATE listener_checkpoints"
+                     " SET last_id = %s, recent_ids = %s, updated = now()"
+                     " WHERE consumer = %s")
+
+INSERT_CHECKPOINT = ("INSERT INTO listener_checkpoints"
+                     " (last_id, recent_ids, consumer)"
+                     " VALUES (%s, %s, %s)")
+
+LAST_TRANSACTION_ID = "SELECT coalesce(max(id), 0) FROM transactions"
+
+LOAD_DEAD_LETTERS = ("SELECT transaction_id, callback"
+                     " FROM listener_dead_letters WHERE consumer = %s")
+
+UPDATE_DEAD_LETTER = ("UPDATE listener_dead_letters"
+                      " SET error = %s, attempts = attempts + 1,"
+                      " updated = now()"
+                      " WHERE consumer = %s AND callback = %s"
+                      " AND transaction_id = %s")
+
+INSERT_DEAD_LETTER = ("INSERT INTO listener_dead_letters"
+                      " (error, consumer, callback, transaction_id)"
+                      " VALUES (%s, %s, %s, %s)")
+
+DELETE_DEAD_LETTER = ("DELETE FROM listener_dead_letters"
+                      " WHERE consumer = %s AND callback = %s"
+                      " AND transaction_id = %s")
+
+
+def log(*args):
+    sys.stderr.write(" ".join([str(x) for x in args]))
+    sys.stderr.write("\n")
 
 
 def get_detailed_details(conn, id):
-    cur = db.get_cursor()
-    cur.execute(("SELECT t.*, u.*"
-                 " FROM transactions t INNER JOIN users u"
-                 " ON t.userid = u.userid"
-                 " WHERE id = %s"), [id])
+    """Looks up the record for a payload that was only an id."""
+    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur.execute(RECORDS_BY_ID_QUERY, [[id]])
     return cur.fetchone()
 
 
+def parse_timestamp(st):
+    """Parses to_char(..., 'YYYY-MM-DD"T"HH24:MI:SS.USOF') output."""
+    stamp, sign, offset = st[:26], st[26], st[27:]
+    hours, _, minutes = offset.partition(':')
+    delta = datetime.timedelta(hours=int(hours), minutes=int(minutes or 0))
+    return datetime.datetime.strptime(stamp, "%Y-%m-%dT%H:%M:%S.%f").replace(
+        tzinfo=datetime.timezone(delta if sign == '+' else -delta))
+
+
+def parse_payload(payload):
+    """Returns the record in a new_transactions payload, or None if the
+    payload is only an id."""
+    if not payload.startswith('{'):
+        return None
+    record = json.loads(payload, parse_float=decimal.Decimal)
+    record['xacttime'] = parse_timestamp(record['xacttime'])
+    return record
+
+
+def get_record(conn, payload):
+    record = parse_payload(payload)
+    if record is None:
+        record = dict(get_detailed_details(conn, int(payload)))
+    return record
+
+
+def replay_transactions(conn, after_id, batch_size=REPLAY_BATCH_SIZE,
+                        since=None, skip=()):
+    """Yields the record of every transaction after after_id, and of those
+    before it started after since, in id order, except the ids in skip;
+    fetching batch_size at a time."""
+    args = {"after_id": after_id, "since": since, "skip": list(skip),
+            "limit": batch_size, "start": after_id}
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    if since is not None:
+        cursor.execute(REPLAY_START, args)
+        args["start"] = cursor.fetchone()[0]
+
+    while True:
+        cursor.execute(REPLAY_QUERY, args)
+        rows = cursor.fetchall()
+        for row in rows:
+            yield dict(row)
+        if len(rows) < batch_size:
+            return
+        args["start"] = rows[-1]['id']
+
+
+def load_checkpoint(conn, consumer):
+    """Returns (last id, recent ids, replay since) or None."""
+    cursor = conn.cursor()
+    cursor.execute(LOAD_CHECKPOINT, [REPLAY_OVERLAP_S, consumer])
+    row = cursor.fetchone()
+    return tuple(row) if row else None
+
+
+def save_checkpoint(conn, consumer, last_id, recent_ids=()):
+    # There's only ever one of each consumer running, so no insert race.
+    cursor = conn.cursor()
+    cursor.execute(UPDATE_CHECKPOINT, [last_id, list(recent_ids), consumer])
+    if not cursor.rowcount:
+        cursor.execute(INSERT_CHECKPOINT,
+                       [last_id, list(recent_ids), consumer])
+
+
+def save_dead_letter(conn, consumer, callback, tid, error):
+    cursor = conn.cursor()
+    cursor.execute(UPDATE_DEAD_LETTER, [error, consumer, callback, tid])
+    if not cursor.rowcount:
+        cursor.execute(INSERT_DEAD_LETTER, [error, consumer, callback, tid])
+
+
+def delete_dead_letter(conn, consumer, callback, tid):
+    cursor = conn.cursor()
+    cursor.execute(DELETE_DEAD_LETTER, [consumer, callback, tid])
+
+
+class Checkpointer(object):
+    """Saves the dispatcher's dead letters and checkpoint every
+    CHECKPOINT_INTERVAL_S."""
+
+    def __init__(self, conn, consumer, dispatcher, last_id, recent_ids=()):
+        self.conn = conn
+        self.consumer = consumer
+        self.dispatcher = dispatcher
+        self.saved = (last_id, list(recent_ids))
+        self._last_save = time.time()
+
+        # The last run's recent ids still need skipping if we restart soon.
+        self.inherited = set(recent_ids)
+        self.inherited_until = time.time() + 2 * REPLAY_OVERLAP_S
+
+        # (transaction id, callback name) of saved dead letters being
+        # retried; each is deleted once its retry has gone through.
+        self.retrying = set()
+
+    def save_dead_letters(self):
+        for tid, name, error in self.dispatcher.dead_letters():
+            log("{}: {} gave up on transaction {}".format(
+                self.consumer, name, tid))
+            save_dead_letter(self.conn, self.consumer, name, tid, error)
+            self.dispatcher.release(tid, name)
+            self.retrying.discard((tid, name))
+
+        for tid, name in list(self.retrying):
+            if not self.dispatcher.is_pending(tid):
+                delete_dead_letter(self.conn, self.consumer, name, tid)
+                self.retrying.discard((tid, name))
+
+    def save_if_due(self, force=False):
+        if not force and (
+                time.time() - self._last_save < CHECKPOINT_INTERVAL_S):
+            return
+        self._last_save = time.time()
+
+        try:
+            # First, so the checkpoint never passes an unrecorded failure.
+            self.save_dead_letters()
+
+            last_id = self.dispatcher.checkpoint()
+            if last_id is None:
+                return
+            # Twice the overlap, so clock skew can't open a gap.
+            recent = set(self.dispatcher.recently_finished(
+                2 * REPLAY_OVERLAP_S))
+            if time.time() < self.inherited_until:
+                recent |= self.inherited
+            checkpoint = (max(last_id, self.saved[0]), sorted(recent))
+            if checkpoint == self.saved:
+                return
+            save_checkpoint(self.conn, self.consumer, *checkpoint)
+            self.saved = checkpoint
+        except psycopg2.Error:
+            traceback.print_exc()
+
+
 def trunc(st, ln):
     if not st:
         return ''
     return st[:ln]
 
 
-def print_transactions(conn, tid):
-    result = get_detailed_details(conn, tid)
+def print_transactions(conn, result):
     format_line = "{:13} | {:40} | {:6} | {:8} | {:20} | {:20} | {:6} | {}"
 
     print(format_line.format(
@@ -47,27 +276,127 @@ def print_transactions(conn, tid):
     ))
 
 
-def watch_transactions(cbs):
+def retry_dead_letters(conn, checkpointer):
+    """Dispatches each saved dead letter again, to its callback only."""
+    dispatcher = checkpointer.dispatcher
+    cursor = conn.cursor()
+    cursor.execute(LOAD_DEAD_LETTERS, [checkpointer.consumer])
+    by_id = {}
+    for tid, name in cursor.fetchall():
+        if name not in dispatcher.names():
+            log("{}: no callback {} to retry transaction {} with".format(
+                checkpointer.consumer, name, tid))
+            continue
+        by_id.setdefault(tid, []).append(name)
+    if not by_id:
+        return
+
+    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cursor.execute(RECORDS_BY_ID_QUERY, [list(by_id)])
+    for row in cursor.fetchall():
+        names = by_id[row['id']]
+        checkpointer.retrying.update((row['id'], name) for name in names)
+        dispatcher.dispatch(dict(row), names)
+    log("{}: retrying {} dead letters".format(
+        checkpointer.consumer, len(checkpointer.retrying)))
+
+
+class Replayed(object):
+    """The ids we replayed, to skip their notifications, which can arrive
+    after the replay. Each is forgotten once it's below the checkpoint and
+    REPLAYED_DEDUPE_S old."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def add(self, tid):
+        self.ids[tid] = time.time()
+
+    def __contains__(self, tid):
+        return tid in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def prune(self, checkpoint):
+        if not self.ids or checkpoint is None:
+            return
+        cutoff = time.time() - REPLAYED_DEDUPE_S
+        self.ids = {tid: t for tid, t in self.ids.items()
+                    if t > cutoff or tid > checkpoint}
+
+
+def replay_missed(conn, consumer, dispatcher):
+    """Dispatches everything missed since consumer's checkpoint; returns
+    the Checkpointer and the Replayed ids."""
+    checkpoint = load_checkpoint(conn, consumer)
+    if checkpoint is None:
+        # First run; there's nothing we missed.
+        cursor = conn.cursor()
+        cursor.execute(LAST_TRANSACTION_ID)
+        checkpoint = (cursor.fetchone()[0], [], None)
+        save_checkpoint(conn, consumer, checkpoint[0])
+    last_id, recent_ids, since = checkpoint
+
+    checkpointer = Checkpointer(
+        conn, consumer, dispatcher, last_id, recent_ids)
+    retry_dead_letters(conn, checkpointer)
+
+    replayed = Replayed()
+    for record in replay_transactions(
+            conn, last_id, since=since, skip=recent_ids):
+        dispatcher.dispatch(record)
+        replayed.add(record['id'])
+        checkpointer.save_if_due()
+
+    if replayed:
+        log("{}: replayed {} transactions after {} or since {}".format(
+            consumer, len(replayed), last_id, since))
+    return checkpointer, replayed
+
+
+def watch_transactions(cbs, consumer=None, **kwargs):
+    """Calls each of cbs with every new transaction, forever, replaying
+    those missed since the last run if consumer is given. kwargs go to
+    TransactionDispatcher."""
     if type(cbs) != list:
         cbs = [cbs]
+    dispatcher = TransactionDispatcher(cbs, **kwargs)
 
     conn = db.get_conn()
     conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
     conn.set_client_encoding("utf-8")
 
     curs = db.get_cursor()
+    # Listen before replaying, so nothing falls between the two.
     curs.execute("LISTEN new_transactions;")
 
+    checkpointer, replayed = None, Replayed()
+    if consumer:
+        checkpointer, replayed = replay_missed(conn, consumer, dispatcher)
+
     while 1:
-        if select.select([conn], [], [], 5) == ([], [], []):
-            pass
-        else:
+        if select.select([conn], [], [], 5) != ([], [], []):
             conn.poll()
             while conn.notifies:
                 notify = conn.notifies.pop(0)
-                for cb in cbs:
-                    cb(conn, int(notify.payload))
+                try:
+                    record = get_record(conn, notify.payload)
+                except Exception:
+                    traceback.print_exc()
+                    continue
+                if record['id'] in replayed:
+                    continue
+                dispatcher.dispatch(record)
                 #print(notify.pid, notify.channel, notify.payload)
+        replayed.prune(dispatcher.checkpoint())
+        if checkpointer:
+            checkpointer.save_if_due()
+        else:
+            # Nowhere to keep them; they've been logged.
+            for tid, name, _ in dispatcher.dead_letters():
+                dispatcher.release(tid, name)
+        dispatcher.report_if_due()
 
 
 def main():
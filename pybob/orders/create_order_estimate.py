@@ -29,83 +29,9 @@ import psycopg2
 import psycopg2.extras
 
 
-# What was the MOST RECENT inventory for each item?
-LAST_INVENTORY_VIEW = """
-create or replace temporary view last_inventory as
-select date, bulkid, units from (
-        SELECT
-            date,
-            bulkid,
-            units,
-            rank() over (partition by bulkid order by date desc) as r
-        from inventory
-        where bulkid in (select bulkid from bulk_items where active)
-        ) s1
-where r = 1
-"""
-
-# Represents how many of an item we've purchased since the last inventory of it
-RECENT_ORDERS_VIEW = """
-create or replace temporary view recent_orders as
-select min(order_date) as since, bulkid, sum(units) as units
-from (
-    select
-        o.date as order_date,
-        li.date AS last_inventoried,
-        quantity*number as units,
-        bulk_type_id as bulkid
-    from orders o
-        inner join order_items oi
-            on oi.order_id = o.id
-        left outer join last_inventory li
-        on bulk_type_id = bulkid
-    ) s1
-where (case
-        when last_inventoried is null then true
-        else order_date > last_inventoried end)
-group by bulkid
-"""
-
-# Represents how many of an item we've sold since the most recent inventory
-RECENT_SALES_VIEW = """
-create or replace temporary view recent_sales as
-select min(date) as since, max(date) as most_recent, bulkid, count(*) as units
-from (
-    select
-        xacttime as date,
-        li.date AS last_inventoried,
-        p.bulkid
-    from transactions t
-        inner join products p
-            on p.barcode = t.barcode
-        left outer join last_inventory li
-        on li.bulkid = p.bulkid
-    ) s1
-where ( case
-    when last_inventoried is null then true
-    else date > last_inventoried end)
-group by bulkid
-"""
-
-CURRENT_INVENTORY_VIEW = """
-create or replace temporary view current_inventory as
-select
-    i.date,
-    (case when i.bulkid is null then s.bulkid else i.bulkid end) as bulkid,
-    (case when i.units is null then 0 else i.units end)
-        + (case when o.units is null then 0 else o.units end)
-        - (case when s.units is null then 0 else s.units end)
-        AS remaining,
-    i.units as n_inventoried,
-    (case when o.units is null then 0 else o.units end) as n_ordered,
-    (case when s.units is null then 0 else s.units end) as n_sold,
-    s.most_recent as most_recent_sale
-    from last_inventory i
-        full outer join recent_sales s on s.bulkid = i.bulkid
-        left outer join recent_orders o on o.bulkid =
-            (case when i.bulkid is null then s.bulkid else i.bulkid end)
-    order by remaining asc
-"""
+# current_inventory is a view over inventory_state, which triggers keep up to
+# date; see admin/current_inventory.sql.
+CURRENT_INVENTORY_QUERY = "SELECT * FROM current_inventory ORDER BY bulkid"
 
 RECENT_SALES_QUERY = """
 SELECT
@@ -145,11 +71,7 @@ def get_inventory(conn):
         row = dict(row)
         bi_details[row['bulkid']] = row
 
-    cursor.execute(LAST_INVENTORY_VIEW)
-    cursor.execute(RECENT_ORDERS_VIEW)
-    cursor.execute(RECENT_SALES_VIEW)
-    cursor.execute(CURRENT_INVENTORY_VIEW)
-    cursor.execute("SELECT * FROM current_inventory order by bulkid")
+    cursor.execute(CURRENT_INVENTORY_QUERY)
     for row in cursor:
         row = dict(row)
         b_id = row['bulkid']
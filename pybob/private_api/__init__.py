@@ -1,2 +1,2 @@
-from . import bob_api
-from . import db
+# Submodules are imported by name, so that using db or queries doesn't
+# create bob_api's module-level pool and catalog.
@@ -0,0 +1,313 @@
+"""An asyncio flavour of BobApi, for services running on an event loop.
+
+AsyncBobApi has the same methods as BobApi, as coroutines. Each call
+borrows a connection from an aiopg pool, so queries from different tasks
+run concurrently instead of stalling the loop. The SQL is shared with
+BobApi through private_api.queries.
+
+Methods that return a live cursor in BobApi return a list of rows here,
+since the cursor goes back to the pool with its connection.
+
+    api = AsyncBobApi(db.get_db_credentials(db.DEFAULT_CONFIG_PATH))
+    await api.connect()
+    rows = await api.get_fingerprint_data()
+
+Waiting for a connection gives up after checkout_timeout, as with
+db.ConnectionPool; query_timeout is aiopg's own, which bounds every
+statement, so it defaults to aiopg's rather than to the checkout timeout.
+"""
+
+import asyncio
+import traceback
+
+import aiopg
+import psycopg2
+import psycopg2.extras
+
+from private_api import db
+from private_api import queries
+from private_api.barcodes import barcode_variants
+from private_api.errors import InvalidOperationException
+from private_api.queries import statements
+
+
+class AsyncBobApi(object):
+    def __init__(self, creds, minsize=db.DEFAULT_POOL_MIN,
+                 maxsize=db.DEFAULT_POOL_MAX,
+                 checkout_timeout=db.DEFAULT_CHECKOUT_TIMEOUT_S,
+                 query_timeout=aiopg.DEFAULT_TIMEOUT):
+        self.creds = creds
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.checkout_timeout = checkout_timeout
+        self.query_timeout = query_timeout
+        self._pool = None
+
+    async def connect(self):
+        if not self._pool:
+            self._pool = await aiopg.create_pool(
+                minsize=self.minsize, maxsize=self.maxsize,
+                timeout=self.query_timeout, client_encoding='utf8',
+                **self.creds)
+        return self
+
+    async def _acquire(self):
+        """Borrows a connection; give it back with self._pool.release."""
+        await self.connect()
+        try:
+            return await asyncio.wait_for(
+                self._pool.acquire(), self.checkout_timeout)
+        except asyncio.TimeoutError:
+            raise db.PoolTimeoutException(
+                "No connection free after {}s".format(self.checkout_timeout))
+
+    async def close(self):
+        if self._pool:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    async def _run(self, query, args=None, fetch=None, prepared=False):
+        """Runs query on a pooled connection.
+
+        fetch is None (return the rowcount), 'one' or 'all'. With prepared,
+        query is the name of a statement in the registry.
+        """
+        conn = await self._acquire()
+        try:
+            async with conn.cursor(
+                    cursor_factory=psycopg2.extras.DictCursor) as cursor:
+                if prepared:
+                    await statements.execute_async(
+                        cursor, conn.raw, query, args or ())
+                else:
+                    await cursor.execute(query, args)
+
+                if fetch is None:
+                    return cursor.rowcount
+                if not cursor.rowcount or cursor.description is None:
+                    return None if fetch == 'one' else []
+                if fetch == 'one':
+                    return await cursor.fetchone()
+                return await cursor.fetchall()
+        finally:
+            await self._pool.release(conn)
+
+    async def _fetchall(self, query, *args):
+        try:
+            return await self._run(query, *args, fetch='all')
+        except psycopg2.Error:
+            traceback.print_exc()
+            return []
+
+    async def _fetchone(self, query, *args):
+        try:
+            return await self._run(query, *args, fetch='one')
+        except psycopg2.Error:
+            traceback.print_exc()
+            return None
+
+    async def is_valid_userid(self, userid):
+        """Given a userid, return whether or not it's valid. """
+        n = await self._run("bobapi_is_valid_userid", [userid], prepared=True)
+        return n > 0
+
+    async def is_valid_username(self, username):
+        """Given a username, return whether or not it's valid. """
+        return (await self.get_userid(username)) is not None
+
+    async def is_valid_product_barcode(self, barcode):
+        """Return whether or not a barcode is associated with a product. """
+        n = await self._run(queries.IS_VALID_PRODUCT_BARCODE, [barcode])
+        return n > 0
+
+    async def resolve_barcode(self, barcode, kind=None):
+        """See BobApi.resolve_barcode."""
+        row = await self._run(
+            queries.RESOLVE_BARCODE, {'alias': barcode, 'kind': kind},
+            fetch='one')
+        return dict(row) if row else None
+
+    async def get_balance(self, username):
+        """Given a username, returns their balance, or None. """
+        row = await self._run(
+            "bobapi_get_balance", [username], fetch='one', prepared=True)
+        return row[0] if row else None
+
+    async def get_userid(self, username):
+        """Given a username, return userid or None if invalid. """
+        row = await self._run(
+            "bobapi_get_userid", [username], fetch='one', prepared=True)
+        return row[0] if row else None
+
+    async def get_user_from_barcode(self, barcode):
+        """Returns info about any user associated with that barcode."""
+        try:
+            return await self._run(
+                "bobapi_get_user_from_barcode", [barcode],
+                fetch='one', prepared=True)
+        except psycopg2.Error:
+            traceback.print_exc()
+            return None
+
+    async def make_deposit(self, username, amount, description, source=None):
+        """Deposits the given amount into the username provided."""
+        if amount < 0:
+            raise InvalidOperationException("invalid amount for deposit")
+
+        userid = await self.get_userid(username)
+        if not userid:
+            raise InvalidOperationException("invalid username")
+
+        if not source:
+            source = 'webpayment'
+
+        description = "ADD " + description
+
+        conn = await self._acquire()
+        try:
+            async with conn.cursor() as cursor:
+                await cursor.execute("BEGIN")
+                try:
+                    await cursor.execute(
+                        queries.DEPOSIT_BALANCE, [amount, userid])
+                    await cursor.execute(
+                        queries.DEPOSIT_TRANSACTION,
+                        [userid, amount, description, source])
+                except:
+                    await cursor.execute("ROLLBACK")
+                    raise
+                await cursor.execute("COMMIT")
+        finally:
+            await self._pool.release(conn)
+
+    async def get_day_stats(self):
+        """Returns stats from the past day."""
+        return await self._run(queries.DAY_STATS, fetch='one')
+
+    async def get_deposited_cash(self):
+        """Returns the expected makeup of cash sitting in soda machine."""
+        since = await self._get_last_soda_empty()
+        return await self._fetchall(queries.DEPOSITED_CASH, [since])
+
+    async def add_fingerprint_data(self, userid, fp_data):
+        """Adds fingerprint enrollment data to the database."""
+        await self._run(queries.ADD_FINGERPRINT, [userid, fp_data])
+
+    async def get_fingerprint_data(self):
+        """Returns a list of enrolled fingerprints."""
+        return await self._fetchall(queries.FINGERPRINTS)
+
+    async def get_last_transaction_id(self):
+        """Returns the newest transaction id, to tell whether any were added."""
+        return (await self._fetchone(queries.LAST_TRANSACTION_ID))['last_id']
+
+    async def _get_last_soda_empty(self):
+        return (await self._fetchone(queries.LAST_SODA_EMPTY))['last_emptied']
+
+    async def get_sales_stats(
+            self, bulkid=None, barcodes=None, window=14, agg='day',
+            bulkids=None):
+        """Returns daily sales numbers from past given days.
+
+        Pass bulkids to get one series per bulk item, in a single query;
+        each row carries its bulkid.
+        """
+        query, args = queries.sales_stats(
+            bulkid, barcodes, window, agg, bulkids)
+        return await self._run(query, args, fetch='all')
+
+    async def get_daily_aggregate_stats(self):
+        """Returns daily sales numbers from past given days."""
+        return await self._run(queries.DAILY_AGGREGATE_STATS, fetch='all')
+
+    async def get_month_transactions(self):
+        return await self._fetchall(queries.MONTH_TRANSACTIONS)
+
+    async def get_day_average_data(self):
+        return await self._fetchall(queries.DAY_AVERAGE_DATA)
+
+    async def get_day_transactions(self):
+        return await self._fetchall(queries.DAY_TRANSACTIONS)
+
+    async def get_bulkitem_from_barcode(self, bc):
+        return await self._fetchone(queries.BULKITEM_FROM_BARCODE, [bc])
+
+    async def get_bulkitem_from_bulkid(self, bid):
+        return await self._fetchone(queries.BULKITEM_FROM_BULKID, [bid])
+
+    async def get_product_from_barcode(self, bc):
+        return await self._fetchone(queries.PRODUCT_FROM_BARCODE, [bc])
+
+    async def get_bulkitems(self, active=None, bulkid=None):
+        """Returns details of all bulk items."""
+        query, args = queries.bulkitems(active, bulkid)
+        return await self._run(query, args, fetch='all')
+
+    async def get_inventory_steps(self, bulkids, window):
+        """Returns an array of actions on a product to graph inventory over
+        time."""
+        return await self._run(
+            queries.INVENTORY_STEPS, [window, window, window, tuple(bulkids)],
+            fetch='all')
+
+    async def get_wall_of_shame(self):
+        return await self._run(queries.WALL_OF_SHAME, [], fetch='all')
+
+    async def cold_brew_sold_since_last_refresh(self):
+        """Returns number of coldbrew cups sold since last restock."""
+        return await self._run(queries.COLD_BREW_SOLD, fetch='all')
+
+    async def buy_barcode(self, userid, barcode, source='UNKNOWN'):
+        """Purchases item by barcode for given userid."""
+        row = await self._run(
+            "bobapi_buy_barcode", [userid, barcode, source],
+            fetch='one', prepared=True)
+
+        if not row:
+            if not await self.is_valid_userid(userid):
+                raise InvalidOperationException("Invalid userid")
+
+            if not await self.is_valid_product_barcode(barcode):
+                raise InvalidOperationException("Invalid barcode")
+
+            raise InvalidOperationException("Couldn't insert transaction")
+
+        return dict(row)
+
+    async def buy_barcodes(self, userid, barcodes, source='UNKNOWN'):
+        """Purchases several items by barcode for given userid at once.
+
+        See BobApi.buy_barcodes.
+        """
+        if not barcodes:
+            raise InvalidOperationException("No barcodes given")
+
+        query, args = queries.buy_barcodes(
+            userid, barcodes, source, barcode_variants)
+        rows = await self._run(query, args, fetch='all')
+
+        if len(rows) != len(barcodes):
+            if not await self.is_valid_userid(userid):
+                raise InvalidOperationException("Invalid userid")
+
+            invalid = []
+            for bc in barcodes:
+                valid = False
+                for variant in barcode_variants(bc):
+                    if await self.is_valid_product_barcode(variant):
+                        valid = True
+                        break
+                if not valid:
+                    invalid.append(bc)
+            if invalid:
+                raise InvalidOperationException(
+                    "Invalid barcode(s): {}".format(", ".join(invalid)))
+
+            raise InvalidOperationException("Couldn't insert transactions")
+
+        transactions = [dict(row) for row in rows]
+        balance = transactions[-1]['balance']
+        for row in transactions:
+            del row['balance']
+        return {"transactions": transactions, "balance": balance}
@@ -0,0 +1,33 @@
+"""How scanned barcodes relate to the barcodes we store.
+
+Scanners sometimes report a UPC-A as a zero-padded EAN-13, or pad a UPC-E
+out to eight digits. barcode_variants() goes from a scan to the stored
+forms it might stand for; barcode_aliases() goes the other way, and is
+what the barcode_aliases table (admin/barcode_aliases.sql) and the catalog
+cache index by.
+"""
+
+
+def barcode_variants(barcode):
+    """Returns the forms to try a scanned barcode as, most specific first."""
+    variants = [barcode]
+    if barcode.startswith("0") and len(barcode) == 13:
+        variants.append(barcode[1:])
+    if barcode.startswith("0") and len(barcode) == 8:
+        variants.append(barcode[1:-1])
+    return variants
+
+
+def barcode_aliases(barcode):
+    """Returns (alias, rank) for every scan that barcode_variants() maps to
+    barcode; rank 0 is the barcode itself.
+
+    Must match barcode_alias_forms() in admin/barcode_aliases.sql.
+    """
+    aliases = [(barcode, 0)]
+    if len(barcode) == 12:
+        aliases.append(("0" + barcode, 1))
+    if len(barcode) == 6:
+        # The eighth digit of a padded UPC-E is dropped, whatever it is.
+        aliases.extend(("0" + barcode + str(d), 1) for d in range(10))
+    return aliases
@@ -11,77 +11,136 @@ this file...
 
 """
 
+import itertools
+
 import psycopg2
 import psycopg2.extras
 
-from private_api.db import get_conn
+from private_api.barcodes import barcode_variants
+from private_api.catalog import CatalogCache, MISS
+from private_api.db import ConnectionPool, get_pool
+from private_api.errors import InvalidOperationException
+from private_api.metrics import metrics
+from private_api import queries
+from private_api.queries import statements
+
 
+# Rows fetched per round trip when streaming from a server-side cursor.
+STREAM_ITERSIZE = 2000
 
-class InvalidOperationException(Exception):
-    pass
+_stream_ids = itertools.count()
 
 
 class BobApi(object):
     def __init__(self, creds, connected=False):
-        if type(creds) == psycopg2.extensions.connection:
-            self.db = creds
+        self._pool = None
+        self._db = None
+        self.catalog = None
+        if isinstance(creds, ConnectionPool):
+            self._pool = creds
+        elif type(creds) == psycopg2.extensions.connection:
+            self._db = creds
         else:
-            self.db = psycopg2.connect(**creds)
-        self.db.set_client_encoding('utf8')
+            self._db = psycopg2.connect(**creds)
+
+        if self._db:
+            self._db.set_client_encoding('utf8')
+
+    @property
+    def db(self):
+        """The connection to use; when pooled, the current thread's."""
+        if self._pool:
+            return self._pool.scoped_conn()
+        return self._db
+
+    def release(self):
+        """Returns a pooled connection held by this thread to the pool."""
+        if self._pool:
+            self._pool.release_scoped()
 
     def _get_cursor(self):
         return self.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
+    def _execute_prepared(self, name, args=()):
+        cursor = self._get_cursor()
+        statements.execute(cursor, name, args)
+        return cursor
+
+    @metrics.instrument
     def is_valid_userid(self, userid):
         """Given a userid, return whether or not it's valid. """
-        cursor = self._get_cursor()
-        query = ("SELECT balance FROM users WHERE userid = %s")
-        cursor.execute(query, [userid])
+        cursor = self._execute_prepared("bobapi_is_valid_userid", [userid])
         return cursor.rowcount > 0
 
+    @metrics.instrument
     def is_valid_username(self, username):
         """Given a username, return whether or not it's valid. """
         return self.get_userid(username) is not None
 
+    @metrics.instrument
     def is_valid_product_barcode(self, barcode):
         """Return whether or not a barcode is associated with a product. """
+        if self.catalog:
+            product = self.catalog.get_product(barcode)
+            if product is not MISS:
+                return product is not None
+
         cursor = self._get_cursor()
-        query = ("SELECT name FROM products WHERE barcode = %s")
-        cursor.execute(query, [barcode])
+        cursor.execute(queries.IS_VALID_PRODUCT_BARCODE, [barcode])
         return cursor.rowcount > 0
 
+    @metrics.instrument
+    def resolve_barcode(self, barcode, kind=None):
+        """Finds the product or bulk item a scanned barcode stands for,
+        under any of its barcode_variants(), optionally only of one kind
+        ('product' or 'bulkitem').
+
+        Returns a dict of its kind, stored barcode and bulkid, or None.
+        Database errors propagate, so they aren't taken for "not found".
+        """
+        if self.catalog:
+            alias = self.catalog.resolve(barcode, kind)
+            if alias is not MISS:
+                return alias
+
+        cursor = self._get_cursor()
+        try:
+            cursor.execute(
+                queries.RESOLVE_BARCODE, {'alias': barcode, 'kind': kind})
+        except psycopg2.Error:
+            metrics.note_error()
+            self.db.rollback()
+            raise
+
+        row = cursor.fetchone() if cursor.rowcount else None
+        self.db.commit()
+        return dict(row) if row else None
+
+    @metrics.instrument
     def get_balance(self, username):
         """Given a username, returns their balance, or None. """
-        query = ("SELECT balance FROM users WHERE username = %s")
-        cursor = self._get_cursor()
-        cursor.execute(query, [username])
+        cursor = self._execute_prepared("bobapi_get_balance", [username])
 
         if cursor.rowcount > 0:
             return cursor.fetchone()[0]
         return None
 
+    @metrics.instrument
     def get_userid(self, username):
         """Given a username, return userid or None if invalid. """
-        query = ("SELECT userid FROM users WHERE username = %s")
-        cursor = self._get_cursor()
-        cursor.execute(query, [username])
+        cursor = self._execute_prepared("bobapi_get_userid", [username])
 
         if cursor.rowcount > 0:
             return cursor.fetchone()[0]
         return None
 
+    @metrics.instrument
     def get_user_from_barcode(self, barcode):
         """Returns info about any user associated with that barcode."""
+        return self._fetchone_prepared(
+            "bobapi_get_user_from_barcode", [barcode])
 
-        query = (" SELECT"
-                 "  u.userid, username, nickname, balance"
-                 " from users u inner join userbarcodes b"
-                 "  on b.userid = u.userid"
-                 " where"
-                 "  barcode = %s")
-
-        return self._fetchone(query, [barcode])
-
+    @metrics.instrument
     def make_deposit(self, username, amount, description, source=None):
         """Deposits the given amount into the username provided."""
         if amount < 0:
@@ -96,432 +155,247 @@ class BobApi(object):
 
         description = "ADD " + description
 
-        query1 = ("UPDATE users SET balance = balance + %s WHERE userid = %s")
-        query2 = ("INSERT INTO transactions"
-                  " (xacttime, userid, xactvalue, xacttype, source)"
-                  " VALUES"
-                  " (now(), %s, %s, %s, %s)")
         cursor = self._get_cursor()
-        cursor.execute(query1, [amount, userid])
-        cursor.execute(query2, [userid, amount, description, source])
+        cursor.execute(queries.DEPOSIT_BALANCE, [amount, userid])
+        cursor.execute(queries.DEPOSIT_TRANSACTION,
+                       [userid, amount, description, source])
         self.db.commit()
 
+    @metrics.instrument
     def get_day_stats(self):
         """Returns stats from the past day."""
 
-        query = (" SELECT"
-                 "  count(*) as n_transactions,"
-                 "  sum(case when xactvalue < 0 then 1 else 0 end) as n_purchases,"
-                 "  sum(case when xactvalue < 0 then xactvalue else 0 end) as purchased,"
-                 "  sum(case when xactvalue > 0 then 1 else 0 end) as n_deposits,"
-                 "  sum(case when xactvalue > 0 then xactvalue else 0 end) as deposits,"
-                 "  sum(xactvalue) as net"
-                 " from transactions"
-                 " where"
-                 "  xacttime >= now() - interval '24 hours'"
-                 )
-
         cursor = self._get_cursor()
-        cursor.execute(query)
+        cursor.execute(queries.DAY_STATS)
         stats = cursor.fetchone()
         return stats
 
+    @metrics.instrument
     def get_deposited_cash(self):
         """Returns the expected makeup of cash sitting in soda machine."""
 
         since = self._get_last_soda_empty()
-        query = (" SELECT"
-                 "  xactvalue::integer::text as value,"
-                 "  count(*) as n,"
-                 "  (count(*) * xactvalue) as total"
-                 " from transactions"
-                 " where"
-                 "  xactvalue >= 1"
-                 "  and xacttime > %s"
-                 "  and source = 'bob2k14.2'"
-                 "  and xacttype like 'ADD %% (cash)'"
-                 " group by xactvalue"
-                 " order by xactvalue")
 
         cursor = self._get_cursor()
         try:
-            cursor.execute(query, [since])
+            cursor.execute(queries.DEPOSITED_CASH, [since])
         except:
             import traceback
             traceback.print_exc()
+            metrics.note_error()
 
         rows = cursor.fetchall()
         return rows
 
+    @metrics.instrument
     def add_fingerprint_data(self, userid, fp_data):
         """Adds fingerprint enrollment data to the database."""
-        query = ("INSERT INTO fingerprints (userid, fp_data) VALUES(%s, %s)")
         cursor = self._get_cursor()
-        cursor.execute(query, [userid, fp_data])
+        cursor.execute(queries.ADD_FINGERPRINT, [userid, fp_data])
         self.db.commit()
 
+    @metrics.instrument
     def get_fingerprint_data(self):
         """Returns a list of enrolled fingerprints."""
-        query = ("SELECT * FROM fingerprints")
         cursor = self._get_cursor()
         try:
-            cursor.execute(query)
+            cursor.execute(queries.FINGERPRINTS)
         except:
             import traceback
             traceback.print_exc()
+            metrics.note_error()
 
         rows = cursor.fetchall()
         return rows
 
+    @metrics.instrument
+    def get_last_transaction_id(self):
+        """Returns the newest transaction id, to tell whether any were added."""
+        return self._fetchone(queries.LAST_TRANSACTION_ID)['last_id']
+
     def _get_last_soda_empty(self):
-        query = (
-            " SELECT"
-            "     max(xacttime) as last_emptied"
-            " FROM transactions WHERE barcode = '482665976515'")
-        return self._fetchone(query)['last_emptied']
+        return self._fetchone(queries.LAST_SODA_EMPTY)['last_emptied']
 
+    @metrics.instrument
     def get_sales_stats(
-            self, bulkid=None, barcodes=None, window=14, agg='day'):
-        """Returns daily sales numbers from past given days."""
-
-        assert(bulkid or barcodes)
+            self, bulkid=None, barcodes=None, window=14, agg='day',
+            bulkids=None):
+        """Returns daily sales numbers from past given days.
 
-        assert(agg in {'day'})
-        #{'hour', 'minute', 'month', 'day'})
+        Pass bulkids to get one series per bulk item, in a single query;
+        each row carries its bulkid.
+        """
+        query, args = queries.sales_stats(
+            bulkid, barcodes, window, agg, bulkids)
 
         cursor = self._get_cursor()
-        args = {}
-        conditions = ["true"]
-
-        query = (
-            " SELECT"
-            "      t_ago,"
-            "      date_trunc('{group_type}',"
-            "                  now()) - t_ago * interval '1 {group_type}'"
-            "          as step,"
-            "      count(distinct id) AS n_sold,"
-            "      count(distinct userid) AS n_users"
-            " FROM "
-            " (select generate_series(0, %(window_size)s) as t_ago) s"
-            " LEFT OUTER JOIN "
-            " ("
-            "      SELECT t.*, p.bulkid FROM "
-            "          transactions t"
-            "          INNER JOIN products p"
-            "              ON t.barcode = p.barcode"
-            "      WHERE"
-            #"          xacttime > date_trunc("
-            #"               '{group_type}',"
-            #"               now()) - interval '%(window_size)s'"
-            #"                   || ' {group_type}"
-            " true"
-            "          AND {transaction_join_condition}"
-            "          AND {product_join_condition}"
-            " ) x"
-            " ON"
-            "        date_part('{group_type}', "
-            "                  date_trunc('{group_type}',"
-            "                             now()) - date_trunc("
-            "                                   '{group_type}',"
-            "                                   xacttime))::integer = t_ago"
-            " AND {conditions}"
-            " GROUP BY t_ago"
-            " ORDER BY t_ago ASC"
-        )
-
-        args['window_size'] = window
-
-        product_join_condition = 'true'
-        transaction_join_condition = 'true'
-        if bulkid:
-            #conditions.append("bulkid = %(bulkid)s")
-            product_join_condition = "bulkid = %(bulkid)s"
-            args['bulkid'] = bulkid
-        elif barcodes:
-            transaction_join_condition = "t.barcode in %(barcodes)s"
-            args['barcodes'] = tuple(barcodes)
-
-        query = query.format(
-            conditions=" AND ".join(conditions),
-            product_join_condition=product_join_condition,
-            transaction_join_condition=transaction_join_condition,
-            group_type=agg,
-        )
-
         cursor.execute(query, args)
         self.db.commit()
         return cursor
 
+    @metrics.instrument
     def get_daily_aggregate_stats(self):
         """Returns daily sales numbers from past given days."""
         cursor = self._get_cursor()
-        query = """
-        select
-            xacttime::date as date,
-            -1*sum(xactvalue) as revenue,
-            count(distinct userid) as n_users,
-            count(*) as n_transactions
-        from transactions
-        where
-            xactvalue < 0
-            and xacttime > current_date - interval '1 month'
-        group by xacttime::date
-        order by xacttime::date
-        """
-
-        cursor.execute(query)
+        cursor.execute(queries.DAILY_AGGREGATE_STATS)
         self.db.commit()
         return cursor
 
+    @metrics.instrument
     def get_month_transactions(self):
-        query = """
-        SELECT t.barcode, t.userid, t.xacttime, t.xactvalue, p.bulkid
-        FROM transactions t LEFT OUTER JOIN products p ON p.barcode = t.barcode
-        WHERE xacttime > now() - interval '31 days'
-        ORDER BY xacttime ASC
-        """
-
-        return self._fetchall(query)
+        return self._fetchall(queries.MONTH_TRANSACTIONS)
 
+    @metrics.instrument
     def get_day_average_data(self):
-        query = """
-select
-    s.hour,
-    case
-        when a.avg_sales is not null
-            then a.avg_sales
-        else 0
-            end as avg_sales,
-    case
-        when t.sales is not null then t.sales
-        when s.hour > extract(hour from now()) then null
-        else 0
-            end as today_sales,
-    case
-        when a.avg_deposits is not null
-            then a.avg_deposits
-        else 0
-            end as avg_deposits,
-    case
-        when t.deposits is not null then t.deposits
-        when s.hour > extract(hour from now()) then null
-        else 0
-            end as today_deposits
-
-from (
-        select generate_series(0, 23) as hour) s
-    left outer join (
-        select
-            extract(hour from xacttime) as hour,
-            -1 * sum(case when xactvalue < 0 then xactvalue else 0 end) /
-                count(distinct date_trunc('day', xacttime))
-                as avg_sales,
-            sum(case when xactvalue > 0 then xactvalue else 0 end) /
-                count(distinct date_trunc('day', xacttime))
-                as avg_deposits
-        from transactions
-        where
-            xacttime > current_date - interval '365 days'
-            and extract(dow from current_date) = extract(dow from xacttime)
-            and xacttime < current_date
-        group by hour
-        ) a
-    on s.hour = a.hour
-    left outer join (
-        select
-            extract(hour from xacttime) as hour,
-            -1 * sum(case when xactvalue < 0 then xactvalue else 0 end)
-                as sales,
-            sum(case when xactvalue > 0 then xactvalue else 0 end) as deposits
-        from transactions
-        where
-            xacttime > current_date
-        group by hour
-        ) t
-    on t.hour = s.hour
-order by hour
-"""
-
-        return self._fetchall(query)
+        return self._fetchall(queries.DAY_AVERAGE_DATA)
 
+    @metrics.instrument
     def get_day_transactions(self):
-        query = """
-        SELECT *
-        FROM transactions
-        WHERE xacttime > current_date - interval '3 days'
-        ORDER BY xacttime ASC
-        """
+        return self._fetchall(queries.DAY_TRANSACTIONS)
 
-        return self._fetchall(query)
+    def stream_month_transactions(self, itersize=STREAM_ITERSIZE):
+        """Like get_month_transactions, but yields rows as they arrive."""
+        return self._stream(queries.MONTH_TRANSACTIONS, itersize=itersize,
+                            name='stream_month_transactions')
 
+    def stream_day_transactions(self, itersize=STREAM_ITERSIZE):
+        """Like get_day_transactions, but yields rows as they arrive."""
+        return self._stream(queries.DAY_TRANSACTIONS, itersize=itersize,
+                            name='stream_day_transactions')
+
+    @metrics.instrument
     def get_bulkitem_from_barcode(self, bc):
-        query = """
-        SELECT *, 'bulkitem' as \"type\" FROM bulk_items WHERE bulkbarcode = %s
-        """
-        return self._fetchone(query, [bc])
+        if self.catalog:
+            row = self.catalog.get_bulkitem_by_barcode(bc)
+            if row is not MISS:
+                return row
+
+        return self._fetchone(queries.BULKITEM_FROM_BARCODE, [bc])
 
+    @metrics.instrument
     def get_bulkitem_from_bulkid(self, bid):
-        query = """
-        SELECT *, 'bulkitem' as \"type\" FROM bulk_items WHERE bulkid = %s
-        """
-        return self._fetchone(query, [bid])
+        if self.catalog:
+            row = self.catalog.get_bulkitem(bid)
+            if row is not MISS:
+                return row
+
+        return self._fetchone(queries.BULKITEM_FROM_BULKID, [bid])
 
+    @metrics.instrument
     def get_product_from_barcode(self, bc):
-        query = """
-        SELECT *, 'product' as \"type\" FROM products WHERE barcode = %s
-        """
-        return self._fetchone(query, [bc])
+        if self.catalog:
+            row = self.catalog.get_product(bc)
+            if row is not MISS:
+                return row
 
+        return self._fetchone(queries.PRODUCT_FROM_BARCODE, [bc])
+
+    @metrics.instrument
     def get_bulkitems(self, active=None, bulkid=None):
         """Returns details of all bulk items."""
-
-        query = (" SELECT"
-                 "  *"
-                 " FROM bulk_items"
-                 " WHERE {conditions}")
+        query, args = queries.bulkitems(active, bulkid)
 
         cursor = self._get_cursor()
-        conditions = ["true"]
-        args = {}
-        if active is not None:
-            conditions.append("active = %(active)s")
-            args['active'] = active
-        if bulkid:
-            conditions.append("bulkid = %(bulkid)s")
-            args['bulkid'] = bulkid
-
-        query = query.format(conditions=" AND ".join(conditions))
-
         cursor.execute(query, args)
         self.db.commit()
         return cursor
 
+    @metrics.instrument
     def get_inventory_steps(self, bulkids, window):
         """Returns an array of actions on a product to graph inventory over
         time."""
-
-        query = """
-SELECT * FROM (
-    SELECT xacttime AS date,
-           bulkid,
-           'sale' AS type,
-           -1 AS n
-    FROM transactions t INNER JOIN products p
-        ON p.barcode = t.barcode
-    WHERE xacttime > current_date - interval %s and bulkid is not null
-
-    UNION ALL
-
-    SELECT  date,
-            bulk_type_id AS bulkid,
-            'order' AS type,
-            quantity*number AS n
-    FROM order_items oi INNER JOIN orders o
-        ON o.id = oi.order_id
-    WHERE date > current_date - interval %s and bulk_type_id is not null
-
-    UNION ALL
-
-    SELECT  date,
-            bulkid,
-            'inventory' AS type,
-            units AS n
-    FROM inventory i
-    WHERE
-        date > current_date - interval %s
-        and bulkid is not null
-        and units is not null
-) s
-WHERE bulkid IN %s
-ORDER BY date ASC
-"""
         cursor = self._get_cursor()
-        cursor.execute(query, [window, window, window, tuple(bulkids)])
+        cursor.execute(queries.INVENTORY_STEPS,
+                       [window, window, window, tuple(bulkids)])
         stats = cursor.fetchall()
         self.db.commit()
         return stats
 
+    @metrics.instrument
     def get_wall_of_shame(self):
-        QUERY = """
-SELECT
-    username,
-    nickname,
-    balance,
-    extract('days' from (now() - entered_wall)) as days_on_wall
-FROM users
-WHERE
-    (NOT disabled)
-    AND (last_purchase_time > now() - INTERVAL '6 months')
-    AND ((balance <= -5) OR (entered_wall < now() - interval '28 days'))
-ORDER BY balance ASC
-"""
         cursor = self._get_cursor()
-        cursor.execute(QUERY, [])
+        cursor.execute(queries.WALL_OF_SHAME, [])
         wall = cursor.fetchall()
         self.db.commit()
         return wall
 
+    @metrics.instrument
     def cold_brew_sold_since_last_refresh(self):
         """Returns number of coldbrew cups sold since last restock."""
-
-        query = ("select count(*) from transactions"
-                 " where barcode = '488348702402'"
-                 " and xacttime >"
-                 "  (select xacttime from transactions t"
-                 "   where barcode in (select barcode from coldbrew_varieties)"
-                 "   order by xacttime desc limit 1)")
-
         cursor = self._get_cursor()
-        cursor.execute(query)
+        cursor.execute(queries.COLD_BREW_SOLD)
         self.db.commit()
         return cursor
 
+    @metrics.instrument
     def buy_barcode(self, userid, barcode, source='UNKNOWN'):
-        """Purchases item by barcode for given userid."""
-
-        if not self.is_valid_userid(userid):
-            raise InvalidOperationException("Invalid userid")
-
-        if not self.is_valid_product_barcode(barcode):
-            raise InvalidOperationException("Invalid barcode")
-
-        purchase_query = """
-            INSERT INTO transactions (
-                userid, xactvalue, xacttype, barcode, source)
-            SELECT
-                %s,
-                -1 * price,
-                (case when price < 0 then 'ADD ' else 'BUY ' end ) || name,
-                barcode, %s
-            FROM dynamic_barcode_lookup WHERE barcode = %s AND userid = %s LIMIT 1
-            RETURNING *
-        """
+        """Purchases item by barcode for given userid.
 
-        balance_query = """
-            UPDATE users SET balance = balance + %s WHERE userid = %s
-            RETURNING balance
+        Validation, the transaction insert and the balance update all happen
+        in one statement. Only when it inserts nothing do we go back to work
+        out which check failed.
         """
 
-        cursor = self._get_cursor()
-        cursor.execute(purchase_query, [userid, source, barcode, userid])
+        cursor = self._execute_prepared(
+            "bobapi_buy_barcode", [userid, barcode, source])
 
-        if not cursor.rowcount:
+        if cursor.rowcount != 1:
             self.db.rollback()
+
+            if not self.is_valid_userid(userid):
+                raise InvalidOperationException("Invalid userid")
+
+            if not self.is_valid_product_barcode(barcode):
+                raise InvalidOperationException("Invalid barcode")
+
             raise InvalidOperationException("Couldn't insert transaction")
 
-        row = cursor.fetchone()
-        results = dict(row)
+        results = dict(cursor.fetchone())
+        self.db.commit()
+        return results
+
+    @metrics.instrument
+    def buy_barcodes(self, userid, barcodes, source='UNKNOWN'):
+        """Purchases several items by barcode for given userid at once.
 
-        cursor.execute(balance_query, [row['xactvalue'], userid])
+        Either every barcode is bought or nothing is. Each barcode is tried
+        as each of its barcode_variants() in turn, and the balance is updated
+        once for the whole basket.
 
-        row = cursor.fetchone()
-        if cursor.rowcount != 1:
+        Returns a dict of the new transactions and the resulting balance.
+        """
+        if not barcodes:
+            raise InvalidOperationException("No barcodes given")
+
+        query, args = queries.buy_barcodes(
+            userid, barcodes, source, barcode_variants)
+
+        cursor = self._get_cursor()
+        cursor.execute(query, args)
+
+        if cursor.rowcount != len(barcodes):
             self.db.rollback()
-            raise InvalidOperationException("Couldn't update balance")
 
+            if not self.is_valid_userid(userid):
+                raise InvalidOperationException("Invalid userid")
+
+            invalid = [
+                bc for bc in barcodes
+                if not any(self.is_valid_product_barcode(v)
+                           for v in barcode_variants(bc))]
+            if invalid:
+                raise InvalidOperationException(
+                    "Invalid barcode(s): {}".format(", ".join(invalid)))
+
+            raise InvalidOperationException("Couldn't insert transactions")
+
+        transactions = [dict(row) for row in cursor.fetchall()]
         self.db.commit()
-        results['balance'] = row['balance']
-        return results
+
+        balance = transactions[-1]['balance']
+        for row in transactions:
+            del row['balance']
+        return {"transactions": transactions, "balance": balance}
 
     def _fetchall(self, query, *args, **kwargs):
         cursor = self._get_cursor()
@@ -530,6 +404,7 @@ ORDER BY balance ASC
         except:
             import traceback
             traceback.print_exc()
+            metrics.note_error()
 
         if cursor.rowcount:
             rows = cursor.fetchall()
@@ -545,6 +420,7 @@ ORDER BY balance ASC
         except:
             import traceback
             traceback.print_exc()
+            metrics.note_error()
 
         if cursor.rowcount:
             row = cursor.fetchone()
@@ -553,5 +429,57 @@ ORDER BY balance ASC
         self.db.commit()
         return row
 
+    def _fetchone_prepared(self, name, args=()):
+        try:
+            cursor = self._execute_prepared(name, args)
+        except:
+            import traceback
+            traceback.print_exc()
+            metrics.note_error()
+            self.db.rollback()
+            return None
 
-bobapi = BobApi(get_conn())
+        row = cursor.fetchone() if cursor.rowcount else None
+        self.db.commit()
+        return row
+
+    def _stream(self, query, args=None, itersize=STREAM_ITERSIZE,
+                name='_stream'):
+        """Yields the rows of query from a named (server-side) cursor, so
+        only itersize rows are held in memory at a time.
+
+        When pooled, the cursor gets a connection of its own for as long as
+        the generator runs. Otherwise, don't use this BobApi for anything
+        else until the generator is exhausted or closed.
+
+        The whole stream is recorded in metrics under name.
+        """
+        return metrics.stream(name, self._stream_rows(query, args, itersize))
+
+    def _stream_rows(self, query, args, itersize):
+        if self._pool:
+            with self._pool.connection() as conn:
+                yield from self._stream_on(conn, query, args, itersize)
+        else:
+            yield from self._stream_on(self._db, query, args, itersize)
+
+    def _stream_on(self, conn, query, args, itersize):
+        cursor = conn.cursor("bobapi_stream_{}".format(next(_stream_ids)),
+                             cursor_factory=psycopg2.extras.DictCursor)
+        cursor.itersize = itersize
+        try:
+            cursor.execute(query, args)
+            for row in cursor:
+                yield row
+        finally:
+            if not conn.closed:
+                try:
+                    cursor.close()
+                except psycopg2.Error:
+                    pass
+                conn.rollback()
+
+
+# Nothing connects until the first query, so importing this stays cheap.
+bobapi = BobApi(get_pool(lazy=True))
+bobapi.catalog = CatalogCache(get_pool())
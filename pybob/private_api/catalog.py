@@ -0,0 +1,233 @@
+"""An in-process copy of the products and bulk_items tables.
+
+Both tables change a handful of times a day but are read on every scan, so
+we load them whole and keep them until Postgres tells us otherwise. The
+triggers in admin/catalog_notify.sql NOTIFY on CATALOG_CHANNEL whenever
+either table is edited; a listener thread marks the cache stale and the
+next lookup reloads it.
+
+While the listener isn't connected we can't know about edits, so lookups
+report a MISS and callers go to the database instead.
+
+Loads borrow their own connection from the pool, so they never touch (or
+commit) the connection the calling thread holds.
+"""
+
+import select
+import sys
+import threading
+import time
+import traceback
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+from private_api.barcodes import barcode_aliases
+
+
+CATALOG_CHANNEL = "catalog_changed"
+
+DEFAULT_MAX_ENTRIES = 50000
+
+LISTEN_RETRY_S = 5
+
+MISS = object()
+
+PRODUCTS_QUERY = "SELECT *, 'product' as \"type\" FROM products"
+BULK_ITEMS_QUERY = "SELECT *, 'bulkitem' as \"type\" FROM bulk_items"
+
+
+def log(*args):
+    sys.stderr.write(" ".join([str(x) for x in args]))
+    sys.stderr.write("\n")
+
+
+class CatalogCache(object):
+    def __init__(self, pool, max_entries=DEFAULT_MAX_ENTRIES):
+        self._pool = pool
+        self._creds = pool.creds
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        # Guards the counters; _lock is held for whole loads.
+        self._stats_lock = threading.Lock()
+        self._listener = None
+        self._listening = False
+        self._stale = True
+        self._oversized = False
+
+        self._products = {}
+        self._bulk_items = {}
+        self._bulk_barcodes = {}
+        self._aliases = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    def _start_listener(self):
+        if self._listener:
+            return
+        self._listener = threading.Thread(
+            daemon=True, target=self._listen, name="catalog-listener")
+        self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                conn = psycopg2.connect(**self._creds)
+                conn.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute("LISTEN {};".format(CATALOG_CHANNEL))
+
+                # Anything could have changed while we weren't listening.
+                self.invalidate()
+                self._listening = True
+
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        del conn.notifies[:]
+                        self.invalidate()
+            except Exception:
+                self._listening = False
+                traceback.print_exc()
+                time.sleep(LISTEN_RETRY_S)
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _load(self):
+        with self._pool.connection() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cursor.execute(PRODUCTS_QUERY)
+            product_rows = cursor.fetchall()
+            cursor.execute(BULK_ITEMS_QUERY)
+            bulk_item_rows = cursor.fetchall()
+            conn.rollback()
+
+        products = {}
+        for row in product_rows:
+            products[row['barcode']] = dict(row)
+
+        bulk_items = {}
+        bulk_barcodes = {}
+        for row in bulk_item_rows:
+            bulk_items[row['bulkid']] = dict(row)
+            if row['bulkbarcode']:
+                bulk_barcodes[row['bulkbarcode']] = row['bulkid']
+
+        self._count('loads')
+        if len(products) + len(bulk_items) > self.max_entries:
+            log("Catalog has {} entries, over the cap of {}; not caching."
+                .format(len(products) + len(bulk_items), self.max_entries))
+            self._oversized = True
+            self._products, self._bulk_items, self._bulk_barcodes = {}, {}, {}
+            self._aliases = {}
+            return
+
+        self._oversized = False
+        self._products = products
+        self._bulk_items = bulk_items
+        self._bulk_barcodes = bulk_barcodes
+        self._aliases = self._index_aliases(products, bulk_items)
+
+    def _index_aliases(self, products, bulk_items):
+        """Maps each alias to what it may resolve to, best match first; the
+        in-memory twin of the barcode_aliases table."""
+        matches = {}
+        for row in products.values():
+            for alias, rank in barcode_aliases(row['barcode']):
+                matches.setdefault(alias, []).append((rank, 0, {
+                    'kind': 'product', 'barcode': row['barcode'],
+                    'bulkid': row['bulkid']}))
+        for row in bulk_items.values():
+            if not row['bulkbarcode']:
+                continue
+            for alias, rank in barcode_aliases(row['bulkbarcode']):
+                matches.setdefault(alias, []).append((rank, 1, {
+                    'kind': 'bulkitem', 'barcode': row['bulkbarcode'],
+                    'bulkid': row['bulkid']}))
+
+        aliases = {}
+        for alias, found in matches.items():
+            found.sort(key=lambda x: x[:2])
+            aliases[alias] = [x[2] for x in found]
+        return aliases
+
+    def _ensure_loaded(self):
+        """Returns whether lookups can be answered from the cache."""
+        self._start_listener()
+        if not self._listening:
+            return False
+
+        if self._stale:
+            with self._lock:
+                if self._stale:
+                    self._stale = False
+                    try:
+                        self._load()
+                    except Exception:
+                        self._stale = True
+                        traceback.print_exc()
+                        return False
+
+        return not self._oversized
+
+    def _get(self, index, key):
+        if not self._ensure_loaded():
+            self._count('misses')
+            return MISS
+
+        self._count('hits')
+        row = index().get(key)
+        return dict(row) if row is not None else None
+
+    def invalidate(self):
+        self._count('invalidations')
+        self._stale = True
+
+    def get_product(self, barcode):
+        return self._get(lambda: self._products, barcode)
+
+    def get_bulkitem(self, bulkid):
+        return self._get(lambda: self._bulk_items, bulkid)
+
+    def get_bulkitem_by_barcode(self, bulkbarcode):
+        if not self._ensure_loaded():
+            self._count('misses')
+            return MISS
+        return self.get_bulkitem(self._bulk_barcodes.get(bulkbarcode))
+
+    def resolve(self, barcode, kind=None):
+        """See BobApi.resolve_barcode."""
+        if not self._ensure_loaded():
+            self._count('misses')
+            return MISS
+
+        self._count('hits')
+        for alias in self._aliases.get(barcode, []):
+            if kind is None or alias['kind'] == kind:
+                return dict(alias)
+        return None
+
+    def stats(self):
+        with self._stats_lock:
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "invalidations": self.invalidations,
+            }
+        stats.update({
+            "products": len(self._products),
+            "bulk_items": len(self._bulk_items),
+            "listening": self._listening,
+            "oversized": self._oversized,
+        })
+        return stats
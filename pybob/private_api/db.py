@@ -1,16 +1,33 @@
 """A few convenience functions for getting the database handles and cursors."""
 
 import configparser
+import contextlib
 import io
 import os
+import threading
+import time
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 
 
 DEFAULT_CONFIG_PATH = os.environ.get("CHEZBOB_DB_PATH", "/git/db.conf")
 
+DEFAULT_POOL_MIN = 1
+DEFAULT_POOL_MAX = 10
+DEFAULT_CHECKOUT_TIMEOUT_S = 5
+
+# Idle connections older than this get a round trip to prove they're alive.
+HEALTH_CHECK_INTERVAL_S = 30
+
 _db = None
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PoolTimeoutException(Exception):
+    pass
 
 
 def get_db_credentials(config_file):
@@ -45,3 +62,177 @@ def get_conn(config_file=DEFAULT_CONFIG_PATH):
         _db.set_client_encoding("UTF-8")
     return _db
 
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of database connections.
+
+    Connections are checked out with getconn() (or the connection() context
+    manager) and handed back with putconn(). Anything left mid-transaction is
+    rolled back on return, so the next borrower always starts clean.
+
+    scoped_conn() gives each thread one connection it keeps until
+    release_scoped() is called; the public API releases it at the end of every
+    request.
+
+    Unless lazy, minconn connections are opened up front; a lazy pool opens
+    nothing until the first getconn().
+    """
+
+    def __init__(self, creds, minconn=DEFAULT_POOL_MIN,
+                 maxconn=DEFAULT_POOL_MAX,
+                 timeout=DEFAULT_CHECKOUT_TIMEOUT_S,
+                 health_check_interval=HEALTH_CHECK_INTERVAL_S,
+                 lazy=False):
+        assert(0 <= minconn <= maxconn)
+
+        self.creds = creds
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = []
+        self._n_open = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+        if not lazy:
+            for _ in range(minconn):
+                self._idle.append((self._connect(), time.time()))
+                self._n_open += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.creds)
+        conn.set_client_encoding("UTF-8")
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._n_open -= 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+
+        if time.time() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self, timeout=None):
+        """Checks out a connection, waiting up to timeout seconds for one."""
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+
+        while True:
+            with self._cond:
+                while not self._idle and self._n_open >= self.maxconn:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeoutException(
+                            "No database connection free after {}s".format(
+                                timeout))
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    conn, last_used = None, None
+                    self._n_open += 1
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except:
+                    with self._cond:
+                        self._n_open -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn):
+        """Returns a connection to the pool."""
+        if not conn.closed and (conn.get_transaction_status() !=
+                                psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+
+        if conn.closed:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def scoped_conn(self):
+        """Returns the connection held by the current thread, checking one
+        out if it doesn't have one yet."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.closed:
+            self._local.conn = None
+            self._discard(conn)
+            conn = None
+
+        if conn is None:
+            conn = self.getconn()
+            self._local.conn = conn
+        return conn
+
+    def release_scoped(self):
+        """Hands the current thread's connection back to the pool."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._n_open -= len(idle)
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self):
+        with self._cond:
+            return {"open": self._n_open, "idle": len(self._idle),
+                    "max": self.maxconn}
+
+
+def get_pool(config_file=DEFAULT_CONFIG_PATH, **kwargs):
+    """Returns the process-wide connection pool, creating it if needed."""
+    global _pool
+    with _pool_lock:
+        if not _pool:
+            creds = get_db_credentials(config_file)
+            _pool = ConnectionPool(creds, **kwargs)
+    return _pool
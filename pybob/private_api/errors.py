@@ -0,0 +1,5 @@
+"""Exceptions shared by BobApi and AsyncBobApi."""
+
+
+class InvalidOperationException(Exception):
+    pass
@@ -0,0 +1,204 @@
+"""Per-method call counts and latencies for BobApi.
+
+Every public BobApi method is wrapped with metrics.instrument, or, for
+those that stream rows, has its stream wrapped with metrics.stream. While
+recording is off the wrapper is a single attribute check; turn it on by
+setting BOB_QUERY_METRICS in the environment or calling metrics.enable().
+
+For each method we keep the number of calls, errors and rows returned, the
+total and worst latency, and a histogram over LATENCY_BUCKETS_MS. The
+public API serves snapshot() as JSON, and start_reporter() logs summary()
+every so often.
+"""
+
+import bisect
+import functools
+import os
+import sys
+import threading
+import time
+
+
+# Upper bounds, in ms, of the histogram buckets; the last bucket is open.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+DEFAULT_REPORT_INTERVAL_S = 300
+
+
+def log(*args):
+    sys.stderr.write(" ".join([str(x) for x in args]))
+    sys.stderr.write("\n")
+
+
+def count_rows(result):
+    """Best guess at how many rows a BobApi method handed back."""
+    if result is None:
+        return 0
+    if isinstance(result, (bool, int, float)):
+        return None
+    if isinstance(result, list):
+        return len(result)
+    rowcount = getattr(result, 'rowcount', None)
+    if rowcount is not None:
+        return max(rowcount, 0)
+    return 1
+
+
+class MethodStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, elapsed_ms, rows, error):
+        self.calls += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        if error:
+            self.errors += 1
+        if rows:
+            self.rows += rows
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "rows": self.rows,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.calls, 3),
+            "max_ms": round(self.max_ms, 3),
+            "histogram": self.histogram[:],
+        }
+
+
+class QueryMetrics(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.since = time.time()
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._reporter = None
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.since = time.time()
+
+    def record(self, name, elapsed_ms, rows=None, error=False):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = MethodStats()
+            stats.add(elapsed_ms, rows, error)
+
+    def note_error(self):
+        """Counts an error that the calling method caught and swallowed."""
+        if self.enabled:
+            self._local.error = True
+
+    def instrument(self, func):
+        """Decorator recording each call of func under its name."""
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+
+            # Methods call each other; keep the outer call's error flag.
+            outer_error = getattr(self._local, 'error', False)
+            self._local.error = False
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                self.record(
+                    name, (time.perf_counter() - start) * 1000, error=True)
+                raise
+            finally:
+                error = self._local.error
+                self._local.error = outer_error
+
+            self.record(name, (time.perf_counter() - start) * 1000,
+                        rows=count_rows(result), error=error)
+            return result
+
+        return wrapper
+
+    def stream(self, name, rows):
+        """Yields from the iterator rows, recording the whole iteration
+        under name once it's exhausted, fails or is closed; instrument()
+        would only time creating it."""
+        if not self.enabled:
+            yield from rows
+            return
+
+        start = time.perf_counter()
+        n_rows = 0
+        error = False
+        try:
+            for row in rows:
+                n_rows += 1
+                yield row
+        except Exception:
+            error = True
+            raise
+        finally:
+            # Closed early, rows still holds its cursor.
+            close = getattr(rows, 'close', None)
+            if close:
+                close()
+            self.record(name, (time.perf_counter() - start) * 1000,
+                        rows=n_rows, error=error)
+
+    def snapshot(self):
+        with self._lock:
+            methods = {name: stats.as_dict()
+                       for name, stats in self._stats.items()}
+        return {
+            "enabled": self.enabled,
+            "since": self.since,
+            "buckets_ms": list(LATENCY_BUCKETS_MS),
+            "methods": methods,
+        }
+
+    def summary(self):
+        methods = self.snapshot()["methods"]
+        lines = ["{} BobApi methods called in the last {:.0f}s".format(
+            len(methods), time.time() - self.since)]
+        for name, stats in sorted(methods.items(),
+                                  key=lambda x: -x[1]["total_ms"]):
+            lines.append(
+                "  {}: {} calls, {} errors, {} rows,"
+                " mean {:.1f} ms, max {:.1f} ms".format(
+                    name, stats["calls"], stats["errors"], stats["rows"],
+                    stats["mean_ms"], stats["max_ms"]))
+        return "\n".join(lines)
+
+    def _report_forever(self, interval_s):
+        while True:
+            time.sleep(interval_s)
+            if self.enabled:
+                log(self.summary())
+
+    def start_reporter(self, interval_s=DEFAULT_REPORT_INTERVAL_S):
+        """Logs summary() every interval_s seconds from a daemon thread."""
+        if self._reporter:
+            return
+        self._reporter = threading.Thread(
+            target=self._report_forever, args=(interval_s,), daemon=True)
+        self._reporter.start()
+
+
+metrics = QueryMetrics(enabled=bool(os.environ.get("BOB_QUERY_METRICS")))
@@ -0,0 +1,420 @@
+"""The SQL behind BobApi and AsyncBobApi.
+
+Kept apart from either class so that the blocking and the asyncio flavours
+of the API run exactly the same queries. Anything that has to be built per
+call has a function here returning (query, args).
+"""
+
+from private_api.statements import StatementRegistry
+
+
+# The queries on the login and purchase paths, prepared once per connection.
+statements = StatementRegistry()
+
+statements.register(
+    "bobapi_is_valid_userid",
+    "SELECT balance FROM users WHERE userid = $1",
+    ["integer"])
+
+statements.register(
+    "bobapi_get_balance",
+    "SELECT balance FROM users WHERE username = $1",
+    ["text"])
+
+statements.register(
+    "bobapi_get_userid",
+    "SELECT userid FROM users WHERE username = $1",
+    ["text"])
+
+statements.register(
+    "bobapi_get_user_from_barcode",
+    (" SELECT"
+     "  u.userid, username, nickname, balance"
+     " from users u inner join userbarcodes b"
+     "  on b.userid = u.userid"
+     " where"
+     "  barcode = $1"),
+    ["text"])
+
+statements.register(
+    "bobapi_buy_barcode",
+    """
+    WITH purchase AS (
+        INSERT INTO transactions (
+            userid, xactvalue, xacttype, barcode, source)
+        SELECT
+            d.userid,
+            -1 * d.price,
+            (case when d.price < 0 then 'ADD ' else 'BUY ' end)
+                || d.name,
+            d.barcode, $3
+        FROM dynamic_barcode_lookup d
+        WHERE
+            d.barcode = $2
+            AND d.userid = $1
+            AND EXISTS (SELECT 1 FROM users WHERE userid = $1)
+            AND EXISTS (SELECT 1 FROM products WHERE barcode = $2)
+        LIMIT 1
+        RETURNING *
+    ), new_balance AS (
+        UPDATE users u SET balance = u.balance + p.xactvalue
+        FROM purchase p
+        WHERE u.userid = p.userid
+        RETURNING u.balance
+    )
+    SELECT p.*, b.balance FROM purchase p, new_balance b
+    """,
+    ["integer", "text", "text"])
+
+
+IS_VALID_PRODUCT_BARCODE = ("SELECT name FROM products WHERE barcode = %s")
+
+# See admin/barcode_aliases.sql for the ranking.
+RESOLVE_BARCODE = """
+        SELECT kind, barcode, bulkid
+        FROM barcode_aliases
+        WHERE alias = %(alias)s
+            AND (%(kind)s::text IS NULL OR kind = %(kind)s)
+        ORDER BY rank, kind = 'bulkitem'
+        LIMIT 1
+        """
+
+DEPOSIT_BALANCE = ("UPDATE users SET balance = balance + %s WHERE userid = %s")
+DEPOSIT_TRANSACTION = ("INSERT INTO transactions"
+                       " (xacttime, userid, xactvalue, xacttype, source)"
+                       " VALUES"
+                       " (now(), %s, %s, %s, %s)")
+
+DAY_STATS = (
+    " SELECT"
+    "  count(*) as n_transactions,"
+    "  sum(case when xactvalue < 0 then 1 else 0 end) as n_purchases,"
+    "  sum(case when xactvalue < 0 then xactvalue else 0 end) as purchased,"
+    "  sum(case when xactvalue > 0 then 1 else 0 end) as n_deposits,"
+    "  sum(case when xactvalue > 0 then xactvalue else 0 end) as deposits,"
+    "  sum(xactvalue) as net"
+    " from transactions"
+    " where"
+    "  xacttime >= now() - interval '24 hours'"
+)
+
+DEPOSITED_CASH = (" SELECT"
+                  "  xactvalue::integer::text as value,"
+                  "  count(*) as n,"
+                  "  (count(*) * xactvalue) as total"
+                  " from transactions"
+                  " where"
+                  "  xactvalue >= 1"
+                  "  and xacttime > %s"
+                  "  and source = 'bob2k14.2'"
+                  "  and xacttype like 'ADD %% (cash)'"
+                  " group by xactvalue"
+                  " order by xactvalue")
+
+ADD_FINGERPRINT = (
+    "INSERT INTO fingerprints (userid, fp_data) VALUES(%s, %s)")
+
+FINGERPRINTS = ("SELECT * FROM fingerprints")
+
+LAST_TRANSACTION_ID = "SELECT max(id) AS last_id FROM transactions"
+
+LAST_SODA_EMPTY = (
+    " SELECT"
+    "     max(xacttime) as last_emptied"
+    " FROM transactions WHERE barcode = '482665976515'")
+
+# One series of window + 1 buckets per key; keys are bulkids, or a single
+# NULL key when selling by barcodes. Only transactions inside the window are
+# read, through the xacttime index, and each is bucketed once.
+SALES_STATS = """
+SELECT
+    k.bulkid,
+    s.t_ago,
+    s.step,
+    count(x.id) AS n_sold,
+    count(distinct x.userid) AS n_users
+FROM {keys} AS k(bulkid)
+    CROSS JOIN (
+        SELECT
+            t_ago,
+            date_trunc('{group_type}', now()) - t_ago * interval '1 {group_type}'
+                AS step
+        FROM generate_series(0, %(window_size)s) AS t_ago
+    ) s
+    LEFT OUTER JOIN (
+        SELECT
+            t.id,
+            t.userid,
+            p.bulkid,
+            date_part('{group_type}',
+                      date_trunc('{group_type}', now()) -
+                      date_trunc('{group_type}', t.xacttime))::integer
+                AS t_ago
+        FROM transactions t
+            INNER JOIN products p
+                ON t.barcode = p.barcode
+        WHERE
+            t.xacttime >= date_trunc('{group_type}', now())
+                          - %(window_size)s * interval '1 {group_type}'
+            AND {filter}
+    ) x
+    ON x.t_ago = s.t_ago AND {key_join}
+GROUP BY k.bulkid, s.t_ago, s.step
+ORDER BY k.bulkid, s.t_ago ASC
+"""
+
+DAILY_AGGREGATE_STATS = """
+        select
+            xacttime::date as date,
+            -1*sum(xactvalue) as revenue,
+            count(distinct userid) as n_users,
+            count(*) as n_transactions
+        from transactions
+        where
+            xactvalue < 0
+            and xacttime > current_date - interval '1 month'
+        group by xacttime::date
+        order by xacttime::date
+        """
+
+MONTH_TRANSACTIONS = """
+        SELECT t.barcode, t.userid, t.xacttime, t.xactvalue, p.bulkid
+        FROM transactions t LEFT OUTER JOIN products p ON p.barcode = t.barcode
+        WHERE xacttime > now() - interval '31 days'
+        ORDER BY xacttime ASC
+        """
+
+# Reads only hourly_transaction_totals (admin/hourly_rollup.sql); an hour
+# counts towards the average if it saw any transactions that day. "Today"
+# and "now" are in the rollup's time zone, as its dates and hours are.
+DAY_AVERAGE_DATA = """
+with local as (
+    select
+        (now() at time zone hourly_rollup_zone())::date as today,
+        extract(hour from now() at time zone hourly_rollup_zone())
+            as this_hour
+)
+select
+    s.hour,
+    case
+        when a.avg_sales is not null
+            then a.avg_sales
+        else 0
+            end as avg_sales,
+    case
+        when t.sales is not null then t.sales
+        when s.hour > (select this_hour from local) then null
+        else 0
+            end as today_sales,
+    case
+        when a.avg_deposits is not null
+            then a.avg_deposits
+        else 0
+            end as avg_deposits,
+    case
+        when t.deposits is not null then t.deposits
+        when s.hour > (select this_hour from local) then null
+        else 0
+            end as today_deposits
+
+from (
+        select generate_series(0, 23) as hour) s
+    left outer join (
+        select
+            hour,
+            sum(sales) / count(*) as avg_sales,
+            sum(deposits) / count(*) as avg_deposits
+        from hourly_transaction_totals, local
+        where
+            date >= today - 365
+            and date < today
+            and extract(dow from today) = extract(dow from date)
+            and n_transactions > 0
+        group by hour
+        ) a
+    on s.hour = a.hour
+    left outer join (
+        select hour, sales, deposits
+        from hourly_transaction_totals, local
+        where
+            date = today
+            and n_transactions > 0
+        ) t
+    on t.hour = s.hour
+order by hour
+"""
+
+DAY_TRANSACTIONS = """
+        SELECT *
+        FROM transactions
+        WHERE xacttime > current_date - interval '3 days'
+        ORDER BY xacttime ASC
+        """
+
+BULKITEM_FROM_BARCODE = """
+        SELECT *, 'bulkitem' as \"type\" FROM bulk_items WHERE bulkbarcode = %s
+        """
+
+BULKITEM_FROM_BULKID = """
+        SELECT *, 'bulkitem' as \"type\" FROM bulk_items WHERE bulkid = %s
+        """
+
+PRODUCT_FROM_BARCODE = """
+        SELECT *, 'product' as \"type\" FROM products WHERE barcode = %s
+        """
+
+BULKITEMS = (" SELECT"
+             "  *"
+             " FROM bulk_items"
+             " WHERE {conditions}")
+
+INVENTORY_STEPS = """
+SELECT * FROM (
+    SELECT xacttime AS date,
+           bulkid,
+           'sale' AS type,
+           -1 AS n
+    FROM transactions t INNER JOIN products p
+        ON p.barcode = t.barcode
+    WHERE xacttime > current_date - interval %s and bulkid is not null
+
+    UNION ALL
+
+    SELECT  date,
+            bulk_type_id AS bulkid,
+            'order' AS type,
+            quantity*number AS n
+    FROM order_items oi INNER JOIN orders o
+        ON o.id = oi.order_id
+    WHERE date > current_date - interval %s and bulk_type_id is not null
+
+    UNION ALL
+
+    SELECT  date,
+            bulkid,
+            'inventory' AS type,
+            units AS n
+    FROM inventory i
+    WHERE
+        date > current_date - interval %s
+        and bulkid is not null
+        and units is not null
+) s
+WHERE bulkid IN %s
+ORDER BY date ASC
+"""
+
+WALL_OF_SHAME = """
+SELECT
+    username,
+    nickname,
+    balance,
+    extract('days' from (now() - entered_wall)) as days_on_wall
+FROM users
+WHERE
+    (NOT disabled)
+    AND (last_purchase_time > now() - INTERVAL '6 months')
+    AND ((balance <= -5) OR (entered_wall < now() - interval '28 days'))
+ORDER BY balance ASC
+"""
+
+COLD_BREW_SOLD = (
+    "select count(*) from transactions"
+    " where barcode = '488348702402'"
+    " and xacttime >"
+    "  (select xacttime from transactions t"
+    "   where barcode in (select barcode from coldbrew_varieties)"
+    "   order by xacttime desc limit 1)")
+
+BUY_BARCODES = """
+            WITH scanned AS (
+                SELECT * FROM unnest(
+                    %(positions)s::integer[],
+                    %(ranks)s::integer[],
+                    %(candidates)s::text[]) AS s(pos, rank, barcode)
+            ), priced AS (
+                SELECT DISTINCT ON (s.pos) s.pos, d.barcode, d.price, d.name
+                FROM scanned s
+                    INNER JOIN dynamic_barcode_lookup d
+                        ON d.barcode = s.barcode AND d.userid = %(userid)s
+                    INNER JOIN products p
+                        ON p.barcode = s.barcode
+                ORDER BY s.pos, s.rank
+            ), purchase AS (
+                INSERT INTO transactions (
+                    userid, xactvalue, xacttype, barcode, source)
+                SELECT
+                    %(userid)s,
+                    -1 * price,
+                    (case when price < 0 then 'ADD ' else 'BUY ' end)
+                        || name,
+                    barcode, %(source)s
+                FROM priced
+                WHERE
+                    (SELECT count(*) FROM priced) = %(n_items)s
+                    AND EXISTS (
+                        SELECT 1 FROM users WHERE userid = %(userid)s)
+                ORDER BY pos
+                RETURNING *
+            ), new_balance AS (
+                UPDATE users u SET balance = u.balance + s.total
+                FROM (SELECT sum(xactvalue) AS total FROM purchase) s
+                WHERE u.userid = %(userid)s AND s.total IS NOT NULL
+                RETURNING u.balance
+            )
+            SELECT p.*, b.balance FROM purchase p, new_balance b
+            ORDER BY p.id
+        """
+
+
+def sales_stats(bulkid=None, barcodes=None, window=14, agg='day',
+                bulkids=None):
+    if bulkid:
+        bulkids = [bulkid]
+    assert(bulkids or barcodes)
+
+    assert(agg in {'day'})
+    #{'hour', 'minute', 'month', 'day'})
+
+    args = {'window_size': window}
+    if bulkids:
+        args['bulkids'] = list(bulkids)
+        keys = "unnest(%(bulkids)s::integer[])"
+        filter = "p.bulkid = ANY(%(bulkids)s)"
+        key_join = "x.bulkid = k.bulkid"
+    else:
+        args['barcodes'] = list(barcodes)
+        keys = "(SELECT NULL::integer)"
+        filter = "t.barcode = ANY(%(barcodes)s)"
+        key_join = "true"
+
+    query = SALES_STATS.format(
+        keys=keys, filter=filter, key_join=key_join, group_type=agg)
+    return query, args
+
+
+def bulkitems(active=None, bulkid=None):
+    conditions = ["true"]
+    args = {}
+    if active is not None:
+        conditions.append("active = %(active)s")
+        args['active'] = active
+    if bulkid:
+        conditions.append("bulkid = %(bulkid)s")
+        args['bulkid'] = bulkid
+
+    return BULKITEMS.format(conditions=" AND ".join(conditions)), args
+
+
+def buy_barcodes(userid, barcodes, source, variants):
+    """Spreads each barcode over its variants(), ranked by preference."""
+    positions, ranks, candidates = [], [], []
+    for pos, barcode in enumerate(barcodes):
+        for rank, variant in enumerate(variants(barcode)):
+            positions.append(pos)
+            ranks.append(rank)
+            candidates.append(variant)
+
+    return BUY_BARCODES, {
+        'userid': userid, 'source': source, 'n_items': len(barcodes),
+        'positions': positions, 'ranks': ranks, 'candidates': candidates}
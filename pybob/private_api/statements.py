@@ -0,0 +1,97 @@
+"""Server-side prepared statements for the hottest queries.
+
+Statements are registered once, with $n placeholders, and PREPAREd lazily
+the first time they're run on each connection. After that we only send
+EXECUTE, so Postgres can skip parsing and, once it settles on a generic
+plan, planning too.
+
+A prepared statement lives as long as the backend it was prepared on. A new
+connection object starts with nothing prepared. If the server forgets a
+statement anyway (e.g. DISCARD ALL), we re-prepare and retry once,
+provided no transaction was in progress.
+"""
+
+import threading
+import weakref
+
+import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+
+
+class StatementRegistry(object):
+    def __init__(self):
+        self._statements = {}
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def register(self, name, query, argtypes=()):
+        """Registers query (using $1, $2, ...) under name."""
+        assert(name not in self._statements)
+        self._statements[name] = (query, tuple(argtypes))
+
+    def _prepared_on(self, conn):
+        with self._lock:
+            return self._prepared.setdefault(conn, set())
+
+    def _prepare_sql(self, name):
+        query, argtypes = self._statements[name]
+        types = "({})".format(", ".join(argtypes)) if argtypes else ""
+        return "PREPARE {}{} AS {}".format(name, types, query)
+
+    def _execute_sql(self, name, args):
+        statement = "EXECUTE {}".format(name)
+        if args:
+            statement += " ({})".format(", ".join(["%s"] * len(args)))
+        return statement
+
+    def _is_retryable(self, error, was_idle):
+        return (was_idle and error.pgcode ==
+                psycopg2.errorcodes.INVALID_SQL_STATEMENT_NAME)
+
+    def forget(self, conn):
+        """Drops our record of what's prepared on conn."""
+        self._prepared_on(conn).clear()
+
+    def execute(self, cursor, name, args=()):
+        """Runs the statement registered as name on cursor."""
+        conn = cursor.connection
+        was_idle = (conn.get_transaction_status() ==
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+        if name not in self._prepared_on(conn):
+            cursor.execute(self._prepare_sql(name))
+            self._prepared_on(conn).add(name)
+
+        try:
+            cursor.execute(self._execute_sql(name, args), args)
+        except psycopg2.Error as e:
+            if not self._is_retryable(e, was_idle):
+                raise
+            conn.rollback()
+            self.forget(conn)
+            cursor.execute(self._prepare_sql(name))
+            self._prepared_on(conn).add(name)
+            cursor.execute(self._execute_sql(name, args), args)
+        return cursor
+
+    async def execute_async(self, cursor, conn, name, args=()):
+        """Like execute(), for an aiopg cursor on the psycopg2 connection
+        conn. aiopg connections are always in autocommit mode."""
+        was_idle = (conn.get_transaction_status() ==
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+        if name not in self._prepared_on(conn):
+            await cursor.execute(self._prepare_sql(name))
+            self._prepared_on(conn).add(name)
+
+        try:
+            await cursor.execute(self._execute_sql(name, args), args)
+        except psycopg2.Error as e:
+            if not self._is_retryable(e, was_idle):
+                raise
+            self.forget(conn)
+            await cursor.execute(self._prepare_sql(name))
+            self._prepared_on(conn).add(name)
+            await cursor.execute(self._execute_sql(name, args), args)
+        return cursor
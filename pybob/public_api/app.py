@@ -1,15 +1,36 @@
+"""The public API WSGI app.
+
+Each blueprint is mounted under its prefix but only imported, along with
+everything it pulls in, on the first request to that prefix. Database
+connections are likewise opened on first use, so a worker comes up without
+touching the database; benchmarks/import_time.py keeps an eye on how long
+importing this module takes.
+"""
+
+import decimal
+import importlib
+import os
+import threading
 
 from flask import Flask
 from flask.json import JSONEncoder
 
-from . import slack_commands
-from . import slack_events
-from . import userauth
-from . import purchasing
-from . import easy_inventory
-from . import stats
+try:
+    from werkzeug.middleware.dispatcher import DispatcherMiddleware
+except ImportError:
+    from werkzeug.wsgi import DispatcherMiddleware
 
-import decimal
+from private_api.metrics import metrics, DEFAULT_REPORT_INTERVAL_S
+
+
+BLUEPRINT_PREFIXES = [
+    ('/slack_commands', 'slack_commands'),
+    ('/userauth', 'userauth'),
+    ('/buy', 'purchasing'),
+    ('/easy_inventory', 'easy_inventory'),
+    ('/stats', 'stats'),
+    ('/slack_events', 'slack_events'),
+]
 
 
 class DecimalFriendlyJSONEncoder(JSONEncoder):
@@ -19,13 +40,50 @@ class DecimalFriendlyJSONEncoder(JSONEncoder):
         return super().default(obj)
 
 
+def _make_app(name):
+    new_app = Flask(name)
+    new_app.json_encoder = DecimalFriendlyJSONEncoder
+
+    @new_app.teardown_request
+    def _release_db_conn(exc):
+        from private_api.bob_api import bobapi
+        bobapi.release()
+
+    return new_app
+
+
+class LazyBlueprintApp(object):
+    """A WSGI app serving one blueprint module, imported on first call."""
+
+    def __init__(self, module_name):
+        self.module_name = module_name
+        self._app = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._app is None:
+                module = importlib.import_module(
+                    "{}.{}".format(__package__, self.module_name))
+                sub_app = _make_app(module.__name__)
+                sub_app.register_blueprint(module.blueprint)
+                self._app = sub_app
+        return self._app
+
+    def __call__(self, environ, start_response):
+        sub_app = self._app or self._load()
+        return sub_app(environ, start_response)
+
+
+# Requests that reach this app matched no blueprint, so it never needs the
+# database.
 app = Flask(__name__)
 app.json_encoder = DecimalFriendlyJSONEncoder
+app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {
+    prefix: LazyBlueprintApp(module_name)
+    for prefix, module_name in BLUEPRINT_PREFIXES})
 
 
-app.register_blueprint(slack_commands.blueprint, url_prefix='/slack_commands')
-app.register_blueprint(userauth.blueprint, url_prefix='/userauth')
-app.register_blueprint(purchasing.blueprint, url_prefix='/buy')
-app.register_blueprint(easy_inventory.blueprint, url_prefix='/easy_inventory')
-app.register_blueprint(stats.blueprint, url_prefix='/stats')
-app.register_blueprint(slack_events.blueprint, url_prefix='/slack_events')
+if metrics.enabled:
+    metrics.start_reporter(int(os.environ.get(
+        "BOB_QUERY_METRICS_INTERVAL_S", DEFAULT_REPORT_INTERVAL_S)))
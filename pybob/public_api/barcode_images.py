@@ -0,0 +1,177 @@
+"""Rendered barcode images, cached in memory and on disk.
+
+Rendering a barcode means running zint, so we only ever do it once per
+(data, symbology, height). Images are stored under IMAGE_CACHE_DIR, named
+by a digest of that key, and the most recent ones are also kept in memory.
+
+render_many() renders all of its misses with one zint --batch run per
+symbology, rather than one process per barcode.
+"""
+
+import base64
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+import traceback
+
+from sh import zint
+
+
+IMAGE_CACHE_DIR = os.environ.get(
+    "CHEZBOB_BARCODE_CACHE_DIR", "/tmp/chezbob-barcodes")
+
+DEFAULT_HEIGHT = 25
+DEFAULT_MEMORY_ENTRIES = 1024
+
+# zint symbology ids.
+UPC_A = 34
+UPC_E = 37
+CODE_128 = 20
+
+
+def symbology_for(barcode):
+    """Returns what to draw barcode as: (zint symbology, data to encode)."""
+    data = (
+        barcode[:-1] if (len(barcode) == 12 or len(barcode) == 13)
+        else barcode)
+    typ = (UPC_A if len(barcode) == 12
+           else UPC_E if len(barcode) == 6
+           else CODE_128)
+    return typ, data
+
+
+class BarcodeImageCache(object):
+    def __init__(self, cache_dir=IMAGE_CACHE_DIR,
+                 max_memory_entries=DEFAULT_MEMORY_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.renders = 0
+        self.zint_runs = 0
+
+    def _path(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".png")
+
+    def _remember(self, key, png):
+        with self._lock:
+            self._memory[key] = png
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def _lookup(self, key):
+        with self._lock:
+            png = self._memory.get(key)
+            if png is not None:
+                self.hits += 1
+                self._memory.move_to_end(key)
+                return png
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                png = f.read()
+        except OSError:
+            return None
+
+        self.disk_hits += 1
+        self._remember(key, png)
+        return png
+
+    def _store(self, key, png):
+        self._remember(key, png)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(png)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            traceback.print_exc()
+
+    def _render_one(self, typ, height, data):
+        self.zint_runs += 1
+        return zint("--directpng", "--height={}".format(height),
+                    "-b", typ, "-d", data).stdout
+
+    def _render_batch(self, typ, height, datas):
+        """Renders datas with a single zint run; returns PNGs in order."""
+        self.zint_runs += 1
+        with tempfile.TemporaryDirectory() as tmp:
+            infile = os.path.join(tmp, "input.txt")
+            with open(infile, 'w') as f:
+                f.write("\n".join(datas) + "\n")
+            # zint numbers batch output by replacing the ~s with the line.
+            zint("--batch", "--height={}".format(height), "-b", typ,
+                 "-i", infile, "-o", os.path.join(tmp, "~~~~~.png"))
+
+            pngs = []
+            for i in range(len(datas)):
+                path = os.path.join(tmp, "{:05d}.png".format(i + 1))
+                with open(path, 'rb') as f:
+                    pngs.append(f.read())
+            return pngs
+
+    def render_many(self, barcodes, height=DEFAULT_HEIGHT):
+        """Returns {barcode: base64 PNG}; "" for any that won't render."""
+        pngs = {}
+        misses = collections.defaultdict(list)
+        for barcode in set(barcodes):
+            typ, data = symbology_for(barcode)
+            key = (data, typ, height)
+            png = self._lookup(key)
+            if png is not None:
+                pngs[barcode] = png
+            else:
+                misses[typ].append((barcode, data, key))
+
+        for typ, items in misses.items():
+            try:
+                rendered = self._render_batch(
+                    typ, height, [data for _, data, _ in items])
+            except Exception:
+                # One bad barcode fails the whole batch; go one by one.
+                traceback.print_exc()
+                rendered = []
+                for _, data, _ in items:
+                    try:
+                        rendered.append(self._render_one(typ, height, data))
+                    except Exception:
+                        rendered.append(None)
+
+            for (barcode, _, key), png in zip(items, rendered):
+                if png:
+                    self.renders += 1
+                    self._store(key, png)
+                    pngs[barcode] = png
+                else:
+                    # Don't retry it on every page load; only until restart.
+                    self._remember(key, b"")
+
+        return {
+            barcode: base64.b64encode(pngs.get(barcode, b"")).decode('utf-8')
+            for barcode in barcodes}
+
+    def render(self, barcode, height=DEFAULT_HEIGHT):
+        return self.render_many([barcode], height)[barcode]
+
+    def stats(self):
+        with self._lock:
+            memory_entries = len(self._memory)
+        return {
+            "memory_entries": memory_entries,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "renders": self.renders,
+            "zint_runs": self.zint_runs,
+        }
+
+
+barcode_images = BarcodeImageCache()
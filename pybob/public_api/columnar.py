@@ -0,0 +1,34 @@
+"""Columnar encoding of query results, for the dashboard's larger payloads.
+
+Repeating the keys of every row costs more than the values themselves, so
+rows are sent as one list per column instead.
+"""
+
+
+def to_columnar(rows, columns, dictionary_columns=()):
+    """Turns rows (dicts) into one list per column.
+
+    Values of dictionary_columns are replaced by their index in
+    result['dictionaries'][column], which lists each distinct value once.
+    """
+    result = {
+        "format": "columnar",
+        "length": 0,
+        "columns": {c: [] for c in columns},
+        "dictionaries": {c: [] for c in dictionary_columns},
+    }
+    indexes = {c: {} for c in dictionary_columns}
+
+    for row in rows:
+        result["length"] += 1
+        for c in columns:
+            value = row[c]
+            if c in indexes:
+                index = indexes[c].get(value)
+                if index is None:
+                    index = indexes[c][value] = len(indexes[c])
+                    result["dictionaries"][c].append(value)
+                value = index
+            result["columns"][c].append(value)
+
+    return result
@@ -8,8 +8,7 @@ from private_api.bob_api import bobapi
 
 from jinja2 import Environment, FileSystemLoader
 
-from sh import zint
-import base64
+from .barcode_images import barcode_images
 
 TEMPLATE_DIR = "/git/pybob/public_api/templates"
 EASY_INVENTORY_TEMPLATE = "easy_inventory.html"
@@ -17,83 +16,8 @@ EASY_INVENTORY_TEMPLATE = "easy_inventory.html"
 
 blueprint = Blueprint('easy_inventory', __name__)
 
-api = bobapi.db
-
-# What was the MOST RECENT inventory for each item?
-LAST_INVENTORY_VIEW = """
-create or replace temporary view last_inventory as
-select date, bulkid, units from (
-        SELECT
-            date,
-            bulkid,
-            units,
-            rank() over (partition by bulkid order by date desc) as r
-        from inventory
-        where bulkid in (select bulkid from bulk_items where active)
-        ) s1
-where r = 1
-"""
-
-# Represents how many of an item we've purchased since the last inventory of it
-RECENT_ORDERS_VIEW = """
-create or replace temporary view recent_orders as
-select min(order_date) as since, bulkid, sum(units) as units
-from (
-    select
-        o.date as order_date,
-        li.date AS last_inventoried,
-        quantity*number as units,
-        bulk_type_id as bulkid
-    from orders o
-        inner join order_items oi
-            on oi.order_id = o.id
-        left outer join last_inventory li
-        on bulk_type_id = bulkid
-    ) s1
-where (case
-        when last_inventoried is null then true
-        else order_date > last_inventoried end)
-group by bulkid
-"""
-
-# Represents how many of an item we've sold since the most recent inventory
-RECENT_SALES_VIEW = """
-create or replace temporary view recent_sales as
-select min(date) as since, max(date) as most_recent, bulkid, count(*) as units
-from (
-    select
-        xacttime as date,
-        li.date AS last_inventoried,
-        p.bulkid
-    from transactions t
-        inner join products p
-            on p.barcode = t.barcode
-        left outer join last_inventory li
-        on li.bulkid = p.bulkid
-    ) s1
-where ( case
-    when last_inventoried is null then true
-    else date > last_inventoried end)
-group by bulkid
-"""
-
-CURRENT_INVENTORY_VIEW = """
-create or replace temporary view current_inventory as
-select
-    i.date,
-    (case when i.bulkid is null then s.bulkid else i.bulkid end) as bulkid,
-    (case when i.units is null then 0 else i.units end)
-        + (case when o.units is null then 0 else o.units end)
-        - (case when s.units is null then 0 else s.units end)
-        AS remaining,
-    s.most_recent as most_recent_sale
-    from last_inventory i
-        full outer join recent_sales s on s.bulkid = i.bulkid
-        left outer join recent_orders o on o.bulkid =
-            (case when i.bulkid is null then s.bulkid else i.bulkid end)
-    order by remaining asc
-"""
-
+# current_inventory is a view over inventory_state, which triggers keep up to
+# date; see admin/current_inventory.sql.
 LOW_QUERY = """
 select ci.bulkid,
        remaining,
@@ -156,19 +80,27 @@ def get_product_bc(bulkid):
         return None
 
 
-def _get_barcode_img(barcode):
-    subbar = (
-        barcode[:-1] if (len(barcode) == 12 or len(barcode) == 13)
-        else barcode)
-    typ = 34 if len(barcode) == 12 else 37 if len(barcode) == 6 else 20
-    try:
-        img = (
-            base64.b64encode(zint(
-                "--directpng", "--height=25",
-                "-b", typ, "-d", subbar).stdout).decode('utf-8'))
-    except:
-        img = ""
-    return img
+def _add_barcode_imgs(to_inventory):
+    """Fills in each row's barcode_img, rendering them all in one batch."""
+    barcodes = {}
+    for row in to_inventory:
+        barcodes[row['bulkid']] = (
+            row['bulkbarcode'] if row['bulkbarcode']
+            else get_product_bc(row['bulkid']))
+
+    imgs = barcode_images.render_many([bc for bc in barcodes.values() if bc])
+
+    for row in to_inventory:
+        barcode = barcodes[row['bulkid']]
+        if not barcode:
+            log("Error in:", row)
+            continue
+
+        row['barcode_img'] = imgs[barcode]
+        if row['inventoried']:
+            row['inventoried'] = row['inventoried'].strftime("%y-%m-%d")
+
+        row['description'] = row['description'][:row['description'].find(" (")]
 
 
 @blueprint.route('/all_low', methods=['GET'])
@@ -178,28 +110,10 @@ def _get_all_low_sheet():
     template = env.get_template(EASY_INVENTORY_TEMPLATE)
 
     cursor = bobapi._get_cursor()
-    cursor.execute(LAST_INVENTORY_VIEW)
-    cursor.execute(RECENT_ORDERS_VIEW)
-    cursor.execute(RECENT_SALES_VIEW)
-    cursor.execute(CURRENT_INVENTORY_VIEW)
     cursor.execute(LOW_QUERY)
 
     to_inventory = [dict(x) for x in cursor.fetchall()]
-    for row in to_inventory:
-        barcode = (
-            row['bulkbarcode'] if row['bulkbarcode']
-            else get_product_bc(row['bulkid']))
-        if not barcode:
-            log("Error in:", row)
-            continue
-
-        barcode_img = _get_barcode_img(barcode)
-
-        row['barcode_img'] = barcode_img
-        if row['inventoried']:
-            row['inventoried'] = row['inventoried'].strftime("%y-%m-%d")
-
-        row['description'] = row['description'][:row['description'].find(" (")]
+    _add_barcode_imgs(to_inventory)
 
     return template.render(to_inventory=to_inventory, title="Low Inventory")
 
@@ -211,28 +125,10 @@ def _get_cheat_sheet():
     template = env.get_template(EASY_INVENTORY_TEMPLATE)
 
     cursor = bobapi._get_cursor()
-    cursor.execute(LAST_INVENTORY_VIEW)
-    cursor.execute(RECENT_ORDERS_VIEW)
-    cursor.execute(RECENT_SALES_VIEW)
-    cursor.execute(CURRENT_INVENTORY_VIEW)
     cursor.execute(QUERY)
 
     to_inventory = [dict(x) for x in cursor.fetchall()]
-    for row in to_inventory:
-        barcode = (
-            row['bulkbarcode'] if row['bulkbarcode']
-            else get_product_bc(row['bulkid']))
-        if not barcode:
-            log("Error in:", row)
-            continue
-
-        barcode_img = _get_barcode_img(barcode)
-
-        row['barcode_img'] = barcode_img
-        if row['inventoried']:
-            row['inventoried'] = row['inventoried'].strftime("%y-%m-%d")
-
-        row['description'] = row['description'][:row['description'].find(" (")]
+    _add_barcode_imgs(to_inventory)
 
     return template.render(to_inventory=to_inventory, title="Easy Inventory")
 
@@ -241,10 +137,6 @@ def _get_cheat_sheet():
 @cross_origin()
 def _get_json():
     cursor = bobapi._get_cursor()
-    cursor.execute(LAST_INVENTORY_VIEW)
-    cursor.execute(RECENT_ORDERS_VIEW)
-    cursor.execute(RECENT_SALES_VIEW)
-    cursor.execute(CURRENT_INVENTORY_VIEW)
     cursor.execute(QUERY)
 
     to_inventory = [dict(x) for x in cursor.fetchall()]
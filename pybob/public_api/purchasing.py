@@ -5,6 +5,7 @@ from flask import Blueprint, jsonify, request
 from flask_cors import cross_origin
 
 from private_api.bob_api import bobapi, InvalidOperationException
+from private_api.catalog import MISS
 from .userauth import decodetoken
 
 
@@ -13,6 +14,8 @@ blueprint = Blueprint('purchasing', __name__)
 
 ACCEPTABLE_SOURCES = ['elektra', 'mobile', 'web']
 
+MAX_BASKET_SIZE = 50
+
 """
 >>> token = jwt.encode({'key': 'value'}, JWT_SECRET, algorithm=JWT_ALGO)
 >>> data = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO])
@@ -46,20 +49,61 @@ def _purchase_by_barcode():
 
 
 def _purchase_by_barcode_unwrapped(barcode, userid, source):
+    # Pick the scanned form the catalog knows about up front, rather than
+    # finding out through a failed purchase. Without the catalog, that
+    # would be an extra query; the basket purchase tries each form itself.
+    product = MISS
+    if bobapi.catalog:
+        product = bobapi.catalog.resolve(barcode, kind='product')
+    if product and product is not MISS and product['barcode'] != barcode:
+        log("Buying {} as known barcode {}".format(
+            barcode, product['barcode']))
+        barcode = product['barcode']
+
     try:
-        new_row = bobapi.buy_barcode(userid, barcode, source=source)
+        if product is MISS:
+            result = bobapi.buy_barcodes(userid, [barcode], source=source)
+            new_row = result['transactions'][0]
+            new_row['balance'] = result['balance']
+        else:
+            new_row = bobapi.buy_barcode(userid, barcode, source=source)
 
     except InvalidOperationException as e:
-        if barcode.startswith("0") and len(barcode) == 13:
-            log("Retrying barcode check with EAN->UPCA: {}".format(barcode))
-            return _purchase_by_barcode_unwrapped(barcode[1:], userid, source)
+        return jsonify({"result": "error", "error": str(e)})
+
+    return jsonify({"result": "success", "transaction": new_row})
+
 
-        if barcode.startswith("0") and len(barcode) == 8:
-            log("Retrying barcode check with shorter UPC-E: {}".format(
-                barcode))
-            return _purchase_by_barcode_unwrapped(
-                barcode[1:-1], userid, source)
+@blueprint.route('/by_barcodes', methods=['POST'])
+@cross_origin()
+def _purchase_by_barcodes():
+    """Buys a basket of comma separated barcodes in one transaction."""
+    token = request.form.get('token', None)
+    barcodes = request.form.get('barcodes', None)
+    source = request.form.get('source', "elektra")
+    if not token or not barcodes:
+        return jsonify({"result": "error",
+                        "error": "Token and barcodes required"})
+
+    barcodes = [bc.strip() for bc in barcodes.split(",") if bc.strip()]
+    if not barcodes or len(barcodes) > MAX_BASKET_SIZE:
+        return jsonify({"result": "error",
+                        "error": "Between 1 and {} barcodes required".format(
+                            MAX_BASKET_SIZE)})
 
+    if source not in ACCEPTABLE_SOURCES:
+        return jsonify({"result": "error",
+                        "error": "Invalid source"})
+
+    decoded = decodetoken(token)
+    if decoded is None:
+        return jsonify({"result": "error", "error": "Invalid token"})
+
+    try:
+        purchase = bobapi.buy_barcodes(decoded['uid'], barcodes, source=source)
+    except InvalidOperationException as e:
         return jsonify({"result": "error", "error": str(e)})
 
-    return jsonify({"result": "success", "transaction": new_row})
+    return jsonify({"result": "success",
+                    "transactions": purchase['transactions'],
+                    "balance": purchase['balance']})
@@ -0,0 +1,159 @@
+"""A small TTL cache for the dashboard's stats responses.
+
+Every open dashboard polls the same handful of endpoints, so we keep each
+result for a few seconds to minutes, depending on the endpoint.
+
+- While an entry is fresh it's served as is.
+- Entries may carry a change marker (stats.py uses the newest transaction
+  id); one computed under a different marker than the request's is stale,
+  however young.
+- Once it goes stale it's still served, for up to max_stale_s, while one
+  background thread recomputes it.
+- On a miss, the first request computes the value and any identical
+  requests that arrive meanwhile wait for its result instead of running
+  the query again.
+
+Errors are never cached; they propagate to the request that computed and to
+everyone waiting on it.
+"""
+
+import collections
+import threading
+import time
+import traceback
+
+
+DEFAULT_MAX_ENTRIES = 256
+
+# How long past its TTL an entry may still be served while it's refreshed.
+DEFAULT_MAX_STALE_S = 300
+
+
+class _Entry(object):
+    def __init__(self, value, fetched_at, marker):
+        self.value = value
+        self.fetched_at = fetched_at
+        self.marker = marker
+
+
+class _Flight(object):
+    def __init__(self, marker):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.marker = marker
+
+
+class ResponseCache(object):
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_stale_s=DEFAULT_MAX_STALE_S):
+        self.max_entries = max_entries
+        self.max_stale_s = max_stale_s
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._flights = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.refresh_ms_total = 0.0
+        self.refresh_ms_max = 0.0
+
+    def get(self, key, ttl, compute, marker=None):
+        """Returns the value cached under key, calling compute() to fill or
+        refresh it once it's older than ttl seconds or was computed under
+        another marker."""
+        return self.lookup(key, ttl, compute, marker)[0]
+
+    def lookup(self, key, ttl, compute, marker=None):
+        """Like get, but returns (value, the marker it was computed under),
+        which differs from marker when a stale value is served."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            age = now - entry.fetched_at if entry else None
+
+            if entry and age < ttl and entry.marker == marker:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry.value, entry.marker
+
+            if entry and age < ttl + self.max_stale_s:
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                if key not in self._flights:
+                    flight = self._flights[key] = _Flight(marker)
+                    threading.Thread(
+                        target=self._refresh, args=(key, compute, flight),
+                        daemon=True).start()
+                return entry.value, entry.marker
+
+            flight = self._flights.get(key)
+            if flight:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.misses += 1
+                flight = self._flights[key] = _Flight(marker)
+                leader = True
+
+        if leader:
+            self._refresh(key, compute, flight)
+        else:
+            flight.done.wait()
+
+        if flight.error:
+            raise flight.error
+        return flight.value, flight.marker
+
+    def _refresh(self, key, compute, flight):
+        start = time.perf_counter()
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            traceback.print_exc()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            self.refreshes += 1
+            self.refresh_ms_total += elapsed_ms
+            self.refresh_ms_max = max(self.refresh_ms_max, elapsed_ms)
+            if flight.error:
+                self.refresh_errors += 1
+            else:
+                self._entries[key] = _Entry(
+                    flight.value, time.time(), flight.marker)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            del self._flights[key]
+
+        flight.done.set()
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": ((self.hits + self.stale_hits) / lookups
+                             if lookups else None),
+                "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors,
+                "refresh_ms_mean": (self.refresh_ms_total / self.refreshes
+                                    if self.refreshes else None),
+                "refresh_ms_max": self.refresh_ms_max,
+            }
@@ -2,18 +2,59 @@
 
 """
 
+import functools
 import hashlib
 import random
 import string
+import time
 
-from flask import Blueprint, jsonify
+from flask import (
+    Blueprint, Response, g, jsonify, json, make_response, request,
+    stream_with_context)
 from flask_cors import cross_origin
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from private_api.bob_api import bobapi
+from private_api.metrics import metrics
+
+from .columnar import to_columnar
+from .response_cache import ResponseCache
 
 
 blueprint = Blueprint('dashboard', __name__)
 
+# Rows encoded per chunk of a streamed response.
+STREAM_CHUNK_ROWS = 500
+
+# How long, in seconds, each endpoint's results are cached for.
+DAY_STATS_TTL_S = 10
+HOURLY_STATS_TTL_S = 60
+AGGREGATE_SALES_TTL_S = 300
+BULKITEMS_TTL_S = 300
+PRODUCT_STATS_TTL_S = 120
+
+response_cache = ResponseCache()
+
+# The columnar form of get_month_transactions; barcodes and userids are sent
+# as indexes into a list of the distinct values.
+MONTH_TRANSACTION_COLUMNS = (
+    'barcode', 'bulkid', 'xacttime_e', 'xactvalue', 'userid')
+MONTH_TRANSACTION_DICTIONARY_COLUMNS = ('barcode', 'userid')
+
+# Limits on the batch endpoints, so one call can't grow without bound.
+MAX_BATCH_BULKIDS = 50
+MAX_SALES_STATS_WINDOW = 365
+MAX_INVENTORY_STEPS_WINDOW = 90
+
+# ETags also roll over this often, so results over windows relative to now()
+# don't stay cached forever when nothing is bought.
+ETAG_PERIOD_S = 3600
+DAY_STATS_ETAG_PERIOD_S = 60
+
 
 def fix_decimals(x):
     return x
@@ -25,29 +66,84 @@ def anonymize(inp):
     return h.hexdigest()
 
 
+def etagged(period_s=ETAG_PERIOD_S):
+    """Adds an ETag derived from the newest transaction id, the request and
+    the current period, and answers a matching If-None-Match with a 304
+    without running the view.
+
+    Only for views whose results are computed from the transactions table.
+    Edits to existing transactions don't change the tag.
+
+    The marker also decides whether response_cache's entry is fresh; when
+    a stale one is served, it's tagged with the marker it was computed
+    under, so the client asks again once the refresh has landed.
+    """
+    def make_etag(marker):
+        h = hashlib.sha1()
+        h.update(repr((
+            request.endpoint, sorted((request.view_args or {}).items()),
+            request.query_string, marker, int(time.time() // period_s),
+        )).encode('utf-8'))
+        return h.hexdigest()
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                marker = bobapi.get_last_transaction_id()
+            except:
+                import traceback
+                traceback.print_exc()
+                return view(*args, **kwargs)
+
+            g.change_marker = marker
+            etag = make_etag(marker)
+
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = view(*args, **kwargs)
+            if response is not None:
+                response = make_response(response)
+                served = g.get('served_marker', marker)
+                response.set_etag(
+                    etag if served == marker else make_etag(served))
+            return response
+
+        return wrapper
+    return decorator
+
+
 @blueprint.route('/v0.1/get_day_stats', methods=['GET'])
 @cross_origin()
+@etagged(DAY_STATS_ETAG_PERIOD_S)
 def get_day_stats():
-    return generic_wrapper(bobapi.get_day_stats, nolist=True)
+    return generic_wrapper(
+        bobapi.get_day_stats, nolist=True, ttl=DAY_STATS_TTL_S)
 
 
 @blueprint.route('/v0.1/get_hourly_stats', methods=['GET'])
 @cross_origin()
+@etagged()
 def get_hourly_stats():
-    return generic_wrapper(bobapi.get_day_average_data)
+    return generic_wrapper(
+        bobapi.get_day_average_data, ttl=HOURLY_STATS_TTL_S)
 
 
 @blueprint.route('/v0.1/bulkitem/getall', methods=['GET'])
 @cross_origin()
 def get_bulkitems():
-    return generic_wrapper(bobapi.get_bulkitems)
+    return generic_wrapper(bobapi.get_bulkitems, ttl=BULKITEMS_TTL_S)
 
 
 @blueprint.route('/v0.1/bulkitem/get_details/<int:bulkid>',
                  methods=['GET'])
 @cross_origin()
 def get_bulkitem(bulkid):
-    return generic_wrapper(bobapi.get_bulkitems, singleton=True, bulkid=bulkid)
+    return generic_wrapper(bobapi.get_bulkitems, singleton=True,
+                           ttl=BULKITEMS_TTL_S, bulkid=bulkid)
 
 
 @blueprint.route(
@@ -62,16 +158,17 @@ def get_inventory_steps(bulkid, window):
         x['date'] = str(x['date'])
         return x
 
-    if window < 0 or window > 90:
+    if window < 0 or window > MAX_INVENTORY_STEPS_WINDOW:
         return jsonify({"error": "Window is of invalid size."})
     return generic_wrapper(
-        bobapi.get_inventory_steps, repair_func=fix,
+        bobapi.get_inventory_steps, repair_func=fix, ttl=PRODUCT_STATS_TTL_S,
         bulkids=[bulkid], window='{} days'.format(window))
 
 
 @blueprint.route('/v0.1/sales/get_stats/<int:bulkid>/<int:window>',
                  methods=['GET'])
 @cross_origin()
+@etagged()
 def get_sales_stats(bulkid, window):
     def fix(x):
         # This stupid thing is because the json conversion of date types isn't
@@ -80,26 +177,86 @@ def get_sales_stats(bulkid, window):
         x['step'] = str(x['step'])
         return x
 
-    if window < 0 or window > 365:
+    if window < 0 or window > MAX_SALES_STATS_WINDOW:
         return jsonify({"error": "Window is of invalid size."})
     return generic_wrapper(
-        bobapi.get_sales_stats, repair_func=fix,
+        bobapi.get_sales_stats, repair_func=fix, ttl=PRODUCT_STATS_TTL_S,
         bulkid=bulkid, window=window, agg='day')
 
 
+def _batch_bulkids():
+    """Parses the bulkids=1,2,3 argument of a batch endpoint; returns the
+    sorted, distinct ids, or None if the list is missing or invalid."""
+    try:
+        bulkids = sorted(set(
+            int(x) for x in request.args.get('bulkids', '').split(',')))
+    except ValueError:
+        return None
+    if not bulkids or len(bulkids) > MAX_BATCH_BULKIDS:
+        return None
+    return bulkids
+
+
+@blueprint.route(
+    '/v0.1/sales/get_inventory_steps_batch/<int:window>', methods=['GET'])
+@cross_origin()
+def get_inventory_steps_batch(window):
+    """get_inventory_steps for up to MAX_BATCH_BULKIDS bulkids at once, in
+    one query; returns {bulkid: [steps]}."""
+    def fix(x):
+        x['date'] = str(x['date'])
+        return x
+
+    bulkids = _batch_bulkids()
+    if bulkids is None:
+        return jsonify({"error": "Give 1 to {} comma separated bulkids."
+                        .format(MAX_BATCH_BULKIDS)})
+    if window < 0 or window > MAX_INVENTORY_STEPS_WINDOW:
+        return jsonify({"error": "Window is of invalid size."})
+    return generic_wrapper(
+        bobapi.get_inventory_steps, repair_func=fix, ttl=PRODUCT_STATS_TTL_S,
+        group_by=('bulkid', bulkids),
+        bulkids=bulkids, window='{} days'.format(window))
+
+
+@blueprint.route('/v0.1/sales/get_stats_batch/<int:window>', methods=['GET'])
+@cross_origin()
+@etagged()
+def get_sales_stats_batch(window):
+    """get_sales_stats for up to MAX_BATCH_BULKIDS bulkids at once, in one
+    query; returns {bulkid: [daily stats]}."""
+    def fix(x):
+        x['step'] = str(x['step'])
+        return x
+
+    bulkids = _batch_bulkids()
+    if bulkids is None:
+        return jsonify({"error": "Give 1 to {} comma separated bulkids."
+                        .format(MAX_BATCH_BULKIDS)})
+    if window < 0 or window > MAX_SALES_STATS_WINDOW:
+        return jsonify({"error": "Window is of invalid size."})
+    return generic_wrapper(
+        bobapi.get_sales_stats, repair_func=fix, ttl=PRODUCT_STATS_TTL_S,
+        group_by=('bulkid', bulkids),
+        bulkids=bulkids, window=window, agg='day')
+
+
 @blueprint.route('/v0.1/sales/get_aggregate_sales', methods=['GET'])
 @cross_origin()
+@etagged()
 def get_aggregate_sales():
     def fix(x):
         x['date'] = str(x['date'])
         x['revenue'] = float(x['revenue'])
         return x
 
-    return generic_wrapper(bobapi.get_daily_aggregate_stats, repair_func=fix)
+    return generic_wrapper(bobapi.get_daily_aggregate_stats, repair_func=fix,
+                           ttl=AGGREGATE_SALES_TTL_S)
 
 
 @blueprint.route('/v0.1/sales/get_day_sales', methods=['GET'])
 @cross_origin()
+@etagged()
 def get_day_sales():
     rand = "".join([random.choice(string.printable) for x in range(32)])
 
@@ -115,11 +272,12 @@ def get_day_sales():
 
         return result
 
-    return generic_wrapper(bobapi.get_day_transactions, repair_func=strip)
+    return streaming_wrapper(bobapi.stream_day_transactions(), strip)
 
 
 @blueprint.route('/v0.1/sales/get_month_transactions', methods=['GET'])
 @cross_origin()
+@etagged()
 def get_month_transactions():
     rand = "".join([random.choice(string.printable) for x in range(32)])
 
@@ -138,52 +296,156 @@ def get_month_transactions():
 
         return result
 
-    return generic_wrapper(bobapi.get_month_transactions, repair_func=strip)
+    def strip_columnar(x):
+        return {
+            'barcode': x['barcode'],
+            'bulkid': x['bulkid'],
+            'xacttime_e': int(x['xacttime'].timestamp()),
+            'xactvalue': float(x['xactvalue']),
+            'userid': anonymize(str(x['userid']) + rand)[:5],
+        }
+
+    fmt = request.args.get('format', 'rows')
+    if fmt == 'columnar' or fmt == 'msgpack':
+        return columnar_wrapper(
+            bobapi.stream_month_transactions(), strip_columnar,
+            MONTH_TRANSACTION_COLUMNS, MONTH_TRANSACTION_DICTIONARY_COLUMNS,
+            use_msgpack=(fmt == 'msgpack'))
+
+    return streaming_wrapper(bobapi.stream_month_transactions(), strip)
+
+
+@blueprint.route('/v0.1/query_metrics', methods=['GET'])
+@cross_origin()
+def get_query_metrics():
+    return jsonify(metrics.snapshot())
+
+
+@blueprint.route('/v0.1/cache_stats', methods=['GET'])
+@cross_origin()
+def get_cache_stats():
+    return jsonify(response_cache.stats())
 
 
 @blueprint.route('/v0.1/details/scan_barcode/<string:bc>',
                  methods=['GET'])
 @cross_origin()
 def get_barcode_details(bc):
-    result = bobapi.get_product_from_barcode(bc)
-    if result:
-        if result['bulkid']:
+    alias = bobapi.resolve_barcode(bc)
+
+    result = None
+    if alias and alias['kind'] == 'product':
+        result = bobapi.get_product_from_barcode(alias['barcode'])
+        if result and result['bulkid']:
             result = dict(result)
-            result['bulkitem'] = dict(bobapi.get_bulkitem_from_bulkid(
-                result['bulkid']))
-            result['bulkitem'] = (dict(result['bulkitem'])
-                                  if result['bulkitem'] else None)
-    else:
-        result = bobapi.get_bulkitem_from_barcode(bc)
+            bulkitem = bobapi.get_bulkitem_from_bulkid(result['bulkid'])
+            result['bulkitem'] = dict(bulkitem) if bulkitem else None
+    elif alias:
+        result = bobapi.get_bulkitem_from_bulkid(alias['bulkid'])
 
     if not result:
-        if bc.startswith("0") and len(bc) == 13:
-            return get_barcode_details(bc[1:])
-        if bc.startswith("0") and len(bc) == 8:
-            return get_barcode_details(bc[1:-1])
-
         result = {"type": "unknown"}
 
     return jsonify(dict(result))
 
 
-def generic_wrapper(func, repair_func=None,
-                    singleton=False, nolist=False, **kwargs):
+def generic_wrapper(func, repair_func=None, singleton=False, nolist=False,
+                    ttl=None, group_by=None, **kwargs):
+    """Runs func(**kwargs) and jsonifies its rows.
+
+    group_by=(column, keys) returns {key: [rows]} instead, with an entry,
+    possibly empty, for each of keys.
+
+    With ttl (seconds), the result is served from response_cache; see
+    response_cache.ResponseCache for how stale entries are refreshed.
+    """
     if not repair_func:
         repair_func = fix_decimals
 
-    try:
-        raw_result = func(**kwargs)
+    def compute():
+        try:
+            raw_result = func(**kwargs)
 
-        if nolist:
-            result = repair_func(dict(raw_result))
+            if nolist:
+                result = repair_func(dict(raw_result))
+            else:
+                result = [dict(x) for x in raw_result]
+                result = list(map(repair_func, result))
+
+            if singleton:
+                result = result[0]
+
+            if group_by:
+                column, keys = group_by
+                grouped = {key: [] for key in keys}
+                for row in result:
+                    grouped.setdefault(row[column], []).append(row)
+                result = grouped
+
+            return result
+        finally:
+            # Background refreshes run outside any request, so nothing else
+            # would hand their connection back.
+            bobapi.release()
+
+    try:
+        if ttl is None:
+            result = compute()
         else:
-            result = [dict(x) for x in raw_result]
-            result = list(map(repair_func, result))
+            key = "{}:{}".format(request.endpoint, sorted(kwargs.items()))
+            result, g.served_marker = response_cache.lookup(
+                key, ttl, compute, g.get('change_marker'))
 
-        if singleton:
-            result = result[0]
+        return jsonify(result)
+
+    except:
+        import traceback
+        traceback.print_exc()
+
+
+def streaming_wrapper(rows, repair_func=None):
+    """Like generic_wrapper, for a generator of rows: sends the JSON array a
+    chunk at a time instead of building it whole."""
+    if not repair_func:
+        repair_func = fix_decimals
+
+    def generate():
+        sep = "["
+        try:
+            chunk = []
+            for row in rows:
+                chunk.append(sep + json.dumps(repair_func(dict(row))))
+                sep = ","
+                if len(chunk) >= STREAM_CHUNK_ROWS:
+                    yield "".join(chunk)
+                    chunk = []
+            yield "".join(chunk)
+        except:
+            # The status line is gone already; cut the array short so the
+            # client sees invalid JSON rather than a truncated result.
+            import traceback
+            traceback.print_exc()
+            return
+        yield "[]" if sep == "[" else "]"
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def columnar_wrapper(rows, repair_func, columns, dictionary_columns=(),
+                     use_msgpack=False):
+    """Like streaming_wrapper, but answers with to_columnar() of the rows,
+    as JSON or msgpack."""
+    if use_msgpack and not msgpack:
+        return jsonify({"error": "msgpack is not available."}), 406
+
+    try:
+        result = to_columnar(
+            map(repair_func, rows), columns, dictionary_columns)
 
+        if use_msgpack:
+            return Response(msgpack.packb(result, use_bin_type=True),
+                            mimetype='application/msgpack')
         return jsonify(result)
 
     except:
@@ -0,0 +1,70 @@
+"""Remembers which JWTs we've already verified.
+
+A kiosk session reuses the same token for every purchase in a burst, and
+checking its signature again each time is wasted work. VerifiedTokenCache
+keeps the claims of recently verified tokens, keyed by a digest of the
+token, until the token's exp. It's a bounded LRU, safe to share between
+threads.
+
+Only tokens that verified and carry an exp are cached, so a cached token is
+exactly one that decode would still accept.
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+
+DEFAULT_MAX_ENTRIES = 1024
+
+
+class VerifiedTokenCache(object):
+    def __init__(self, decode, max_entries=DEFAULT_MAX_ENTRIES):
+        """decode(token) returns the verified claims or raises."""
+        self._decode = decode
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def decode(self, token):
+        key = hashlib.sha256(token.encode('utf-8')).digest()
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                claims, exp = entry
+                if now < exp:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return dict(claims)
+                del self._entries[key]
+            self.misses += 1
+
+        claims = self._decode(token)
+
+        exp = claims.get('exp')
+        if isinstance(exp, (int, float)) and now < exp:
+            with self._lock:
+                self._entries[key] = (dict(claims), exp)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return claims
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -9,6 +9,7 @@ from jose import jwt, JWTError
 
 from secrets import get_secret
 from private_api.bob_api import bobapi
+from .token_cache import VerifiedTokenCache
 
 VALID_FOR_TIME_S = 300
 JWT_SECRET = get_secret('jwt.secret')
@@ -36,9 +37,13 @@ def _mktoken(userid):
     return jwt.encode(verified, JWT_SECRET, algorithm=JWT_ALGO), exp
 
 
+_verified_tokens = VerifiedTokenCache(
+    lambda token: jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO]))
+
+
 def decodetoken(token):
     try:
-        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO])
+        return _verified_tokens.decode(token)
     except JWTError as e:
         log("Failed to validate token: {} because {}".format(token, e))
         return None
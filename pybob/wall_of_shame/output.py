@@ -0,0 +1,39 @@
+"""Writes the wall's output files only when what they show has changed."""
+
+import hashlib
+import os
+import os.path
+import tempfile
+import threading
+
+# Digest of what we last wrote to each path, by this process.
+_written = {}
+_lock = threading.Lock()
+
+
+def write_if_changed(path, content, key=None):
+    """Replaces path with content (bytes) unless we've already written the
+    same thing there.
+
+    key (bytes) is what's compared, defaulting to content; pass something
+    that leaves out timestamps and cache busters. Returns whether it wrote.
+    """
+    digest = hashlib.sha256(content if key is None else key).hexdigest()
+    with _lock:
+        if _written.get(path) == digest:
+            return False
+
+        # Write beside the target and rename over it, so readers never see a
+        # partial file.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+        _written[path] = digest
+        return True
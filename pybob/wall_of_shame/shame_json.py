@@ -14,6 +14,7 @@ if __name__ == "__main__":
     sys.path.insert(0, os.path.join(BOB_PATH, 'pybob'))
 
 from private_api import db
+from wall_of_shame.output import write_if_changed
 
 
 OUTFILE = "/git/www/json/shame.json"
@@ -70,8 +71,20 @@ def prepare_debtor_set(cursor, query, type_name, **formatting):
     return debtors
 
 
-def generate_shame_json():
-    conn = db.get_conn()
+def _dump(data):
+    return (json.dumps(data, sort_keys=True) + "\n").encode('utf-8')
+
+
+def _write_json(path, data):
+    """Writes data to path unless only its as_of changed."""
+    key = dict(data)
+    key.pop("as_of", None)
+    return write_if_changed(path, _dump(data), key=_dump(key))
+
+
+def generate_shame_json(conn=None):
+    if conn is None:
+        conn = db.get_conn()
     cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
     high_debt = prepare_debtor_set(
@@ -94,14 +107,8 @@ def generate_shame_json():
         "as_of": time.time(),  # Cache busting
     }
 
-    with open(OUTFILE, 'w') as f:
-        json.dump(debt_data, f)
-
-    with open(ANNOUNCE_PATH, 'w') as f:
-        if delinquent or high_debt:
-            json.dump(announce_data, f)
-        else:
-            f.write('{}\n')
+    _write_json(OUTFILE, debt_data)
+    _write_json(ANNOUNCE_PATH, announce_data if debtors else {})
 
     # sys.stdout.write(json.dumps(debt_data))
 
@@ -4,7 +4,6 @@ import datetime
 import os
 import os.path
 import sys
-import tempfile
 
 import arrow
 from jinja2 import Environment, FileSystemLoader
@@ -14,6 +13,7 @@ if __name__ == "__main__":
     sys.path.insert(0, os.path.join(BOB_PATH, 'pybob'))
 
 from private_api import db
+from wall_of_shame.output import write_if_changed
 
 OUTFILE = "/git/www/wall_of_shame.html"
 
@@ -81,21 +81,33 @@ def get_time_on_wall(cur, userid, balance):
     return None
 
 
-def print_wall_of_shame(f, users, total_owed, now):
-    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
-    template = env.get_template(WALL_TEMPLATE)
+# Stands in for the time in the rendered page, so renders can be compared.
+LAST_UPDATED_MARKER = "@@LAST_UPDATED@@"
 
+_env = None
+
+
+def get_template():
+    # One Environment per process, so the template is only compiled once.
+    global _env
+    if _env is None:
+        _env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    return _env.get_template(WALL_TEMPLATE)
+
+
+def render_wall_of_shame(users, total_owed):
+    """Returns the page, with LAST_UPDATED_MARKER where the time goes."""
     wall_debt = float(sum([x['balance'] for x in users]))
     debt_percentage = wall_debt / total_owed * -100.00
 
-    f.write(template.render(
+    return get_template().render(
         users=users,
         total_percentage=debt_percentage, total_debt=total_owed,
         wall_debt=wall_debt,
-        last_updated=now.strftime("%c"),
+        last_updated=LAST_UPDATED_MARKER,
         WARNING_DAYS=WARNING_DAYS,
         WARNING_BALANCE=WARNING_BALANCE,
-        MIN_SHAME_BALANCE=MIN_SHAME_BALANCE).encode('utf-8'))
+        MIN_SHAME_BALANCE=MIN_SHAME_BALANCE)
 
 
 def set_days_since(cursor, user):
@@ -155,10 +167,19 @@ def set_weight(user):
     return set_weight_seconds(user)
 
 
-def regenerate_wall_of_shame(outfile=OUTFILE):
+def get_wall_balances(conn):
+    """Returns {userid: balance} for everyone on the wall."""
+    cursor = conn.cursor()
+    cursor.execute(DEBTOR_QUERY.format(threshold=MIN_SHAME_BALANCE))
+    return {row[3]: row[2] for row in cursor}
+
+
+def regenerate_wall_of_shame(outfile=OUTFILE, conn=None):
+    """Rewrites outfile if the wall changed; returns whether it did."""
     now = datetime.datetime.now()
 
-    conn = db.get_conn()
+    if conn is None:
+        conn = db.get_conn()
     cursor = conn.cursor()
     cursor.execute(DEBTOR_QUERY.format(threshold=MIN_SHAME_BALANCE))
 
@@ -183,14 +204,11 @@ def regenerate_wall_of_shame(outfile=OUTFILE):
     cursor.execute(TOTAL_BALANCE_QUERY)
     total_owed = -1 * float(cursor.fetchone()[0])
 
-    # Doing this layer of indirection means that the transition is faster.
-    # It reduces the race condition wherein we try to load the page while it's
-    # only partially created.
-    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
-        print_wall_of_shame(f, results, total_owed, now)
-        tfile = f.name
-    os.chmod(tfile, 0o644)
-    os.rename(tfile, outfile)
+    page = render_wall_of_shame(results, total_owed)
+    return write_if_changed(
+        outfile,
+        page.replace(LAST_UPDATED_MARKER, now.strftime("%c")).encode('utf-8'),
+        key=page.encode('utf-8'))
 
 
 def main():
@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, HERE + '/../../../pybob')
+
+from bobslack import outbox, stub_slack
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "outbox.sqlite")
+
+        self.stub = stub_slack.StubSlack()
+        server = stub_slack.serve(self.stub, 0)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+        self.outstanding = []
+        self.forgotten = []
+        patches = [
+            mock.patch.object(outbox, 'API_URL', url + "/api/"),
+            mock.patch.object(outbox, 'WEBHOOK_URL', url),
+            mock.patch.object(outbox, 'get_secret', lambda name: "token"),
+            mock.patch.object(outbox, 'CHANNEL_IDS', {}),
+            mock.patch.object(
+                outbox, 'save_outstanding',
+                lambda *args: self.outstanding.append(args)),
+            mock.patch.object(
+                outbox, 'forget_outstanding',
+                lambda *args: self.forgotten.append(args)),
+            mock.patch.object(sys, 'stderr'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        self.public = outbox.PublicOutbox(self.path)
+        self.private = outbox.PrivateOutbox(self.path)
+        self.sender = outbox.OutboxSender(self.path, min_interval_s=0)
+        self.addCleanup(self.sender.conn.close)
+        self.now = time.time() + 1
+
+    def texts(self, kind="post"):
+        return [x.get("text") for x in self.stub.messages if x["kind"] == kind]
+
+    def test_coalesces_per_channel(self):
+        for text in ("a", "b", "c"):
+            self.public.send_msg(text, "#chezbob")
+        self.public.send_msg("cold", "#coldbrew")
+        self.private.send_msg("private", "#random")
+
+        self.assertEqual(self.sender.run_once(self.now), 3)
+        self.assertEqual(sorted(self.texts()), ["a\nb\nc", "cold"])
+        self.assertEqual(self.texts("webhook"), ["private"])
+        self.assertEqual(self.sender.stats()["queued"], 0)
+        self.assertEqual(self.sender.coalesced, 2)
+
+        # Posted to the channel's id, as public_slack does it.
+        channels = [x["channel"] for x in self.stub.messages
+                    if x["kind"] == "post"]
+        self.assertEqual(sorted(channels), sorted(
+            [self.stub.channels["chezbob"], self.stub.channels["coldbrew"]]))
+
+    def test_tracked_posts_go_alone_and_are_recorded(self):
+        self.public.send_msg("a", "#chezbob")
+        self.public.send_msg("shame", "#chezbob", track_userid=7)
+        self.public.send_msg("b", "#chezbob")
+
+        for _ in range(3):
+            self.sender.run_once(self.now)
+        self.assertEqual(self.texts(), ["a", "shame", "b"])
+        [(userid, channel, ts)] = self.outstanding
+        self.assertEqual((userid, channel), (7, self.stub.channels["chezbob"]))
+
+    def test_backoff_keeps_channel_order(self):
+        self.stub.fail_every = 1
+        self.public.send_msg("first", "#chezbob", track_userid=1)
+        self.assertEqual(self.sender.run_once(self.now), 1)
+        self.assertEqual(self.sender.retries, 1)
+        self.stub.fail_every = 0
+
+        # Queued after the failure, but still behind it.
+        self.public.send_msg("second", "#chezbob")
+        self.sender.run_once(self.now)
+        self.assertEqual(self.texts(), [])
+
+        self.sender.run_once(self.now + 3)
+        self.sender.run_once(self.now + 3)
+        self.assertEqual(self.texts(), ["first", "second"])
+
+    def test_gives_up(self):
+        self.stub.fail_every = 1
+        self.public.send_msg("doomed", "#chezbob")
+        for i in range(outbox.MAX_ATTEMPTS):
+            self.sender.run_once(self.now + outbox.MAX_BACKOFF_S * i)
+        self.assertEqual(self.sender.dropped, 1)
+        self.assertEqual(self.sender.stats()["queued"], 0)
+
+    def test_unknown_channel_is_retried(self):
+        self.public.send_msg("hello?", "#nowhere")
+        self.sender.run_once(self.now)
+        self.assertEqual(self.sender.retries, 1)
+        self.assertEqual(self.texts(), [])
+
+    def test_rate_limit_pauses_without_using_attempts(self):
+        self.stub.rate_limit_every = 1
+        self.public.send_msg("a", "#chezbob")
+        self.public.send_msg("b", "#coldbrew")
+        self.assertEqual(self.sender.run_once(self.now), 1)
+        self.stub.rate_limit_every = 0
+
+        # The whole workspace waits out Retry-After.
+        self.assertEqual(self.sender.run_once(self.now), 0)
+        self.sender.run_once(self.now + self.stub.retry_after)
+        self.assertEqual(sorted(self.texts()), ["a", "b"])
+        self.assertEqual(self.sender.retries, 0)
+
+    def test_cancel_tracked(self):
+        self.public.send_msg("shame", "#chezbob", track_userid=7)
+        self.public.send_msg("other", "#chezbob", track_userid=8)
+        self.assertEqual(self.public.cancel_tracked(7), 1)
+
+        self.sender.run_once(self.now)
+        self.assertEqual(self.texts(), ["other"])
+
+    def test_cancelled_while_posting_is_taken_down(self):
+        deliver = outbox.deliver
+
+        def deliver_then_cancel(*args):
+            result = deliver(*args)
+            self.public.cancel_tracked(7)
+            return result
+
+        self.public.send_msg("shame", "#chezbob", track_userid=7)
+        with mock.patch.object(outbox, 'deliver', deliver_then_cancel):
+            self.sender.run_once(self.now)
+        self.assertEqual(self.forgotten, self.outstanding)
+
+        self.sender.run_once(self.now)
+        [post] = [x for x in self.stub.messages if x["kind"] == "post"]
+        [delete] = [x for x in self.stub.messages if x["kind"] == "delete"]
+        self.assertEqual(delete["channel"], post["channel"])
+        self.assertEqual(delete["ts"], self.outstanding[0][2])
+
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,22 @@
+"""Fakes and helpers shared by the pybob tests."""
+
+import contextlib
+import time
+
+
+class FakePool(object):
+    """Stands in for db.get_pool(); callbacks get None as their conn."""
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield None
+
+
+def wait_for(condition, timeout_s=5):
+    """Polls condition until it's true, failing after timeout_s. Uses the
+    monotonic clock, since some tests freeze time.time."""
+    deadline = time.monotonic() + timeout_s
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.001)
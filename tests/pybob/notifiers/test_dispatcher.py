@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(HERE + '/..')
+sys.path.append(HERE + '/../../../pybob')
+sys.path.append(HERE + '/../../../pybob/notifiers')
+
+import dispatcher
+from dispatcher import TransactionDispatcher
+from helpers import FakePool, wait_for
+
+
+class DispatcherTest(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(dispatcher.db, 'get_pool', FakePool),
+            mock.patch.object(dispatcher, 'RETRY_DELAY_S', 0),
+            mock.patch.object(sys, 'stderr'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_per_user_order(self):
+        seen = []
+
+        def record_it(conn, record):
+            seen.append((record['userid'], record['id']))
+
+        d = TransactionDispatcher([record_it], n_workers=4)
+        for tid in range(1, 201):
+            d.dispatch({'id': tid, 'userid': tid % 7})
+        wait_for(lambda: d.checkpoint() == 200)
+
+        for userid in range(7):
+            ids = [tid for uid, tid in seen if uid == userid]
+            self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(seen), 200)
+
+    def test_checkpoint_waits_for_slowest(self):
+        release = threading.Event()
+
+        def slow(conn, record):
+            if record['id'] == 2:
+                release.wait()
+
+        d = TransactionDispatcher([slow], n_workers=2)
+        self.assertIsNone(d.checkpoint())
+        # 2 on one worker, the rest on the other.
+        for tid in (1, 2, 3, 4):
+            d.dispatch({'id': tid, 'userid': 0 if tid == 2 else 1})
+
+        wait_for(lambda: not d.is_pending(3) and not d.is_pending(4))
+        self.assertEqual(d.checkpoint(), 1)
+
+        release.set()
+        wait_for(lambda: d.checkpoint() == 4)
+
+    def test_retry_then_succeed(self):
+        calls = []
+
+        def flaky(conn, record):
+            calls.append(record['id'])
+            if len(calls) < 3:
+                raise RuntimeError("try again")
+
+        d = TransactionDispatcher([flaky], max_attempts=3)
+        d.dispatch({'id': 10, 'userid': 1})
+        wait_for(lambda: d.checkpoint() == 10)
+        self.assertEqual(calls, [10, 10, 10])
+        self.assertEqual(d.dead_letters(), [])
+
+    def test_stats_count_transactions_not_attempts(self):
+        calls = []
+
+        def flaky(conn, record):
+            calls.append(record['id'])
+            if record['id'] == 1 and len(calls) < 3:
+                raise RuntimeError("try again")
+
+        d = TransactionDispatcher([flaky], max_attempts=3)
+        for tid in (1, 2):
+            d.dispatch({'id': tid, 'userid': 1})
+        wait_for(lambda: d.checkpoint() == 2)
+
+        stats = d.stats()['flaky']
+        self.assertEqual(stats['handled'], 2)
+        self.assertEqual(stats['attempts'], 4)
+        self.assertEqual(stats['errors'], 2)
+        self.assertEqual(stats['dead_lettered'], 0)
+
+    def test_failure_holds_checkpoint_until_released(self):
+        def broken(conn, record):
+            if record['id'] == 2:
+                raise RuntimeError("broken")
+
+        def fine(conn, record):
+            pass
+
+        d = TransactionDispatcher([broken, fine], max_attempts=2)
+        for tid in (1, 2, 3):
+            d.dispatch({'id': tid, 'userid': 1})
+
+        wait_for(lambda: d.dead_letters())
+        wait_for(lambda: not d.is_pending(3))
+        self.assertEqual(d.checkpoint(), 1)
+
+        [(tid, name, error)] = d.dead_letters()
+        self.assertEqual((tid, name), (2, 'broken'))
+        self.assertIn("RuntimeError", error)
+
+        d.release(tid, name)
+        self.assertEqual(d.checkpoint(), 3)
+        self.assertEqual(d.dead_letters(), [])
+
+    def test_dispatch_to_named(self):
+        seen = []
+
+        def first(conn, record):
+            seen.append('first')
+
+        def second(conn, record):
+            seen.append('second')
+
+        d = TransactionDispatcher([first, second])
+        d.dispatch({'id': 5, 'userid': 1}, ['second'])
+        wait_for(lambda: d.checkpoint() == 5)
+        self.assertEqual(seen, ['second'])
+
+        # Nothing to run it, so nothing left pending.
+        d.dispatch({'id': 6, 'userid': 1}, ['gone'])
+        self.assertFalse(d.is_pending(6))
+
+
+if (__name__ == '__main__'):
+    unittest.main()
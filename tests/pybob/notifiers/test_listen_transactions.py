@@ -0,0 +1,257 @@
+#! /usr/bin/env python3
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(HERE + '/..')
+sys.path.append(HERE + '/../../../pybob')
+sys.path.append(HERE + '/../../../pybob/notifiers')
+
+import dispatcher
+import listen_transactions as lt
+from dispatcher import TransactionDispatcher
+from helpers import FakePool, wait_for
+
+
+class FakeCursor(object):
+    """Answers the listener's own queries from a FakeDB."""
+
+    def __init__(self, db):
+        self.db = db
+        self.rowcount = 0
+        self.rows = []
+
+    def execute(self, query, args=None):
+        db = self.db
+        self.rows = []
+        if query == lt.LAST_TRANSACTION_ID:
+            self.rows = [(max([x['id'] for x in db.committed()] or [0]),)]
+
+        elif query == lt.LOAD_CHECKPOINT:
+            overlap_s, consumer = args
+            if consumer in db.checkpoints:
+                last_id, recent_ids, updated = db.checkpoints[consumer]
+                self.rows = [(last_id, recent_ids, updated - overlap_s)]
+
+        elif query in (lt.UPDATE_CHECKPOINT, lt.INSERT_CHECKPOINT):
+            last_id, recent_ids, consumer = args
+            exists = consumer in db.checkpoints
+            if exists or query == lt.INSERT_CHECKPOINT:
+                db.checkpoints[consumer] = (last_id, recent_ids, time.time())
+            self.rowcount = 1 if exists else 0
+
+        elif query == lt.REPLAY_START:
+            ids = [x['id'] for x in db.committed()
+                   if x['xacttime'] > args['since'] and
+                   x['id'] <= args['after_id']]
+            self.rows = [(min(ids) - 1 if ids else args['after_id'],)]
+
+        elif query == lt.REPLAY_QUERY:
+            since = args['since']
+            self.rows = [
+                x for x in db.committed()
+                if x['id'] > args['start'] and
+                (x['id'] > args['after_id'] or
+                 (since is not None and x['xacttime'] > since)) and
+                x['id'] not in args['skip']][:args['limit']]
+
+        elif query == lt.RECORDS_BY_ID_QUERY:
+            self.rows = [x for x in db.committed() if x['id'] in args[0]]
+
+        elif query == lt.LOAD_DEAD_LETTERS:
+            self.rows = [(tid, name) for (c, name, tid) in db.dead_letters
+                         if c == args[0]]
+
+        elif query == lt.UPDATE_DEAD_LETTER:
+            error, consumer, name, tid = args
+            key = (consumer, name, tid)
+            self.rowcount = 1 if key in db.dead_letters else 0
+            if self.rowcount:
+                db.dead_letters[key] += 1
+
+        elif query == lt.INSERT_DEAD_LETTER:
+            error, consumer, name, tid = args
+            db.dead_letters[(consumer, name, tid)] = 1
+
+        elif query == lt.DELETE_DEAD_LETTER:
+            db.dead_letters.pop(tuple(args), None)
+
+        else:
+            raise AssertionError("unexpected query " + query)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return list(self.rows)
+
+
+class FakeDB(object):
+    def __init__(self):
+        self.transactions = []
+        self.checkpoints = {}
+        self.dead_letters = {}
+
+    def begin(self, tid, userid=1):
+        """Starts a transaction; it isn't seen until commit()."""
+        self.transactions.append({
+            'id': tid, 'userid': userid, 'xacttime': time.time(),
+            'committed': False})
+
+    def commit(self, tid):
+        for x in self.transactions:
+            if x['id'] == tid:
+                x['committed'] = True
+
+    def committed(self):
+        return sorted([x for x in self.transactions if x['committed']],
+                      key=lambda x: x['id'])
+
+    def get(self, tid):
+        return [x for x in self.transactions if x['id'] == tid][0]
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(dispatcher.db, 'get_pool', FakePool),
+            mock.patch.object(dispatcher, 'RETRY_DELAY_S', 0),
+            mock.patch.object(sys, 'stderr'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        self.db = FakeDB()
+        self.handled = []
+
+    def start(self, cbs=None):
+        """What watch_transactions does before it starts listening."""
+        d = TransactionDispatcher(cbs or [self.handle])
+        checkpointer, replayed = lt.replay_missed(self.db, 'test', d)
+        return d, checkpointer, replayed
+
+    def handle(self, conn, record):
+        self.handled.append(record['id'])
+
+    def notify(self, d, tid):
+        d.dispatch(self.db.get(tid))
+
+    def settle(self, d, checkpointer):
+        # Dead letters stay pending until the checkpointer has saved them.
+        wait_for(lambda: set(d._pending) <= set(
+            tid for tid, _, _ in d.dead_letters()))
+        checkpointer.save_if_due(force=True)
+
+    def test_first_run_starts_at_latest(self):
+        for tid in (1, 2):
+            self.db.begin(tid)
+            self.db.commit(tid)
+        d, checkpointer, replayed = self.start()
+        self.assertEqual(len(replayed), 0)
+        self.assertEqual(self.db.checkpoints['test'][0], 2)
+
+    def test_replays_what_was_missed(self):
+        d, checkpointer, _ = self.start()
+        for tid in (1, 2, 3):
+            self.db.begin(tid)
+            self.db.commit(tid)
+        self.notify(d, 1)
+        self.settle(d, checkpointer)
+
+        # Down for 2 and 3.
+        d, checkpointer, replayed = self.start()
+        self.settle(d, checkpointer)
+        self.assertEqual(self.handled, [1, 2, 3])
+        self.assertIn(2, replayed)
+        self.assertEqual(self.db.checkpoints['test'][0], 3)
+
+    def test_late_commit_below_checkpoint_is_replayed(self):
+        d, checkpointer, _ = self.start()
+        for tid in (1, 2, 3):
+            self.db.begin(tid)
+            self.db.commit(tid)
+            self.notify(d, tid)
+        # 4 gets its id first, but 5 commits first.
+        self.db.begin(4)
+        self.db.begin(5)
+        self.db.commit(5)
+        self.notify(d, 5)
+        self.settle(d, checkpointer)
+        self.assertEqual(self.db.checkpoints['test'][0], 5)
+
+        # We stop before 4 commits.
+        self.db.commit(4)
+        d, checkpointer, replayed = self.start()
+        self.settle(d, checkpointer)
+        self.assertEqual(sorted(self.handled), [1, 2, 3, 4, 5])
+
+        # And a second restart doesn't replay anything again.
+        d, checkpointer, replayed = self.start()
+        self.settle(d, checkpointer)
+        self.assertEqual(sorted(self.handled), [1, 2, 3, 4, 5])
+        self.assertEqual(len(replayed), 0)
+
+    def test_failure_is_dead_lettered_and_retried(self):
+        broken = [True]
+
+        def flaky(conn, record):
+            if broken[0] and record['id'] == 2:
+                raise RuntimeError("Slack is down")
+            self.handled.append(record['id'])
+
+        d, checkpointer, _ = self.start([flaky])
+        for tid in (1, 2, 3):
+            self.db.begin(tid)
+            self.db.commit(tid)
+            self.notify(d, tid)
+        wait_for(lambda: d.dead_letters())
+        self.settle(d, checkpointer)
+
+        # Recorded before the checkpoint passed it.
+        self.assertEqual(list(self.db.dead_letters), [('test', 'flaky', 2)])
+        self.assertEqual(self.db.checkpoints['test'][0], 3)
+        self.assertEqual(self.handled, [1, 3])
+
+        broken[0] = False
+        d, checkpointer, replayed = self.start([flaky])
+        self.settle(d, checkpointer)
+        self.assertEqual(self.handled, [1, 3, 2])
+        self.assertEqual(self.db.dead_letters, {})
+        self.assertEqual(len(replayed), 0)
+
+
+class GetRecordTest(unittest.TestCase):
+    def test_id_only_payload_is_looked_up(self):
+        db = FakeDB()
+        db.begin(3)
+        db.commit(3)
+        self.assertEqual(lt.get_record(db, "3")['id'], 3)
+
+
+class ReplayedTest(unittest.TestCase):
+    def test_prune(self):
+        replayed = lt.Replayed()
+        replayed.add(1)
+        replayed.add(2)
+
+        # Below the checkpoint, but too recent to forget.
+        replayed.prune(2)
+        self.assertIn(1, replayed)
+
+        replayed.ids[1] -= lt.REPLAYED_DEDUPE_S + 1
+        replayed.ids[2] -= lt.REPLAYED_DEDUPE_S + 1
+        replayed.prune(1)
+        self.assertNotIn(1, replayed)
+        # Not yet below the checkpoint.
+        self.assertIn(2, replayed)
+
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(HERE + '/../../../pybob')
+
+import psycopg2.extensions
+
+from private_api import db
+from private_api.db import ConnectionPool, PoolTimeoutException
+
+
+class FakeConn(object):
+    def __init__(self):
+        self.closed = False
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+
+        def connect(pool):
+            conn = FakeConn()
+            self.opened.append(conn)
+            return conn
+
+        p = mock.patch.object(ConnectionPool, '_connect', connect)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_opens_minconn_unless_lazy(self):
+        pool = ConnectionPool({}, minconn=2, maxconn=4)
+        self.assertEqual(len(self.opened), 2)
+
+        lazy = ConnectionPool({}, minconn=2, maxconn=4, lazy=True)
+        self.assertEqual(lazy.stats(), {"open": 0, "idle": 0, "max": 4})
+        self.assertEqual(pool.stats(), {"open": 2, "idle": 2, "max": 4})
+
+    def test_reuses_returned_connections(self):
+        pool = ConnectionPool({}, minconn=0, maxconn=2)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        self.assertIs(pool.getconn(), conn)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_times_out_when_exhausted(self):
+        pool = ConnectionPool({}, minconn=0, maxconn=1)
+        pool.getconn()
+        with self.assertRaises(PoolTimeoutException):
+            pool.getconn(timeout=0.01)
+
+    def test_waiter_gets_returned_connection(self):
+        pool = ConnectionPool({}, minconn=0, maxconn=1)
+        conn = pool.getconn()
+
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(pool.getconn(5)))
+        waiter.start()
+        pool.putconn(conn)
+        waiter.join()
+        self.assertEqual(got, [conn])
+
+    def test_rolls_back_on_return(self):
+        pool = ConnectionPool({}, minconn=0, maxconn=1)
+        with pool.connection() as conn:
+            conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        self.assertEqual(conn.rollbacks, 1)
+
+    def test_closed_connections_free_their_slot(self):
+        pool = ConnectionPool({}, minconn=0, maxconn=1)
+        conn = pool.getconn()
+        conn.close()
+        pool.putconn(conn)
+        self.assertEqual(pool.stats()["open"], 0)
+        self.assertIsNot(pool.getconn(timeout=0.01), conn)
+
+    def test_broken_idle_connection_is_replaced(self):
+        pool = ConnectionPool({}, minconn=1, maxconn=1)
+        [conn] = self.opened
+        conn.status = psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+        self.assertIsNot(pool.getconn(), conn)
+        self.assertTrue(conn.closed)
+
+    def test_scoped_conn_is_per_thread(self):
+        pool = ConnectionPool({}, minconn=0, maxconn=2)
+        mine = pool.scoped_conn()
+        self.assertIs(pool.scoped_conn(), mine)
+
+        theirs = []
+        other = threading.Thread(
+            target=lambda: theirs.append(pool.scoped_conn()))
+        other.start()
+        other.join()
+        self.assertIsNot(theirs[0], mine)
+
+        pool.release_scoped()
+        self.assertEqual(pool.stats()["idle"], 1)
+
+
+class GetPoolTest(unittest.TestCase):
+    def test_one_pool_per_process(self):
+        with mock.patch.object(db, '_pool', None):
+            path = HERE + '/../../../db.conf'
+            pool = db.get_pool(path, lazy=True)
+            self.assertIs(db.get_pool(path), pool)
+            self.assertEqual(pool.minconn, db.DEFAULT_POOL_MIN)
+
+
+if (__name__ == '__main__'):
+    unittest.main()
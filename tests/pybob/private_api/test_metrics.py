@@ -0,0 +1,59 @@
+#! /usr/bin/env python3
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(HERE + '/../../../pybob')
+
+from private_api.metrics import QueryMetrics
+
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = QueryMetrics(enabled=True)
+        self.closed = []
+
+    def rows(self, n, fail_at=None):
+        try:
+            for i in range(n):
+                if i == fail_at:
+                    raise RuntimeError("connection lost")
+                yield i
+        finally:
+            self.closed.append(True)
+
+    def recorded(self):
+        return self.metrics.snapshot()["methods"]["stream_rows"]
+
+    def test_recorded_when_exhausted(self):
+        stream = self.metrics.stream("stream_rows", self.rows(3))
+        self.assertEqual(self.metrics.snapshot()["methods"], {})
+        self.assertEqual(list(stream), [0, 1, 2])
+        self.assertEqual(
+            (self.recorded()["calls"], self.recorded()["rows"]), (1, 3))
+
+    def test_recorded_and_closed_when_closed_early(self):
+        stream = self.metrics.stream("stream_rows", self.rows(10))
+        next(stream)
+        stream.close()
+        self.assertEqual(self.closed, [True])
+        self.assertEqual(
+            (self.recorded()["rows"], self.recorded()["errors"]), (1, 0))
+
+    def test_error(self):
+        stream = self.metrics.stream("stream_rows", self.rows(10, fail_at=2))
+        with self.assertRaises(RuntimeError):
+            list(stream)
+        self.assertEqual(
+            (self.recorded()["rows"], self.recorded()["errors"]), (2, 1))
+
+    def test_disabled(self):
+        self.metrics.disable()
+        self.assertEqual(
+            list(self.metrics.stream("stream_rows", self.rows(2))), [0, 1])
+        self.assertEqual(self.metrics.snapshot()["methods"], {})
+
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(HERE + '/../../../pybob/public_api')
+
+import barcode_images
+from barcode_images import BarcodeImageCache, symbology_for
+
+
+def png(data):
+    return ("png:" + data).encode('utf-8')
+
+
+def decoded(result):
+    return {k: base64.b64decode(v) for k, v in result.items()}
+
+
+class SymbologyTest(unittest.TestCase):
+    def test_upc_a_drops_check_digit(self):
+        self.assertEqual(symbology_for("012345678905"),
+                         (barcode_images.UPC_A, "01234567890"))
+
+    def test_upc_e(self):
+        self.assertEqual(symbology_for("123456"),
+                         (barcode_images.UPC_E, "123456"))
+
+    def test_ean_13_drops_check_digit(self):
+        self.assertEqual(symbology_for("0012345678905"),
+                         (barcode_images.CODE_128, "001234567890"))
+
+    def test_anything_else_is_code_128(self):
+        self.assertEqual(symbology_for("ABC-1"),
+                         (barcode_images.CODE_128, "ABC-1"))
+
+
+class BarcodeImageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        p = mock.patch.object(sys, 'stderr')
+        p.start()
+        self.addCleanup(p.stop)
+
+        self.batches = []
+        self.singles = []
+        self.broken = set()
+
+    def cache(self, **kwargs):
+        cache = BarcodeImageCache(self.dir, **kwargs)
+
+        def render_batch(typ, height, datas):
+            self.batches.append((typ, list(datas)))
+            if self.broken & set(datas):
+                raise RuntimeError("zint failed")
+            return [png(d) for d in datas]
+
+        def render_one(typ, height, data):
+            self.singles.append(data)
+            if data in self.broken:
+                raise RuntimeError("zint failed")
+            return png(data)
+
+        cache._render_batch = render_batch
+        cache._render_one = render_one
+        return cache
+
+    def test_one_batch_per_symbology(self):
+        cache = self.cache()
+        result = cache.render_many(["012345678905", "123456", "ABC", "DEF"])
+        self.assertEqual(decoded(result), {
+            "012345678905": png("01234567890"),
+            "123456": png("123456"),
+            "ABC": png("ABC"),
+            "DEF": png("DEF"),
+        })
+        self.assertEqual(len(self.batches), 3)
+        self.assertEqual(cache.renders, 4)
+
+    def test_memory_then_disk(self):
+        cache = self.cache()
+        cache.render_many(["ABC"])
+        cache.render_many(["ABC"])
+        self.assertEqual((len(self.batches), cache.hits), (1, 1))
+
+        # A new process finds it on disk.
+        other = self.cache()
+        self.assertEqual(base64.b64decode(other.render("ABC")), png("ABC"))
+        self.assertEqual((len(self.batches), other.disk_hits), (1, 1))
+
+    def test_height_is_part_of_the_key(self):
+        cache = self.cache()
+        cache.render("ABC", height=10)
+        cache.render("ABC", height=20)
+        self.assertEqual(len(self.batches), 2)
+
+    def test_bad_barcode_falls_back_to_one_by_one(self):
+        self.broken.add("BAD")
+        cache = self.cache()
+        result = cache.render_many(["BAD", "GOOD"])
+        self.assertEqual(result["BAD"], "")
+        self.assertEqual(base64.b64decode(result["GOOD"]), png("GOOD"))
+        self.assertEqual(sorted(self.singles), ["BAD", "GOOD"])
+
+        # Not retried until restart.
+        cache.render_many(["BAD"])
+        self.assertEqual(len(self.batches), 1)
+
+    def test_memory_is_bounded(self):
+        cache = self.cache(max_memory_entries=2)
+        cache.render_many(["A", "B", "C"])
+        self.assertEqual(cache.stats()["memory_entries"], 2)
+
+
+if (__name__ == '__main__'):
+    unittest.main()
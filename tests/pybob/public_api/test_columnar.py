@@ -0,0 +1,49 @@
+#! /usr/bin/env python3
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(HERE + '/../../../pybob/public_api')
+
+from columnar import to_columnar
+
+
+class ToColumnarTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(to_columnar([], ('a', 'b'), ('b',)), {
+            "format": "columnar",
+            "length": 0,
+            "columns": {"a": [], "b": []},
+            "dictionaries": {"b": []},
+        })
+
+    def test_plain_columns(self):
+        rows = [{"a": 1, "b": "x", "c": "ignored"}, {"a": 2, "b": None}]
+        result = to_columnar(rows, ('a', 'b'))
+        self.assertEqual(result["length"], 2)
+        self.assertEqual(result["columns"], {"a": [1, 2], "b": ["x", None]})
+        self.assertEqual(result["dictionaries"], {})
+
+    def test_dictionary_columns(self):
+        rows = [{"user": u, "value": i}
+                for i, u in enumerate(["bob", "amy", "bob", None, "amy"])]
+        result = to_columnar(rows, ('user', 'value'), ('user',))
+        self.assertEqual(result["dictionaries"]["user"], ["bob", "amy", None])
+        self.assertEqual(result["columns"]["user"], [0, 1, 0, 2, 1])
+        self.assertEqual(result["columns"]["value"], [0, 1, 2, 3, 4])
+
+        # Decodes back to the rows.
+        users = result["dictionaries"]["user"]
+        self.assertEqual(
+            [users[i] for i in result["columns"]["user"]],
+            [row["user"] for row in rows])
+
+    def test_accepts_a_generator(self):
+        result = to_columnar(({"a": i} for i in range(3)), ('a',))
+        self.assertEqual(result["columns"]["a"], [0, 1, 2])
+        self.assertEqual(result["length"], 3)
+
+
+if (__name__ == '__main__'):
+    unittest.main()
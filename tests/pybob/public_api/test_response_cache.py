@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(HERE + '/..')
+sys.path.append(HERE + '/../../../pybob/public_api')
+
+import response_cache
+from helpers import wait_for
+from response_cache import ResponseCache
+
+
+class Counter(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.calls
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patches = [
+            mock.patch.object(response_cache.time, 'time',
+                              lambda: self.now),
+            mock.patch.object(sys, 'stderr'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.cache = ResponseCache(max_entries=2, max_stale_s=10)
+
+    def test_fresh_hit(self):
+        compute = Counter()
+        self.assertEqual(self.cache.get('a', 5, compute), 1)
+        self.assertEqual(self.cache.get('a', 5, compute), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_stale_is_served_while_refreshing(self):
+        compute = Counter()
+        self.cache.get('a', 5, compute)
+        self.now += 6
+        self.assertEqual(self.cache.get('a', 5, compute), 1)
+        wait_for(lambda: self.cache.refreshes == 2)
+        self.assertEqual(self.cache.get('a', 5, compute), 2)
+
+    def test_too_stale_is_recomputed(self):
+        compute = Counter()
+        self.cache.get('a', 5, compute)
+        self.now += 16
+        self.assertEqual(self.cache.get('a', 5, compute), 2)
+
+    def test_new_marker_makes_entry_stale(self):
+        compute = Counter()
+        self.assertEqual(self.cache.lookup('a', 5, compute, 1), (1, 1))
+
+        # Served under the marker it was computed with, then refreshed.
+        self.assertEqual(self.cache.lookup('a', 5, compute, 2), (1, 1))
+        wait_for(lambda: self.cache.refreshes == 2)
+        self.assertEqual(self.cache.lookup('a', 5, compute, 2), (2, 2))
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_misses_are_coalesced(self):
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            release.wait()
+            return "v"
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(self.cache.get('a', 5, slow)))
+            for _ in range(3)]
+        for t in threads:
+            t.start()
+        wait_for(lambda: self.cache.misses + self.cache.coalesced == 3)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, ["v"] * 3)
+        self.assertEqual(len(calls), 1)
+
+    def test_errors_are_not_cached(self):
+        def broken():
+            raise RuntimeError("db down")
+
+        with self.assertRaises(RuntimeError):
+            self.cache.get('a', 5, broken)
+        self.assertEqual(self.cache.get('a', 5, Counter()), 1)
+        self.assertEqual(self.cache.refresh_errors, 1)
+
+    def test_evicts_least_recently_used(self):
+        for key in ('a', 'b'):
+            self.cache.get(key, 5, Counter())
+        self.cache.get('a', 5, Counter())
+        self.cache.get('c', 5, Counter())
+        self.assertEqual(list(self.cache._entries), ['a', 'c'])
+
+
+if (__name__ == '__main__'):
+    unittest.main()
@@ -33,13 +33,62 @@ var DEFAULT_OPTIONS = {
 };
 
 var API_HOST = "https://chezbob.ucsd.edu"
-var TRANSACTION_URL = API_HOST + "/api/stats/v0.1/sales/get_month_transactions";
+var TRANSACTION_URL = API_HOST + "/api/stats/v0.1/sales/get_month_transactions?format=columnar";
+
+// Live updates come from the crossbar dashboard aggregator; we only poll
+// while we can't reach it.
+var WS_URL = API_HOST.replace(/^http/, "ws") + "/ws";
+var DELTA_TOPIC = "chezbob.dashboard.delta";
+var SNAPSHOT_PROCEDURE = "chezbob.dashboard.get_snapshot";
+var NODE_NAME = "dashboard";
+var POLL_INTERVAL_MS = 5*60*1000;
+var RENDER_DELAY_MS = 2000;
+
+var all_transactions = [];
+var wamp_session = null;
+var last_seq = null;
+// Deltas that arrive while a snapshot is on its way.
+var queued_deltas = null;
+var poll_timer = null;
+var render_timer = null;
+
+// Turns the columnar form of get_month_transactions back into one object
+// per transaction. A plain list of objects is passed through untouched.
+function decode_columnar(data) {
+    if (Array.isArray(data))
+        return data;
+
+    var columns = data.columns;
+    var dictionaries = data.dictionaries;
+    var names = Object.keys(columns);
+    var rows = [];
+    for (var i = 0; i < data.length; ++i) {
+        var row = {};
+        for (var j = 0; j < names.length; ++j) {
+            var name = names[j];
+            var value = columns[name][i];
+            if (name in dictionaries)
+                value = dictionaries[name][value];
+            row[name] = value;
+        }
+        rows.push(add_xacttime_s(row));
+    }
+    return rows;
+}
+
+function add_xacttime_s(row) {
+    if (!("xacttime_s" in row) && "xacttime_e" in row)
+        row.xacttime_s = new Date(row.xacttime_e * 1000).toISOString();
+    return row;
+}
 
 function get_transactions() {
     var promise = new Promise(function(resolve, reject) {
         console.log("Getting transactions");
         url = TRANSACTION_URL;
-        $.getJSON(url, null, resolve).fail(
+        $.getJSON(url, null, function(data) {
+            resolve(decode_columnar(data));
+        }).fail(
             function() { reject(Error("JSON request failed")) });
     });
     return promise;
@@ -218,8 +267,130 @@ function process_new_data(transactions) {
     update_user_stats(transactions);
 }
 
+function render() {
+    render_timer = null;
+    process_new_data(all_transactions);
+}
+
+// Redraws at most once per RENDER_DELAY_MS, however fast deltas arrive.
+function schedule_render() {
+    if (render_timer === null)
+        render_timer = setTimeout(render, RENDER_DELAY_MS);
+}
+
 function trigger_update() {
-    return get_transactions().then(process_new_data);
+    return get_transactions().then(function(transactions) {
+        all_transactions = transactions;
+        render();
+    });
+}
+
+// Replaces everything we have with the aggregator's snapshot, then applies
+// whatever deltas came in meanwhile.
+function load_snapshot() {
+    if (queued_deltas !== null)
+        return;
+    queued_deltas = [];
+
+    wamp_session.call(SNAPSHOT_PROCEDURE).then(
+        function(snapshot) {
+            var queued = queued_deltas;
+            if (queued === null)
+                // The connection went while we waited.
+                return;
+            queued_deltas = null;
+
+            all_transactions = decode_columnar(snapshot);
+            last_seq = snapshot.seq;
+            render();
+            for (var i = 0; i < queued.length; ++i)
+                apply_delta([queued[i]]);
+        },
+        function(err) {
+            console.log("Failed to get dashboard snapshot", err);
+            queued_deltas = null;
+            last_seq = null;
+            trigger_update();
+        });
+}
+
+function apply_delta(args) {
+    var delta = args[0];
+    if (queued_deltas !== null) {
+        queued_deltas.push(delta);
+        return;
+    }
+    if (last_seq !== null && delta.seq <= last_seq)
+        // Already in the snapshot.
+        return;
+
+    if (delta.type == "transaction" && last_seq !== null &&
+            delta.seq == last_seq + 1) {
+        last_seq = delta.seq;
+        all_transactions.push(add_xacttime_s(delta.transaction));
+        schedule_render();
+    }
+    else {
+        // We missed something, or the aggregator resynced; start over.
+        load_snapshot();
+    }
+}
+
+function start_polling() {
+    if (poll_timer === null)
+        poll_timer = setInterval(trigger_update, POLL_INTERVAL_MS);
+}
+
+function stop_polling() {
+    if (poll_timer !== null) {
+        clearInterval(poll_timer);
+        poll_timer = null;
+    }
+}
+
+function init_websockets() {
+    if (typeof autobahn === "undefined") {
+        console.log("No autobahn; polling for updates.");
+        return;
+    }
+
+    var heartbeat_timer;
+    var connection = new autobahn.Connection({
+       url: WS_URL, realm: "chezbob"
+    });
+
+    connection.onopen = function (session, details) {
+        console.log("Connected");
+        wamp_session = session;
+        session.subscribe(DELTA_TOPIC, apply_delta).then(
+            function() {
+                console.log("Subscribed to dashboard deltas");
+                stop_polling();
+                // Anything sold while we were polling.
+                last_seq = null;
+                load_snapshot();
+            },
+            function(err) {
+                console.log("Failed subscription for deltas", err);
+            });
+
+        heartbeat_timer = setInterval(function () {
+           session.publish('chezbob.heartbeat', [NODE_NAME]);
+        }, 1000);
+    };
+
+    connection.onclose = function (reason, details) {
+        console.log("Connection lost: " + reason);
+        wamp_session = null;
+        queued_deltas = null;
+        if (heartbeat_timer) {
+           clearInterval(heartbeat_timer);
+           heartbeat_timer = null;
+        }
+        start_polling();
+    };
+
+    connection.open();
 }
 
 function hide_loading_overlay() {
@@ -233,5 +404,6 @@ function on_load() {
     init_product_stats(google);
     init_user_stats(google);
     trigger_update().then(hide_loading_overlay);
-    setInterval(trigger_update, 5*60*1000);
+    start_polling();
+    init_websockets();
 }